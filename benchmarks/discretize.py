@@ -0,0 +1,115 @@
+"""Compares tools.discretize_series with the implementation it replaced.
+
+Usage:
+
+    python benchmarks/discretize.py [n_rows]
+
+"""
+import numbers
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from phd import tools  # noqa: E402
+
+
+def legacy_categorical_qcut(series, q):
+    bin_freq = 1 / q
+    value_counts = series.value_counts(normalize=True).sort_index()
+    bins = {}
+
+    values_in_bin = []
+    cum_freq = 0
+
+    for i, (val, freq) in enumerate(value_counts.iteritems()):
+
+        values_in_bin.append(val)
+        cum_freq += freq
+
+        if cum_freq >= bin_freq or (i+1) == len(value_counts):
+            values_in_bin = sorted(values_in_bin)
+            interval = pd.Interval(left=values_in_bin[0], right=values_in_bin[-1], closed='both')
+            for v in values_in_bin:
+                bins[v] = interval
+                values_in_bin = []
+                cum_freq = 0
+
+    return series.apply(lambda x: bins.get(x))
+
+
+def legacy_discretize_series(series: pd.Series, n_mcv: int, n_bins: int) -> pd.Series:
+
+    s = series.copy()
+
+    if s.dtype == 'object':
+        s = s.str.rstrip()
+
+    value_counts = s.value_counts()
+    n_mcv = len(value_counts) if n_mcv == -1 else n_mcv
+    n_largest = value_counts.nlargest(n_mcv)
+    most_common_vals = set(n_largest.index)
+    most_common_mask = s.isin(most_common_vals)
+
+    n_least_common = s[~most_common_mask].nunique()
+    n_bins = min(n_least_common, n_bins)
+    if n_least_common > 0:
+        if not isinstance(s.iloc[0], numbers.Number):
+            s[~most_common_mask] = legacy_categorical_qcut(s[~most_common_mask], q=n_bins)
+        else:
+            s[~most_common_mask] = pd.qcut(s[~most_common_mask], q=n_bins, duplicates='drop')
+
+    s = s.where((pd.notnull(s)), None)
+
+    n_distinct = {}
+    for hist_bin in s[~most_common_mask].unique():
+        if hist_bin is not None:
+            n_distinct[str(hist_bin)] = len(set(
+                x
+                for x in series
+                if x and x in hist_bin and
+                x not in most_common_vals
+            ))
+
+    s = s.apply(tools.format_interval)
+
+    return s, n_distinct
+
+
+def make_series(n_rows: int, rng: np.random.RandomState) -> dict:
+    zipf = rng.zipf(1.5, n_rows) % 100000
+    words = np.array(['word{:05d}'.format(i) for i in range(5000)], dtype=object)
+    return {
+        'numeric': pd.Series(zipf.astype(float)),
+        'categorical': pd.Series(words[rng.zipf(1.3, n_rows) % len(words)])
+    }
+
+
+def main(n_rows: int):
+
+    rng = np.random.RandomState(42)
+
+    for name, series in make_series(n_rows, rng).items():
+
+        tic = time.time()
+        new, new_n_distinct = tools.discretize_series(series, n_mcv=30, n_bins=30)
+        new_duration = time.time() - tic
+
+        tic = time.time()
+        old, old_n_distinct = legacy_discretize_series(series, n_mcv=30, n_bins=30)
+        old_duration = time.time() - tic
+
+        print('{} ({} rows)'.format(name, n_rows))
+        print('\tlegacy: {:.3f}s'.format(old_duration))
+        print('\tvectorized: {:.3f}s'.format(new_duration))
+        print('\tspeed-up: {:.1f}x'.format(old_duration / new_duration))
+        print('\tsame bins: {}'.format((new == old).all()))
+        print('\tsame distinct counts: {}'.format(new_n_distinct == old_n_distinct))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
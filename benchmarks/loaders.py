@@ -0,0 +1,51 @@
+"""Compares the time it takes each loader to fetch the sample of every relation of a database.
+
+Usage:
+
+    python benchmarks/loaders.py URI [sampling_ratio]
+
+"""
+import os
+import sys
+import time
+
+import sqlalchemy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from phd import loaders  # noqa: E402
+from phd.sampling.estimator import SamplingEstimator  # noqa: E402
+
+
+def main(uri: str, sampling_ratio: float):
+
+    engine = sqlalchemy.create_engine(uri)
+
+    est = SamplingEstimator(sampling_ratio=sampling_ratio, min_rows=0, seed=42)
+    est.setup(engine)
+
+    conn = engine.connect()
+
+    for rel_name in sorted(est.rel_names, key=lambda rel_name: -est.rel_cards[rel_name]):
+
+        samples = {}
+        durations = {}
+        for loader in loaders.LOADERS:
+            est.loader = loader
+            tic = time.time()
+            samples[loader] = est.fetch_sample(conn, rel_name)
+            durations[loader] = time.time() - tic
+
+        print('{} ({} rows)'.format(rel_name, len(samples['sql'])))
+        for loader, duration in durations.items():
+            print('\t{}: {:.3f}s'.format(loader, duration))
+        print('\tspeed-up: {:.1f}x'.format(durations['sql'] / durations['copy']))
+        print('\tsame sample: {}'.format(
+            samples['sql'].fillna(-1).astype(str).equals(samples['copy'].fillna(-1).astype(str))
+        ))
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 1.0)
@@ -1,11 +1,17 @@
 import fileinput
 import ftplib
 import glob
+import json
 import os
 
 import click
 import sqlalchemy
 
+from phd import bench
+from phd import benchmark
+from phd import bulk
+from phd import instrument
+from phd import server
 from phd import tools
 
 
@@ -97,26 +103,125 @@ def loadtpcds(directory, uri):
     conn.commit()
 
 
+@cli.command()
+@click.argument('directory')
+@click.argument('uri', default=URI)
+@click.option('--jobs', default=4, help='Number of tables or chunks loaded at the same time.')
+@click.option('--chunk-size', default=256, help='Size in MB of the chunks the files are split into.')
+@click.option('--defer/--no-defer', default=True, help='Drop the indexes and constraints while loading.')
+@click.option('--analyze/--no-analyze', default=True, help='Run ANALYZE on each table once it is loaded.')
+def load(directory, uri, jobs, chunk_size, defer, analyze):
+    """Loads the .dat files generated by dsdgen into the tables of the same name.
+
+    The trailing delimiter of each line is stripped on the fly, hence the files
+    don't have to be cleaned with cleantpcds beforehand. If the load is
+    interrupted then running the same command again resumes it."""
+    bulk.load_directory(
+        uri=uri,
+        directory=directory,
+        n_jobs=jobs,
+        chunk_size=chunk_size << 20,
+        defer=defer,
+        analyze=analyze,
+        log=click.echo
+    )
+
+
 @cli.command()
 @click.argument('queries_dir')
 @click.argument('uri', default=URI)
-def run_queries(queries_dir, uri):
+@click.option('--output', default='results.csv', help='CSV or Parquet file the plans are written to.')
+@click.option('--concurrency', default=4, help='Number of queries that run at the same time.')
+@click.option('--repetitions', default=1, help='Number of recorded runs per query.')
+@click.option('--warmup', default=0, help='Number of unrecorded runs per query beforehand.')
+@click.option('--timeout', default=None, type=float, help='Seconds after which a query is cancelled.')
+@click.option('--resume', is_flag=True, help='Skip the runs that are already in the output file.')
+def run_queries(queries_dir, uri, output, concurrency, repetitions, warmup, timeout, resume):
+    """Runs each query of a directory with EXPLAIN ANALYZE and writes the
+    estimated and actual number of rows of every plan node to a file."""
+    benchmark.run_benchmark(
+        uri=uri,
+        queries_dir=queries_dir,
+        output=output,
+        concurrency=concurrency,
+        repetitions=repetitions,
+        warmup=warmup,
+        timeout=timeout,
+        resume=resume,
+        log=click.echo
+    )
+
+
+@cli.command(name='bench')
+@click.argument('workload')
+@click.argument('uri', default=URI)
+@click.option('--estimators', default='bn,sampling,textbook', help='Comma-separated estimators to compare.')
+@click.option('--sampling-ratio', default=0.01, help='Sampling ratio of every estimator.')
+@click.option('--seed', default=42, help='Random seed of every estimator.')
+@click.option('--adaptive', is_flag=True, help='Pick the sampling ratio of each relation from a pilot sample.')
+@click.option('--sample-budget', default=None, type=int, help='Total number of sampled rows in adaptive mode.')
+@click.option('--output', default='bench.json', help='JSON file the report is written to.')
+@click.option('--truth-cache', default='truths.json', help='JSON file the true cardinalities are cached in.')
+@click.option('--baseline', default=None, help='Report to compare with, regressions make the command fail.')
+@click.option('--tolerance', default=1.1, help='Factor by which a metric may exceed the baseline.')
+@click.option('--trace', default=None, help='Chrome trace file the instrumentation spans are written to.')
+def run_bench(workload, uri, estimators, sampling_ratio, seed, adaptive, sample_budget, output, truth_cache,
+              baseline, tolerance, trace):
+    """Compares the estimators on the sub-plans of a workload's queries, in
+    terms of q-error, estimation latency, build time and memory footprint. The
+    workload is a JSON file or a directory of SQL files."""
 
-    # Connect to the database
     engine = sqlalchemy.create_engine(uri)
 
-    # Load the JOB queries
-    queries = [
-        open(f).read()
-        for f in glob.glob('{}/*.sql'.format(queries_dir))
-        if f not in ('fkindexes.sql', 'schema.sql')
-    ]
-
-    # Run the queries one by one
-    for query in queries[:1]:
-        plan = tools.explain_query(query, engine)
-        print(query)
-        tools.print_json(plan)
+    with instrument.recording(instrument.Recorder() if trace else instrument.NullRecorder()) as recorder:
+        report = bench.run(
+            engine=engine,
+            workload=bench.load_workload(workload),
+            estimators={
+                name: bench.ESTIMATORS[name](
+                    sampling_ratio=sampling_ratio,
+                    seed=seed,
+                    adaptive=adaptive,
+                    sample_budget=sample_budget
+                )
+                for name in estimators.split(',')
+            },
+            truth_cache=truth_cache,
+            log=click.echo
+        )
+    if trace:
+        recorder.to_chrome_trace(trace)
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=4)
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = bench.find_regressions(report, json.load(f), tolerance)
+        if regressions:
+            raise click.ClickException('Regressions:\n' + '\n'.join(regressions))
+
+
+@cli.command()
+@click.argument('models', nargs=-1, required=True)
+@click.option('--host', default='127.0.0.1', help='Host to listen on.')
+@click.option('--port', default=8000, help='TCP port to listen on.')
+@click.option('--socket', 'unix_socket', default=None, help='Unix socket to listen on instead of a TCP port.')
+@click.option('--workers', default=4, help='Number of worker processes, 0 runs the estimations in the server process.')
+@click.option('--batch-window', default=0.002, help='Seconds during which requests are merged into a batch.')
+@click.option('--max-batch-size', default=1024, help='Number of queries which triggers a batch right away.')
+def serve(models, host, port, unix_socket, workers, batch_window, max_batch_size):
+    """Loads saved estimators and answers estimation requests over HTTP or
+    newline-delimited JSON. Each model is named after its directory."""
+
+    service = server.Server(
+        paths=models,
+        n_workers=workers,
+        batch_window=batch_window,
+        max_batch_size=max_batch_size
+    )
+    click.echo('Serving {} on {}'.format(', '.join(sorted(service.models)), unix_socket or '{}:{}'.format(host, port)))
+    service.serve_forever(host=host, port=port, unix_socket=unix_socket)
 
 
 @cli.command()
@@ -0,0 +1,127 @@
+"""Adaptive sampling budget.
+
+Rather than sampling every relation with the same ratio, each one is first sampled with a small
+pilot sample. The accuracy of the pilot is measured by bootstrapping the frequencies of the bins
+which the histograms and the CPDs are made of. The standard error of a frequency decreases with the
+square root of the sample size, down to 0 once the relation is read in full, hence the error of a
+larger sample can be extrapolated from the pilot's.
+
+The relations whose error exceeds the tolerance are then given the number of rows they need to
+reach it. If this doesn't fit the budget, which can be a number of rows or a number of seconds of
+sampling, then the largest error is minimized instead: the target error is raised until the samples
+fit. Small relations thus aren't oversampled whilst large ones get the rows they need.
+"""
+import numpy as np
+import pandas as pd
+
+from phd import tools
+
+
+# Bins of the attributes whose error is measured, for the estimators which don't discretize
+N_MCV = 30
+N_BINS = 30
+
+
+def bootstrap_error(codes: np.ndarray, n_codes: int, fpc: float, n_resamples: int,
+                    rng: np.random.RandomState) -> float:
+    """Returns the mean total variation distance between the bin frequencies of a sample and the
+    ones of its bootstrap resamples.
+
+    The bin counts of a bootstrap resample follow a multinomial distribution, hence they are drawn
+    directly rather than by resampling the rows.
+
+    Args:
+        codes (numpy.ndarray): the bin code of each sampled row.
+        n_codes (int): the number of bins.
+        fpc (float): the finite population correction of the variance, which is 1 minus the
+            fraction of the relation the sample is made of.
+        n_resamples (int): the number of bootstrap resamples.
+        rng (numpy.random.RandomState)
+    """
+
+    n = len(codes)
+    if not n:
+        return 0.
+
+    freqs = np.bincount(codes, minlength=n_codes) / n
+    resampled = rng.multinomial(n, freqs, size=n_resamples) / n
+    return float(np.abs(resampled - freqs).sum(axis=1).mean() / 2 * np.sqrt(fpc))
+
+
+def sample_error(rel: pd.DataFrame, atts: list, n_rows: float, n_mcv=N_MCV, n_bins=N_BINS,
+                 n_resamples=20, seed=None) -> float:
+    """Returns the largest bootstrap error amongst some attributes of a sample.
+
+    Args:
+        rel (pandas.DataFrame): the sampled rows.
+        atts (list of str): the attributes to measure, typically the ones which aren't IDs.
+        n_rows (float): the number of rows of the relation.
+    """
+
+    if not len(rel) or not atts:
+        return 0.
+
+    fpc = max(1 - len(rel) / n_rows, 0) if n_rows else 0
+    rng = np.random.RandomState(None if seed is None else seed % 2 ** 32)
+
+    errors = []
+    for att in atts:
+        codes, values, _, _ = tools.discretize(rel[att], n_mcv=n_mcv, n_bins=n_bins)
+        # Missing values have a bin of their own
+        codes[codes == -1] = len(values)
+        errors.append(bootstrap_error(codes, len(values) + 1, fpc, n_resamples, rng))
+
+    return max(errors)
+
+
+def required_rows(pilot_rows: int, error: float, n_rows: float, target: float) -> float:
+    """Returns the sample size at which the error of a pilot sample falls to a target.
+
+    The variance is assumed to be proportional to 1 / sample size - 1 / n_rows, as is the variance
+    of a frequency under simple random sampling without replacement.
+    """
+
+    if error <= target or pilot_rows >= n_rows:
+        return pilot_rows
+
+    scale = error ** 2 / (1 / pilot_rows - 1 / n_rows)
+    return max(pilot_rows, 1 / (target ** 2 / scale + 1 / n_rows))
+
+
+def allocate(pilots: dict, tolerance: float, costs: dict = None, budget: float = None) -> dict:
+    """Returns the number of rows to sample from each relation.
+
+    Args:
+        pilots (dict): the number of sampled rows, the error and the number of rows of the pilot
+            sample of each relation.
+        tolerance (float): the error under which a relation has converged.
+        costs (dict): the cost of a sampled row of each relation, 1 by default.
+        budget (float): the total cost of the samples, None means there is no limit. The pilot
+            samples are kept even if they exceed it.
+    """
+
+    costs = costs or {}
+
+    def plan(target: float) -> dict:
+        return {
+            rel_name: required_rows(pilot_rows, error, n_rows, target)
+            for rel_name, (pilot_rows, error, n_rows) in pilots.items()
+        }
+
+    def cost(rows: dict) -> float:
+        return sum(n * costs.get(rel_name, 1) for rel_name, n in rows.items())
+
+    rows = plan(tolerance)
+    if budget is None or cost(rows) <= budget:
+        return rows
+
+    # Bisect the target error, at the largest pilot error no relation is sampled further
+    low, high = tolerance, max(error for _, error, _ in pilots.values())
+    for _ in range(50):
+        middle = (low + high) / 2
+        if cost(plan(middle)) > budget:
+            low = middle
+        else:
+            high = middle
+
+    return plan(high)
@@ -0,0 +1,331 @@
+"""Compares the estimators on the cardinalities of the sub-plans of a workload.
+
+A workload is a JSON list of queries, each of which is a dict with a name, a join query and a
+filter query written in the estimators' syntax. Every connected subset of the relations of a query
+is a sub-plan which a query optimizer would have to estimate. The true cardinality of each
+sub-plan is obtained with a COUNT(*) query and cached on disk, hence it is only computed once.
+"""
+import json
+import os
+import time
+
+import numpy as np
+import sqlalchemy
+
+from phd import expression
+from phd import sql
+from phd import tools
+from phd.bn.estimator import BayesianNetworkEstimator
+from phd.sampling.estimator import SamplingEstimator
+from phd.textbook.estimator import TextbookEstimator
+
+
+ESTIMATORS = {
+    'bn': BayesianNetworkEstimator,
+    'sampling': SamplingEstimator,
+    'textbook': TextbookEstimator
+}
+PERCENTILES = (50, 90, 95, 99)
+
+
+def load_workload(path: str) -> list:
+    """Loads the queries of a workload.
+
+    The path is either a JSON file or a directory of SQL files, each of which holds a query named
+    after the file. A query of a JSON file may also be given as SQL under the "sql" key. A SQL
+    query which can't be parsed gets the reason under the "error" key rather than failing the
+    whole workload.
+    """
+
+    if os.path.isdir(path):
+        queries = []
+        for file_name in sorted(os.listdir(path)):
+            if file_name.endswith('.sql'):
+                with open(os.path.join(path, file_name)) as f:
+                    queries.append({'name': file_name[:-len('.sql')], 'sql': f.read()})
+    else:
+        with open(path) as f:
+            queries = json.load(f)
+
+    for query in queries:
+        if 'sql' in query:
+            try:
+                parsed = sql.parse(query['sql'])
+            except ValueError as e:
+                query['error'] = str(e)
+                continue
+            query['join_query'] = parsed.join_query
+            query['filter_query'] = parsed.filter_query
+            # The relations of a query where one appears more than once are referred to by alias
+            if isinstance(parsed.relation_names, dict):
+                query['aliases'] = parsed.relation_names
+
+    return queries
+
+
+def split_query(query: str) -> list:
+    """Returns the predicates of a join query, or the members of the top-level conjunction of a
+    filter query."""
+    return [expression.to_string(member) for member in expression.conjuncts(expression.parse(query))]
+
+
+def relation_name(part: str) -> str:
+    """Returns the relation a member of a filter query is about."""
+    return expression.predicates(expression.parse(part))[0].att.split('.')[0]
+
+
+def connected_subsets(nodes: list, edges: list) -> list:
+    """Returns every connected subset of the nodes of a graph, smallest first."""
+
+    neighbours = {node: set() for node in nodes}
+    for a, b in edges:
+        neighbours[a].add(b)
+        neighbours[b].add(a)
+
+    subsets = set(frozenset([node]) for node in nodes)
+    frontier = subsets
+    while frontier:
+        frontier = set(
+            subset | {neighbour}
+            for subset in frontier
+            for node in subset
+            for neighbour in neighbours[node] - subset
+        ) - subsets
+        subsets |= frontier
+
+    return sorted(subsets, key=lambda subset: (len(subset), sorted(subset)))
+
+
+def enumerate_subplans(query: dict) -> list:
+    """Returns the join and filter queries of each sub-plan of a query.
+
+    If the query has aliases, then the relation names of each sub-plan are a dict of its aliases
+    to their relation names, see phd.sql.
+    """
+
+    joins = split_query(query.get('join_query', ''))
+    filters = split_query(query.get('filter_query', ''))
+
+    edges = [tuple(side.split('.')[0] for side in join.split(' == ')) for join in joins]
+    rel_names = sorted(set(
+        [rel_name for edge in edges for rel_name in edge] +
+        [relation_name(part) for part in filters]
+    ))
+
+    aliases = query.get('aliases')
+
+    return [
+        {
+            'query': query['name'],
+            'relation_names': (
+                {alias: aliases[alias] for alias in sorted(subset)} if aliases else sorted(subset)
+            ),
+            'join_query': ' and '.join(
+                join for join, (left, right) in zip(joins, edges)
+                if left in subset and right in subset
+            ),
+            'filter_query': ' and '.join(part for part in filters if relation_name(part) in subset)
+        }
+        for subset in connected_subsets(rel_names, edges)
+    ]
+
+
+def to_sql_literal(value) -> str:
+    if isinstance(value, str):
+        return "'{}'".format(value.replace("'", "''"))
+    return repr(value)
+
+
+def to_sql_predicate(part: str) -> str:
+    """Translates a predicate written in the estimators' syntax to SQL."""
+    att, op, operand = tools.split_predicate(part)
+    if op == '==':
+        return '{} = {}'.format(att, to_sql_literal(operand))
+    if op == 'in':
+        return '{} IN ({})'.format(att, ', '.join(to_sql_literal(value) for value in operand))
+    if op == 'between':
+        return '{} BETWEEN {} AND {}'.format(att, *(to_sql_literal(value) for value in operand))
+    if op in ('is null', 'is not null'):
+        return '{} {}'.format(att, op.upper())
+    return '{} {} {}'.format(att, op.upper(), to_sql_literal(operand))
+
+
+def to_sql_condition(part: str) -> str:
+    """Translates a member of a filter query, which may combine predicates, to SQL."""
+
+    def translate(node) -> str:
+        if isinstance(node, expression.Predicate):
+            return to_sql_predicate(expression.to_string(node))
+        if isinstance(node, expression.Not):
+            return 'NOT ({})'.format(translate(node.child))
+        connective = ' AND ' if isinstance(node, expression.And) else ' OR '
+        return '({})'.format(connective.join(translate(child) for child in node.children))
+
+    return translate(expression.parse(part))
+
+
+def to_count_query(subplan: dict) -> str:
+    predicates = (
+        [join.replace(' == ', ' = ') for join in split_query(subplan['join_query'])] +
+        [to_sql_condition(part) for part in split_query(subplan['filter_query'])]
+    )
+    relation_names = subplan['relation_names']
+    if isinstance(relation_names, dict):
+        relation_names = ['{} AS {}'.format(rel_name, alias) for alias, rel_name in relation_names.items()]
+    return 'SELECT COUNT(*) FROM {}{}'.format(
+        ', '.join(relation_names),
+        ' WHERE ' + ' AND '.join(predicates) if predicates else ''
+    )
+
+
+def fetch_truths(engine: sqlalchemy.engine.base.Engine, subplans: list, cache_path: str) -> list:
+    """Returns the true cardinality of each sub-plan, the ones which are missing from the cache
+    file being counted and added to it."""
+
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+
+    conn = engine.connect()
+    for subplan in subplans:
+        query = to_count_query(subplan)
+        if query not in cache:
+            cache[query] = conn.execute(query).scalar()
+            # Save as we go so that an interruption doesn't lose the counts
+            with open(cache_path, 'w') as f:
+                json.dump(cache, f)
+    conn.close()
+
+    return [cache[to_count_query(subplan)] for subplan in subplans]
+
+
+def calc_q_error(estimate: float, truth: float) -> float:
+    """Returns the factor by which an estimate is off, both numbers being clipped to 1."""
+    estimate, truth = max(estimate, 1), max(truth, 1)
+    return max(estimate / truth, truth / estimate)
+
+
+def summarize(values) -> dict:
+    values = np.asarray(values, dtype=float)
+    summary = {'p{}'.format(p): float(np.percentile(values, p)) for p in PERCENTILES}
+    summary['mean'] = float(values.mean())
+    summary['max'] = float(values.max())
+    return summary
+
+
+def evaluate(est, subplans: list, truths: list) -> tuple:
+    """Estimates each sub-plan with a fitted estimator.
+
+    Returns:
+        tuple: the estimate, the q-error and the latency in seconds of each sub-plan.
+    """
+
+    estimates = []
+    latencies = []
+
+    for subplan in subplans:
+        tic = time.perf_counter()
+        estimate = est.estimate_selectivity(
+            subplan['join_query'],
+            subplan['filter_query'],
+            subplan['relation_names']
+        )
+        latencies.append(time.perf_counter() - tic)
+        estimates.append(float(estimate))
+
+    q_errors = [calc_q_error(estimate, truth) for estimate, truth in zip(estimates, truths)]
+
+    return estimates, q_errors, latencies
+
+
+def run(engine: sqlalchemy.engine.base.Engine, workload: list, estimators: dict,
+        truth_cache='truths.json', log=print) -> dict:
+    """Builds each estimator and evaluates it on every sub-plan of a workload.
+
+    Args:
+        engine (sqlalchemy.engine.base.Engine)
+        workload (list of dicts): the queries, see load_workload.
+        estimators (dict): unfitted estimators keyed by name.
+        truth_cache (str): the JSON file where the true cardinalities are cached.
+        log (callable): called with a progress message after each step.
+
+    Returns:
+        dict: the report, which contains a summary per estimator along with the sub-plans.
+    """
+
+    # The queries which couldn't be parsed are reported and left out
+    errors = {query['name']: query['error'] for query in workload if 'error' in query}
+    for name, error in errors.items():
+        log('Skipping {}: {}'.format(name, error))
+    workload = [query for query in workload if 'error' not in query]
+
+    subplans = [subplan for query in workload for subplan in enumerate_subplans(query)]
+    log('{} sub-plans in {} queries'.format(len(subplans), len(workload)))
+
+    truths = fetch_truths(engine, subplans, truth_cache)
+
+    report = {
+        'estimators': {},
+        'subplans': [dict(s, truth=t) for s, t in zip(subplans, truths)],
+        'errors': errors
+    }
+
+    for name, est in estimators.items():
+
+        tic = time.time()
+        est.build_from_engine(engine)
+        build_time = time.time() - tic
+
+        estimates, q_errors, latencies = evaluate(est, subplans, truths)
+        for subplan, estimate, q_error in zip(report['subplans'], estimates, q_errors):
+            subplan[name] = estimate
+            subplan['{}_q_error'.format(name)] = q_error
+
+        report['estimators'][name] = {
+            'params': est.get_params(),
+            'build_time': build_time,
+            'memory_bytes': est.calc_memory_bytes(),
+            'memory': est.memory_report(),
+            'q_error': summarize(q_errors),
+            'latency': summarize(latencies)
+        }
+        log('{}: median q-error {:.2f}, median latency {:.3f}ms'.format(
+            name,
+            report['estimators'][name]['q_error']['p50'],
+            report['estimators'][name]['latency']['p50'] * 1000
+        ))
+
+    return report
+
+
+def find_regressions(report: dict, baseline: dict, tolerance=1.1) -> list:
+    """Compares the summary of each estimator with a baseline report.
+
+    Returns:
+        list of str: the metrics which are worse than in the baseline by more than the tolerance
+            factor.
+    """
+
+    regressions = []
+
+    for name, summary in report['estimators'].items():
+        if name not in baseline['estimators']:
+            continue
+        reference = baseline['estimators'][name]
+        metrics = [('build_time', ), ('memory_bytes', )] + [
+            (metric, stat)
+            for metric in ('q_error', 'latency')
+            for stat in summary[metric]
+        ]
+        for keys in metrics:
+            value, expected = summary, reference
+            for key in keys:
+                value, expected = value[key], (expected or {}).get(key)
+            # Metrics which the baseline predates are skipped
+            if expected is None:
+                continue
+            if value > expected * tolerance:
+                regressions.append('{} {}: {:.4g} > {:.4g}'.format(name, '.'.join(keys), value, expected))
+
+    return regressions
@@ -0,0 +1,233 @@
+"""Runs a directory of queries against PostgreSQL and records their plans and timings.
+
+Each query is run with EXPLAIN (ANALYZE, FORMAT JSON), and every node of the resulting plan is
+flattened into a row which contains PostgreSQL's estimated number of rows along with the actual
+number of rows. The rows are written to a CSV or a Parquet file as the runs complete. A run which
+fails is recorded as a single row with an error status and message, hence one bad query doesn't
+abort the benchmark.
+"""
+from concurrent import futures
+import glob
+import os
+import time
+
+import pandas as pd
+import sqlalchemy
+
+
+EXCLUDED_FILES = ('fkindexes.sql', 'schema.sql')
+EXPLAIN_PREFIX = 'EXPLAIN (ANALYZE true, FORMAT JSON, VERBOSE true)'
+COLUMNS = [
+    'query', 'repetition', 'status', 'error', 'latency', 'planning_time', 'execution_time',
+    'node_id', 'parent_id', 'depth', 'node_type', 'relation_name', 'estimated_rows', 'actual_rows',
+    'loops', 'q_error', 'startup_time', 'total_time'
+]
+
+
+def list_queries(queries_dir: str) -> dict:
+    """Returns the text of each query of a directory, keyed by file name without extension."""
+    return {
+        os.path.splitext(os.path.basename(path))[0]: open(path).read()
+        for path in sorted(glob.glob(os.path.join(queries_dir, '*.sql')))
+        if os.path.basename(path) not in EXCLUDED_FILES
+    }
+
+
+def calc_q_error(estimated: float, actual: float) -> float:
+    """Returns the factor by which an estimate is off, both numbers being clipped to 1."""
+    estimated, actual = max(estimated, 1), max(actual, 1)
+    return max(estimated / actual, actual / estimated)
+
+
+def flatten_plan(plan: dict) -> list:
+    """Returns one dict per node of an EXPLAIN ANALYZE plan, in depth-first order.
+
+    The actual number of rows of a node is the average per loop times the number of loops, which
+    is what the estimated number of rows is comparable to.
+    """
+
+    nodes = []
+
+    def walk(node, parent_id, depth):
+        node_id = len(nodes)
+        loops = node.get('Actual Loops', 1)
+        estimated = node['Plan Rows']
+        actual = node.get('Actual Rows', 0) * loops
+        nodes.append({
+            'node_id': node_id,
+            'parent_id': parent_id,
+            'depth': depth,
+            'node_type': node['Node Type'],
+            'relation_name': node.get('Relation Name'),
+            'estimated_rows': estimated,
+            'actual_rows': actual,
+            'loops': loops,
+            'q_error': calc_q_error(estimated * loops, actual),
+            'startup_time': node.get('Actual Startup Time'),
+            'total_time': node.get('Actual Total Time')
+        })
+        for child in node.get('Plans', []):
+            walk(child, node_id, depth + 1)
+
+    walk(plan['Plan'], None, 0)
+
+    return nodes
+
+
+def run_query(engine: sqlalchemy.engine.base.Engine, query: str, timeout=None) -> tuple:
+    """Runs EXPLAIN ANALYZE on a query with a connection of an engine's pool.
+
+    Returns:
+        tuple: the status of the run, which is ok, timeout or error, the wall-clock latency in
+            seconds, the plan and the error message.
+    """
+
+    tic = time.time()
+    conn = None
+
+    try:
+        conn = engine.connect()
+        # The timeout only lasts for the transaction
+        with conn.begin():
+            if timeout:
+                conn.execute('SET LOCAL statement_timeout = {}'.format(int(timeout * 1000)))
+            result = conn.execute(sqlalchemy.text('{} {}'.format(EXPLAIN_PREFIX, query)))
+            plan = result.first()[0][0]
+            result.close()
+        return 'ok', time.time() - tic, plan, None
+    except Exception as e:
+        if isinstance(e, sqlalchemy.exc.OperationalError) and 'statement timeout' in str(e):
+            return 'timeout', time.time() - tic, None, None
+        return 'error', time.time() - tic, None, '{}: {}'.format(type(e).__name__, e)
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def to_rows(name: str, repetition: int, status: str, latency: float, plan: dict,
+            error: str = None) -> list:
+    """Returns the rows which describe a run of a query, one per plan node."""
+
+    run = {
+        'query': name,
+        'repetition': repetition,
+        'status': status,
+        'error': error,
+        'latency': latency,
+        'planning_time': plan.get('Planning Time') if plan else None,
+        'execution_time': plan.get('Execution Time') if plan else None
+    }
+
+    if not plan:
+        return [run]
+    return [dict(run, **node) for node in flatten_plan(plan)]
+
+
+def checkpoint_path(output: str) -> str:
+    """Returns the CSV file the runs are appended to as they complete.
+
+    A CSV output is its own checkpoint. A Parquet file can't be appended to, hence the runs go to
+    a CSV file next to it, which is merged into the Parquet file once the benchmark is over.
+    """
+    if output.endswith('.parquet'):
+        return output + '.partial.csv'
+    return output
+
+
+def read_results(output: str) -> pd.DataFrame:
+    """Returns the runs recorded in an output file and in its checkpoint."""
+
+    results = []
+    if output.endswith('.parquet') and os.path.exists(output):
+        results.append(pd.read_parquet(output))
+    if os.path.exists(checkpoint_path(output)):
+        results.append(pd.read_csv(checkpoint_path(output)))
+
+    if not results:
+        return pd.DataFrame(columns=COLUMNS)
+    return pd.concat(results, ignore_index=True).reindex(columns=COLUMNS)
+
+
+def write_checkpoint(output: str, results: pd.DataFrame, append: bool):
+    checkpoint = checkpoint_path(output)
+    results.to_csv(checkpoint, mode='a' if append else 'w', header=not append, index=False)
+
+
+def write_results(output: str, results: pd.DataFrame):
+    """Writes the results to a Parquet file if the output ends with .parquet, and removes the
+    checkpoint; CSV outputs are already complete."""
+    if output.endswith('.parquet'):
+        results.to_parquet(output, index=False)
+        if os.path.exists(checkpoint_path(output)):
+            os.remove(checkpoint_path(output))
+
+
+def run_benchmark(uri: str, queries_dir: str, output: str, concurrency=4, repetitions=1, warmup=0,
+                  timeout=None, resume=False, log=print) -> pd.DataFrame:
+    """Runs every query of a directory and records the plan of each run.
+
+    Args:
+        uri (str): the database URI.
+        queries_dir (str): the directory which contains one .sql file per query.
+        output (str): the CSV or Parquet file the results are written to.
+        concurrency (int): the number of queries which run at the same time, each with its own
+            connection.
+        repetitions (int): the number of recorded runs per query.
+        warmup (int): the number of runs per query which happen before the recorded ones, so that
+            the caches are warm.
+        timeout (float): the number of seconds after which a query is cancelled.
+        resume (bool): whether to keep the results that are already in the output file, or in
+            its checkpoint, and to skip the runs they contain.
+        log (callable): called with a progress message after each run.
+    """
+
+    queries = list_queries(queries_dir)
+
+    # Skip the runs that have already been recorded
+    previous = read_results(output) if resume else pd.DataFrame(columns=COLUMNS)
+    recorded = set(zip(previous['query'], previous['repetition']))
+    runs = [
+        (name, repetition)
+        for repetition in range(-warmup, repetitions)
+        for name in queries
+        if (name, repetition) not in recorded
+    ]
+
+    engine = sqlalchemy.create_engine(uri, pool_size=concurrency, max_overflow=0)
+
+    # Start the checkpoint over with the current columns, the previous runs of a Parquet output
+    # are merged into it beforehand
+    results = [previous] if len(previous) else []
+    if output.endswith('.parquet'):
+        write_results(output, previous)
+        write_checkpoint(output, previous.iloc[:0], append=False)
+    else:
+        write_checkpoint(output, previous, append=False)
+
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        # The warmup runs are given negative repetition numbers and are not recorded
+        for repetition in sorted(set(repetition for _, repetition in runs)):
+            pending = {
+                executor.submit(run_query, engine, queries[name], timeout): name
+                for name, rep in runs
+                if rep == repetition
+            }
+            for future in futures.as_completed(pending):
+                name = pending[future]
+                status, latency, plan, error = future.result()
+                log('{} #{}: {} in {:.3f}s{}'.format(
+                    name, repetition, status, latency, ': {}'.format(error) if error else ''
+                ))
+                if repetition < 0:
+                    continue
+                rows = pd.DataFrame(to_rows(name, repetition, status, latency, plan, error), columns=COLUMNS)
+                results.append(rows)
+                write_checkpoint(output, rows, append=True)
+
+    engine.dispose()
+
+    results = pd.concat(results, ignore_index=True) if results else pd.DataFrame(columns=COLUMNS)
+    write_results(output, results)
+
+    return results
@@ -1,9 +1,14 @@
+import os
+
 import networkx as nx
+import numpy as np
 import pandas as pd
 
 from phd import distribution
-from phd import operator as op
-from phd import tools
+from phd import instrument
+from phd import store
+
+from . import compiled
 
 
 class BayesNet(nx.DiGraph):
@@ -85,19 +90,15 @@ class BayesNet(nx.DiGraph):
 
         return sub_tree
 
-    def update_distributions(self, df: pd.DataFrame, n_mcv: int, n_bins: int, types: dict):
+    def update_distributions(self, df: pd.DataFrame, n_mcv: int, n_bins: int):
         """Updates each node's CDP given the data in a pandas.DataFrame."""
 
-        # Copy the DataFrame before applying discretization; this wastes RAM
-        df = df[list(self.nodes)].copy()
-
-        # Record the number of distinct values per histogram
-        self.n_in_bin = {}
-
-        # Dicretization
-        for col in df.columns:
-            df[col], self.n_in_bin[col] = tools.discretize_series(
-                df[col],
+        # Discretize each attribute and record its bin dictionary
+        self.bins = {}
+        codes = {}
+        for node in self.nodes:
+            self.bins[node], codes[node] = distribution.Bins.from_series(
+                df[node],
                 n_mcv=n_mcv,
                 n_bins=n_bins
             )
@@ -106,82 +107,130 @@ class BayesNet(nx.DiGraph):
         for node in self.nodes:
             predecessor = next(self.predecessors(node), None)
             self.node[node]['dist'] = distribution.Distribution(on=node, by=predecessor)
-            self.node[node]['dist'].build_from_df(df, types=types)
+            self.node[node]['dist'].build_from_codes(codes, bins=self.bins)
 
     def infer(self, conditions) -> float:
 
-        sub_tree = self.steiner_tree(conditions.keys())
+        with instrument.span('steiner_tree', n=1):
+            sub_tree = self.steiner_tree(conditions.keys())
 
         root = sub_tree.root()
 
         def subset_dist(on):
 
-            by = sub_tree.node[on]['dist'].by
+            dist = sub_tree.node[on]['dist']
 
-            child_conditions = [subset_dist(child) for child in sub_tree.successors(on)]
-            for condition in child_conditions:
-                sub_tree.node[on]['dist'] = sub_tree.node[on]['dist'].subset(on, condition)
+            for child in sub_tree.successors(on):
+                dist = dist.restrict(on, subset_dist(child))
 
-            sub_tree.node[on]['dist'] = sub_tree.node[on]['dist'].subset(on, conditions.get(on))
-            if by:
-                sub_tree.node[on]['dist'] = sub_tree.node[on]['dist'].subset(by, conditions.get(by))
+            dist = dist.subset(on, conditions.get(on))
+            if dist.by:
+                dist = dist.subset(dist.by, conditions.get(dist.by))
 
-            if by:
-                return op.In(set(sub_tree.node[on]['dist'].keys()))
+            sub_tree.node[on]['dist'] = dist
+
+            if dist.by:
+                return dist.present(dist.by)
 
         def propagate(node):
 
             # Get the node's CPD
             dist = sub_tree.node[node]['dist']
 
-            # We're at a leaf of the tree
-            if sub_tree.out_degree(node) == 0:
+            child_dists = [propagate(child) for child in sub_tree.successors(node)]
 
-                if not dist.by:
-                    return sum(dist.values())
+            # The coverage of the node's condition is applied to the intervals
+            weights = self.bins[node].evidence(conditions.get(node))[2]
+            # The subtrees of the children are independent given the node, hence their messages
+            # are multiplied
+            if child_dists:
+                weights = weights * np.prod(child_dists, axis=0)
 
-                return {
-                    by_val: sum(
-                        (p * conditions[node].calc_coverage(on_val, self.n_in_bin[node][str(on_val)]))
-                        if isinstance(on_val, pd.Interval) and node in conditions
-                        else p
-                        for on_val, p in d.items()
-                    )
-                    for by_val, d in dist.items()
-                }
+            # We're at the root of the tree
+            if not dist.by:
+                return dist.probs.dot(weights)
 
-            child_dists = [propagate(child) for child in sub_tree.successors(node)]
+            return dist.probs.dot(np.where(dist.present(node), weights, 0))
 
-            # We're at an internal node
-            if dist.by:
-                return {
-                    by_val: sum(
-                        sum(
-                            child_dist[on_val] *
-                            (
-                                (p * conditions[node].calc_coverage(on_val, self.n_in_bin[node][str(on_val)]))
-                                if isinstance(on_val, pd.Interval) and node in conditions
-                                else p
-                            )
-                            for on_val, p in d.items()
-                        )
-                        for child_dist in child_dists
-                    )
-                    for by_val, d in dist.items()
-                }
+        with instrument.span('subset', n=1, n_nodes=len(sub_tree)):
+            subset_dist(root)
+        with instrument.span('propagate', n=1, n_nodes=len(sub_tree)):
+            sel = propagate(root)
+        return sel
 
-            # We're at the root of the tree
-            return sum(
-                sum(
-                    p * child_dist[on_val]
-                    for child_dist in child_dists
-                )
-                for on_val, p in dist.items()
+    def update_counts(self, inserted: pd.DataFrame, deleted: pd.DataFrame, weight: float):
+        """Updates each node's CPD after rows were inserted and deleted.
+
+        Args:
+            inserted (pandas.DataFrame)
+            deleted (pandas.DataFrame)
+            weight (float): the weight of each row, which is lower than 1 if the distributions were
+                built on a sample.
+        """
+        for rows, sign in ((inserted, 1), (deleted, -1)):
+            if len(rows) == 0:
+                continue
+            codes = {node: self.bins[node].encode(rows[node]) for node in self.nodes}
+            for node in self.nodes:
+                self.node[node]['dist'].update_counts(codes, sign * weight)
+
+    def compress(self, min_mass=0.):
+        """Compresses the distribution of each node, see distribution.Distribution.compress."""
+        for node in self.nodes:
+            self.node[node]['dist'].compress(min_mass)
+
+    def memory_usage(self) -> dict:
+        """Returns the number of bytes taken up by the distribution and the bins of each node."""
+        return {
+            node: self.node[node]['dist'].nbytes() + self.bins[node].nbytes()
+            for node in self.nodes
+        }
+
+    def n_rows(self) -> float:
+        """Returns the number of rows the distributions were built on."""
+        if len(self) == 0:
+            return 0
+        return self.node[self.root()]['dist'].counts.sum()
+
+    def save(self, path: str) -> dict:
+        """Saves the arrays to a directory and returns the rest of the network as a dict."""
+        os.makedirs(path, exist_ok=True)
+        return {
+            'nodes': list(self.nodes),
+            'edges': list(self.edges),
+            'bins': {node: bins.to_dict() for node, bins in self.bins.items()},
+            'probs': {
+                node: store.save_array(path, 'probs-{}'.format(node), self.node[node]['dist'].probs)
+                for node in self.nodes
+            },
+            'counts': {
+                node: store.save_array(path, 'counts-{}'.format(node), self.node[node]['dist'].counts)
+                for node in self.nodes
+            }
+        }
+
+    @classmethod
+    def load(cls, path: str, meta: dict, mmap_mode=None):
+        """Inverse of save."""
+
+        bn = cls(nodes=meta['nodes'], edges=[tuple(edge) for edge in meta['edges']])
+        bn.bins = {node: distribution.Bins.from_dict(bins) for node, bins in meta['bins'].items()}
+
+        for node in bn.nodes:
+            predecessor = next(bn.predecessors(node), None)
+            bn.node[node]['dist'] = distribution.Distribution(
+                on=node,
+                by=predecessor,
+                bins={att: bn.bins[att] for att in (node, predecessor) if att},
+                probs=store.load_array(path, meta['probs'][node], mmap_mode),
+                counts=store.load_array(path, meta['counts'][node], mmap_mode)
             )
 
-        subset_dist(root)
-        sel = propagate(root)
-        return sel
+        return bn
+
+    def compile(self) -> compiled.CompiledBayesNet:
+        """Returns an array-backed version of the network which is faster to query."""
+        return compiled.CompiledBayesNet(self)
 
     def plot(self, ax):
         """Draws the DAG on a matplotlib.axis."""
@@ -1,25 +1,41 @@
-import itertools
 from typing import List
 
 import networkx as nx
 import pandas as pd
 
+from phd import instrument
+
 from . import bayes_net
 from . import dependence
 
 
-def chow_liu_tree_from_df(df: pd.DataFrame, blacklist: List[str]) -> bayes_net.BayesNet:
+def chow_liu_tree_from_df(df: pd.DataFrame, blacklist: List[str], max_rows=None,
+                          seed=None, leaves: List[str] = ()) -> bayes_net.BayesNet:
+    """Learns a tree-shaped Bayesian network from a DataFrame.
+
+    Args:
+        df (pandas.DataFrame)
+        blacklist (list of str): the columns to ignore.
+        max_rows (int): if specified, the mutual informations are approximated on a random
+            subsample of at most max_rows rows.
+        seed (int): the random state used for subsampling.
+        leaves (list of str): blacklisted columns, such as join keys, which are nonetheless
+            added to the tree as leaves. Each one is the child of the attribute it shares the
+            most information with, hence the rest of the tree is the same as without them.
+    """
 
-    # Ignore columns that are part of the blacklist
-    attributes = set(df.columns) - set(blacklist)
-    if len(attributes) <= 1:
-        return bayes_net.BayesNet(nodes=attributes), {}
+    # Ignore columns that are part of the blacklist; the attributes are sorted so that the
+    # resulting tree doesn't depend on the hash seed of the process it was built in
+    attributes = sorted(set(df.columns) - set(blacklist))
+    leaves = sorted(set(leaves) & set(df.columns) - set(attributes))
+    if len(attributes) == 0:
+        return bayes_net.BayesNet(), []
+    if len(attributes) == 1:
+        return attach_leaves(bayes_net.BayesNet(nodes=attributes), df, leaves, max_rows, seed), []
 
     # Calculate the pairwise mutual informations scores
-    mut_infos = [
-        (a, b, dependence.mutual_info(df[a], df[b]))
-        for (a, b) in itertools.combinations(attributes, 2)
-    ]
+    with instrument.span('mutual_info', n_attributes=len(attributes)):
+        mut_infos = dependence.pairwise_mutual_info(df, attributes, max_rows=max_rows, seed=seed)
 
     # Create a graph that contains all the mutual informations
     mut_info_graph = nx.Graph()
@@ -34,4 +50,54 @@ def chow_liu_tree_from_df(df: pd.DataFrame, blacklist: List[str]) -> bayes_net.B
     # Initialise the Bayesian network
     bn = bayes_net.BayesNet(edges=list(tree.edges))
 
-    return bn, mut_infos
+    return attach_leaves(bn, df, leaves, max_rows, seed), mut_infos
+
+
+def attach_leaves(bn: bayes_net.BayesNet, df: pd.DataFrame, leaves: List[str], max_rows=None,
+                  seed=None) -> bayes_net.BayesNet:
+    """Adds each leaf to a network as the child of the node it shares the most information with."""
+
+    if not leaves:
+        return bn
+
+    if max_rows is not None and len(df) > max_rows:
+        df = df.sample(n=max_rows, random_state=None if seed is None else seed % 2 ** 32)
+
+    attributes = sorted(bn.nodes)
+    codes = {att: dependence.to_numeric(df[att]) for att in attributes + leaves}
+
+    for leaf in leaves:
+        x, x_card = codes[leaf]
+        with instrument.span('mutual_info', leaf=leaf):
+            parent = max(
+                attributes,
+                key=lambda att: dependence.mutual_info_from_codes(x, codes[att][0], x_card, codes[att][1])
+            )
+        bn.add_edge(parent, leaf)
+
+    return bn
+
+
+def calc_drift(bn: bayes_net.BayesNet, mutual_infos: list) -> float:
+    """Measures how far the tree of a network is from the Chow-Liu tree of some mutual informations.
+
+    The drift is 1 minus the ratio between the weight of the tree and the weight of the maximum
+    spanning tree. It is 0 if the tree is still optimal and tends to 1 as it gets worse.
+    """
+
+    if len(bn.edges) == 0:
+        return 0
+
+    mut_info_graph = nx.Graph()
+    mut_info_graph.add_weighted_edges_from(mutual_infos)
+
+    best = sum(
+        data['weight']
+        for _, _, data in nx.algorithms.tree.mst.maximum_spanning_edges(mut_info_graph, data=True)
+    )
+    if best <= 0:
+        return 0
+
+    # The leaves that were attached afterwards aren't part of the spanning tree
+    current = sum(mut_info_graph[a][b]['weight'] for a, b in bn.edges if mut_info_graph.has_edge(a, b))
+    return 1 - current / best
@@ -0,0 +1,150 @@
+from collections import defaultdict
+
+import networkx as nx
+import numpy as np
+
+from phd import distribution
+from phd import instrument
+from phd import operator as op
+
+
+class CompiledBayesNet():
+    """Flat representation of a fitted BayesNet which can answer many queries at once.
+
+    The tree is stored as parent and children lookups in topological order, and each CPD as the
+    array of its distribution, indexed by the codes of the nodes' bin dictionaries. Evidence is
+    applied through boolean masks and coverage vectors, which turns message passing into a chain
+    of matrix-vector products. The CPDs of a compressed network stay compressed until a query
+    involves them; each one is then decompressed once into a float32 array, which holds the float16
+    probabilities exactly, and kept for the following queries.
+    """
+
+    def __init__(self, bn):
+        """
+
+        Args:
+            bn (BayesNet): a Bayesian network whose distributions have been updated.
+        """
+
+        self.root = bn.root() if len(bn) else None
+        self.order = list(nx.topological_sort(bn))
+        self.parent = {node: next(bn.predecessors(node), None) for node in self.order}
+        self.children = {node: list(bn.successors(node)) for node in self.order}
+        self.bins = {node: bn.bins[node] for node in self.order}
+        self.cpds = {}
+        for node in self.order:
+            dist = bn.node[node]['dist']
+            self.cpds[node] = dist.sparse if dist.is_compressed else dist.probs
+
+    def cpd(self, node) -> np.ndarray:
+        """Returns the dense CPD of a node, which is decompressed the first time only."""
+        cpd = self.cpds[node]
+        if isinstance(cpd, distribution.SparseArray):
+            cpd = self.cpds[node] = cpd.toarray().astype(np.float32)
+        return cpd
+
+    def steiner_tree(self, nodes):
+        """Returns the nodes on the paths from the root to a set of nodes, children first."""
+        sub_nodes = set()
+        for node in nodes:
+            while node is not None and node not in sub_nodes:
+                sub_nodes.add(node)
+                node = self.parent[node]
+        return [node for node in reversed(self.order) if node in sub_nodes]
+
+    def infer(self, conditions) -> float:
+        return self.infer_many([conditions])[0]
+
+    def infer_many(self, conditions_list) -> list:
+        """Returns the selectivity of each set of conditions.
+
+        Conditions that involve the same nodes are stacked along a leading batch axis and go
+        through a single pass.
+        """
+
+        conditions_list = list(conditions_list)
+        selectivities = [1.] * len(conditions_list)
+
+        # Group the conditions that share the same Steiner tree and the same evidence nodes
+        groups = defaultdict(list)
+        with instrument.span('steiner_tree', n=len(conditions_list)):
+            for i, conditions in enumerate(conditions_list):
+                nodes = tuple(self.steiner_tree(node for node in conditions if node in self.bins))
+                if not nodes:
+                    continue
+                evidence_nodes = tuple(
+                    node for node in nodes
+                    if conditions.get(node) is not None and not isinstance(conditions[node], op.Identity)
+                )
+                groups[nodes, evidence_nodes].append(i)
+
+        # The evidence is memoized because the same predicates tend to occur many times
+        evidence_cache = {}
+
+        def get_evidence(node, operator):
+            key = (node, operator.key())
+            if key not in evidence_cache:
+                evidence_cache[key] = self.bins[node].evidence(operator)
+            return evidence_cache[key]
+
+        for (nodes, evidence_nodes), indexes in groups.items():
+            evidence = {
+                node: tuple(
+                    np.stack(arrays)
+                    for arrays in zip(*[
+                        get_evidence(node, conditions_list[i][node])
+                        for i in indexes
+                    ])
+                )
+                for node in evidence_nodes
+            }
+            for i, sel in zip(indexes, self.propagate(nodes, evidence, len(indexes))):
+                selectivities[i] = sel
+
+        return selectivities
+
+    def propagate(self, nodes, evidence: dict, n: int) -> np.ndarray:
+        """Runs a batch of n queries over a Steiner tree given stacked evidence arrays."""
+
+        in_tree = set(nodes)
+        cpds = {node: self.cpd(node) for node in nodes}
+
+        # Subset each CPD so that only the relevant values remain
+        with instrument.span('subset', n=n, n_nodes=len(nodes)):
+            masks = {}
+            for node in nodes:
+                mask = np.broadcast_to(cpds[node] > 0, (n,) + cpds[node].shape)
+                by = self.parent[node]
+                for child in self.children[node]:
+                    if child in in_tree:
+                        rows = masks[child].any(axis=-1)
+                        mask = mask & (rows[:, None, :] if by else rows)
+                if node in evidence:
+                    if by:
+                        relevant = distribution.keep_relevant(evidence[node], mask.any(axis=1))
+                        mask = mask & relevant[:, None, :]
+                    else:
+                        mask = mask & distribution.keep_relevant(evidence[node], mask)
+                if by and by in evidence:
+                    relevant = distribution.keep_relevant(evidence[by], mask.any(axis=2))
+                    mask = mask & relevant[:, :, None]
+                masks[node] = mask
+
+        # Propagate the messages from the leaves to the root
+        with instrument.span('propagate', n=n, n_nodes=len(nodes)):
+            messages = {}
+            for node in nodes:
+                cpd = np.where(masks[node], cpds[node], 0)
+                child_messages = [messages[child] for child in self.children[node] if child in in_tree]
+
+                weights = evidence[node][2] if node in evidence else np.ones((n, len(self.bins[node])))
+                # The subtrees of the children are independent given the node, hence their messages
+                # are multiplied
+                if child_messages:
+                    weights = weights * np.prod(child_messages, axis=0)
+
+                if node == self.root:
+                    return (cpd * weights).sum(axis=-1)
+
+                weights = np.where(masks[node].any(axis=1), weights, 0)
+                messages[node] = np.einsum('bij,bj->bi', cpd, weights)
@@ -1,11 +1,46 @@
+import itertools
+
 import numpy as np
 import pandas as pd
-from sklearn import metrics
 
 
-def to_numeric(x: pd.Series):
-    _, num = np.unique(x.tolist(), return_inverse=True)
-    return num
+def to_numeric(x: pd.Series) -> tuple:
+    """Encodes a series as integer codes, missing values are encoded as -1.
+
+    Returns:
+        tuple: the codes and the number of distinct values.
+    """
+    codes, uniques = pd.factorize(x)
+    return codes, len(uniques)
+
+
+def mutual_info_from_codes(x: np.ndarray, y: np.ndarray, x_card: int, y_card: int) -> float:
+    """Calculates the mutual information between two arrays of integer codes.
+
+    Rows where either code is -1 are ignored. The contingency table is obtained with a single
+    np.bincount on the combined codes, or with np.unique if the table would be too large.
+    """
+
+    mask = (x >= 0) & (y >= 0)
+    if not mask.any():
+        return 0
+
+    combined = x[mask].astype(np.int64) * y_card + y[mask]
+    if x_card * y_card <= 2 * len(combined):
+        counts = np.bincount(combined, minlength=x_card * y_card)
+        combined = np.flatnonzero(counts)
+        counts = counts[combined]
+    else:
+        combined, counts = np.unique(combined, return_counts=True)
+
+    x_counts = np.bincount(combined // y_card, weights=counts, minlength=x_card)
+    y_counts = np.bincount(combined % y_card, weights=counts, minlength=y_card)
+    n = counts.sum()
+
+    outer = x_counts[combined // y_card] * y_counts[combined % y_card]
+    mi = np.sum(counts / n * (np.log(counts) + np.log(n) - np.log(outer)))
+
+    return max(mi, 0)
 
 
 def mutual_info(x: pd.Series, y: pd.Series):
@@ -13,11 +48,30 @@ def mutual_info(x: pd.Series, y: pd.Series):
 
     This works regardless of the type of each series.
     """
-    null_mask = x.isnull() | y.isnull()
-    try:
-        return metrics.mutual_info_score(
-            to_numeric(x[~null_mask]),
-            to_numeric(y[~null_mask])
-        )
-    except:
-        return 0
+    x, x_card = to_numeric(x)
+    y, y_card = to_numeric(y)
+    return mutual_info_from_codes(x, y, x_card, y_card)
+
+
+def pairwise_mutual_info(df: pd.DataFrame, attributes: list, max_rows=None, seed=None) -> list:
+    """Calculates the mutual information of each pair of attributes.
+
+    Each attribute is encoded once. If max_rows is specified then the scores are approximated on
+    a random subsample of the rows, which is much faster for large samples of wide relations.
+
+    Returns:
+        list: (a, b, mutual information) tuples, in the order of itertools.combinations.
+    """
+
+    if max_rows is not None and len(df) > max_rows:
+        df = df.sample(n=max_rows, random_state=None if seed is None else seed % 2 ** 32)
+
+    codes = {}
+    cards = {}
+    for att in attributes:
+        codes[att], cards[att] = to_numeric(df[att])
+
+    return [
+        (a, b, mutual_info_from_codes(codes[a], codes[b], cards[a], cards[b]))
+        for a, b in itertools.combinations(attributes, 2)
+    ]
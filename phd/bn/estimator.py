@@ -1,122 +1,337 @@
+import os
 import random
-import time
 
+import numpy as np
 import pandas as pd
 import sqlalchemy
 
-from phd import tools
+from phd import cache
+from phd import expression
+from phd import instrument
+from phd import operator
 from phd.estimator import Estimator
+from phd.estimator import join_name
+from phd.estimator import relation_aliases
 
+from . import bayes_net
 from . import chow_liu
+from . import dependence
 
 
 class BayesianNetworkEstimator(Estimator):
 
     def __init__(self, n_mcv=30, n_bins=30, sampling_ratio=1.0, block_sampling=True,
-                 min_rows=10000, seed=None):
+                 min_rows=10000, seed=None, n_jobs=1, mi_max_rows=None, drift_threshold=0.1,
+                 cache_size=1024, chunk_size=100000, loader='sql', sketch_size=100, fk_joins=False,
+                 adaptive=False, sampling_tolerance=0.02, sample_budget=None, time_budget=None,
+                 memory_budget=None):
         self.n_mcv = n_mcv
         self.n_bins = n_bins
         self.sampling_ratio = sampling_ratio
         self.min_rows = min_rows
         self.block_sampling = block_sampling
         self.seed = seed if seed else random.randint(0, 2 ** 32)
+        self.n_jobs = n_jobs
+        self.cache_size = cache_size
+        self.cache = cache.SelectivityCache(cache_size)
+        self.chunk_size = chunk_size
+        self.loader = loader
+        self.sketch_size = sketch_size
+        self.key_sketches = {}
+        self.mi_max_rows = mi_max_rows
+        self.drift_threshold = drift_threshold
+        self.fk_joins = fk_joins
+        self.adaptive = adaptive
+        self.sampling_tolerance = sampling_tolerance
+        self.sample_budget = sample_budget
+        self.time_budget = time_budget
+        self.memory_budget = memory_budget
+        self.sampling_ratios = {}
+        self.pilot_samples = {}
+        self.stale_relations = set()
+        self.join_bayes_nets = {}
+        self.join_compiled_nets = {}
+        self.join_cards = {}
 
     def build_from_engine(self, engine: sqlalchemy.engine.base.Engine) -> dict:
 
         self.setup(engine)
 
-        # Create a connection to the database
-        conn = engine.connect()
-
-        # Record the time spent
-        duration = {
-            'querying': {},
-            'structure': {},
-            'parameters': {}
-        }
-
         # Create a Bayesian network per relation
+        models, duration = self.build_relations(engine)
+
+        # Store the networks
         self.bayes_nets = {}
+        self.compiled_nets = {}
         self.mutual_infos = {}
-        sampling_method = {True: 'SYSTEM', False: 'BERNOULLI'}[self.block_sampling]
-        for rel_name in self.rel_names:
-
-            rel_card = self.rel_cards[rel_name]
-
-            # Sample the relation if the number of rows is high enough
-            query = 'SELECT * FROM {}'.format(rel_name)
-            # Add a sampling statement if the sampling ratio is lower than 1
-            sampling_ratio = max(self.sampling_ratio, self.min_rows / rel_card)
-            if sampling_ratio < 1:
-                # Make sure there won't be less samples then the minimum number of allowed rows
-                query += ' TABLESAMPLE {} ({}) REPEATABLE ({})'.format(
-                    sampling_method,
-                    sampling_ratio * 100,
-                    self.seed
-                )
-            date_atts = [att for att, typ in self.att_types[rel_name].items() if typ == 'date']
-            tic = time.time()
-            rel = pd.read_sql_query(sql=query, con=conn, parse_dates=date_atts)
-            duration['querying'][rel_name] = time.time() - tic
-
-            # Convert the datetimes to ISO formatted strings
-            for att in date_atts:
-                rel[att] = rel[att].map(lambda x: x.isoformat())
-
-            # Strip the whitespace from the string columns
-            for att in rel.columns:
-                if rel[att].dtype == 'object':
-                    rel[att] = rel[att].str.rstrip()
-
-            # Blacklist the ID columns
-            blacklist = [
-                att for att in rel.columns
-                if '_id' in att or
-                'id_' in att or
-                att == 'id' or
-                '_sk' in att or
-                self.att_types[rel_name][att] == 'character varying' or
-                round(rel_card * self.null_fracs[rel_name][att] + self.att_cards[rel_name][att]) == rel_card
-            ]
+        self.key_sketches = {}
+        for rel_name, (bn, compiled_net, mutual_infos, key_sketches) in models.items():
+            self.bayes_nets[rel_name] = bn
+            self.compiled_nets[rel_name] = compiled_net
+            self.mutual_infos[rel_name] = list(mutual_infos)
+            self.key_sketches[rel_name] = key_sketches
+        self.stale_relations = set()
+
+        # Create a Bayesian network per foreign key over a sample of the join
+        self.join_bayes_nets = {}
+        self.join_compiled_nets = {}
+        self.join_cards = {}
+        if self.fk_joins:
+            models, duration['joins'] = self.build_joins(engine)
+            for fk, (bn, card) in models.items():
+                self.join_bayes_nets[fk] = bn
+                self.join_compiled_nets[fk] = bn.compile()
+                self.join_cards[fk] = card
+
+        self.fit_memory_budget()
+
+        return duration
+
+    def build_relation(self, conn, rel_name: str) -> tuple:
+
+        # Record the time spent
+        duration = {}
 
-            # Find the structure of the Bayesian network
-            tic = time.time()
-            bn, self.mutual_infos[rel_name] = chow_liu.chow_liu_tree_from_df(
+        with instrument.timer('querying', rel_name=rel_name) as timer:
+            rel = self.fetch_sample(conn, rel_name)
+        duration['querying'] = timer.duration
+
+        # Blacklist the ID columns
+        blacklist = self.calc_blacklist(rel_name, rel)
+
+        # Sketch the join keys
+        with instrument.timer('sketches', rel_name=rel_name) as timer:
+            key_sketches = self.build_key_sketches(rel_name, rel)
+        duration['sketches'] = timer.duration
+
+        # Find the structure of the Bayesian network, the join keys are added as leaves so that
+        # their distribution can be conditioned on the filters
+        with instrument.timer('structure', rel_name=rel_name) as timer:
+            bn, mutual_infos = chow_liu.chow_liu_tree_from_df(
                 df=rel,
-                blacklist=blacklist
+                blacklist=blacklist,
+                max_rows=self.mi_max_rows,
+                seed=self.seed,
+                leaves=list(key_sketches)
             )
-            duration['structure'][rel_name] = time.time() - tic
+        duration['structure'] = timer.duration
 
-            # Compute the network's parameters
-            tic = time.time()
+        # Compute the network's parameters
+        with instrument.timer('parameters', rel_name=rel_name) as timer:
             bn.update_distributions(
                 rel,
                 n_mcv=self.n_mcv,
-                n_bins=self.n_bins,
-                types=self.att_types[rel_name]
+                n_bins=self.n_bins
             )
-            duration['parameters'][rel_name] = time.time() - tic
+            compiled_net = bn.compile()
+        duration['parameters'] = timer.duration
 
-            # Store the network
-            self.bayes_nets[rel_name] = bn
+        return (bn, compiled_net, mutual_infos, key_sketches), duration
 
-        # Close the connection to the database
-        conn.close()
+    def build_join(self, conn, fk: tuple) -> tuple:
+        """Learns a network over a sample of the join along a foreign key.
 
-        return duration
+        The attributes are those of the networks of both relations, minus the join keys.
+
+        Returns:
+            tuple: the network, or None if no sampled row has a match, along with the estimated
+                number of rows of the join.
+        """
+
+        child, _, parent, _ = fk
+
+        rows, card = self.fetch_join_sample(conn, fk)
+        if rows is None:
+            return None, 0
+
+        attributes = [
+            '{}.{}'.format(rel_name, att)
+            for rel_name in (child, parent)
+            for att in self.bayes_nets[rel_name].nodes
+            if att not in self.key_sketches[rel_name]
+        ]
+        bn, _ = chow_liu.chow_liu_tree_from_df(
+            df=rows,
+            blacklist=[att for att in rows.columns if att not in attributes],
+            max_rows=self.mi_max_rows,
+            seed=self.seed
+        )
+        bn.update_distributions(rows, n_mcv=self.n_mcv, n_bins=self.n_bins)
+
+        return bn, card
 
     def estimate_selectivity(self, join_query: str, filter_query: str, relation_names=None):
 
         relationships, filters, rel_names = self.parse_query(join_query, filter_query)
+        aliases = relation_aliases(relation_names if relation_names else rel_names)
+
+        # The joins which have their own network are estimated along with their filters
+        joint_card, covered, relationships = self.calc_joint_card(relationships, filters, aliases)
 
-        cartesian_prod_card = self.calc_cartesian_prod_card(relation_names if relation_names else rel_names)
-        join_selectivity = self.calc_join_selectivity(relationships)
+        cartesian_prod_card = self.calc_cartesian_prod_card([
+            rel_name for alias, rel_name in aliases.items() if alias not in covered
+        ])
+        join_selectivity = self.calc_join_selectivity(relationships, filters, aliases)
 
         attribute_selectivity = 1
-        for rel_name in filters:
-            bn = self.bayes_nets[rel_name]
-            p = bn.infer(tools.parse_filter(filters[rel_name]))
-            print(rel_name, p)
+        for alias, f in filters.items():
+            if alias in covered:
+                continue
+            rel_name = aliases.get(alias, alias)
+            p = self.calc_cached_filter_selectivity(rel_name, f)
+            instrument.event('filter_selectivity', rel_name=rel_name, selectivity=p)
             attribute_selectivity *= p
 
-        return cartesian_prod_card * join_selectivity * attribute_selectivity
+        return joint_card * cartesian_prod_card * join_selectivity * attribute_selectivity
+
+    def calc_filter_selectivities(self, rel_name: str, conditions: list) -> list:
+        return self.compiled_nets[rel_name].infer_many(conditions)
+
+    def calc_key_sketch(self, rel_name: str, att: str, f: str) -> tuple:
+        """Conditions the sketch of a join key on a filter by inferring the probability of each of
+        its most common values amongst the rows which satisfy the filter."""
+
+        key_sketch = self.key_sketches[rel_name][att]
+        terms = expression.expand(f)
+        if (att not in self.bayes_nets[rel_name].nodes or not len(key_sketch) or
+                any(att in conditions for _, conditions in terms)):
+            return super().calc_key_sketch(rel_name, att, f)
+
+        # The conjunctions of the filter are inferred alone and along with each value of the key
+        selectivities = self.compiled_nets[rel_name].infer_many(
+            [conditions for _, conditions in terms] +
+            [
+                dict(conditions, **{att: operator.Equal(value)})
+                for value in key_sketch.values
+                for _, conditions in terms
+            ]
+        )
+        p = expression.combine(terms, selectivities[:len(terms)])
+        if not p:
+            return key_sketch.condition(np.zeros(len(key_sketch)), 0), 0
+
+        joint = [
+            expression.combine(terms, selectivities[len(terms) * (i + 1):len(terms) * (i + 2)])
+            for i in range(len(key_sketch))
+        ]
+        return key_sketch.condition(np.array(joint) / p, p), p
+
+    def calc_joint_selectivity(self, fk: tuple, conditions: dict) -> float:
+        return self.join_compiled_nets[fk].infer(conditions)
+
+    def update(self, rel_name: str, inserted_df: pd.DataFrame = None,
+               deleted_df: pd.DataFrame = None) -> bool:
+        """Updates the network of a relation after rows were inserted and/or deleted.
+
+        The counts behind each CPD are adjusted in place while the structure of the network is
+        kept as is. The stored mutual informations are blended with the ones of the inserted rows,
+        and the relation is flagged as stale if its tree has drifted from the Chow-Liu tree by more
+        than drift_threshold. Deleted rows are not taken into account by the drift.
+
+        Returns:
+            bool: whether the relation is stale and should be rebuilt.
+        """
+
+        bn = self.bayes_nets[rel_name]
+        inserted_df = self.normalize_types(rel_name, pd.DataFrame() if inserted_df is None else inserted_df)
+        deleted_df = self.normalize_types(rel_name, pd.DataFrame() if deleted_df is None else deleted_df)
+
+        # Each row is weighted by the sampling ratio the network was built with
+        old_card = self.rel_cards[rel_name]
+        weight = bn.n_rows() / old_card if old_card else 1
+        bn.update_counts(inserted_df, deleted_df, weight)
+        self.compiled_nets[rel_name] = bn.compile()
+        self.invalidate_cache(rel_name)
+
+        # Blend the mutual informations with the ones of the inserted rows
+        if len(inserted_df) and len(self.mutual_infos[rel_name]):
+            inserted_infos = dependence.pairwise_mutual_info(
+                inserted_df,
+                sorted(set(a for a, _, _ in self.mutual_infos[rel_name]) |
+                       set(b for _, b, _ in self.mutual_infos[rel_name])),
+                max_rows=self.mi_max_rows,
+                seed=self.seed
+            )
+            inserted_infos = {(a, b): mi for a, b, mi in inserted_infos}
+            share = len(inserted_df) / (old_card + len(inserted_df))
+            self.mutual_infos[rel_name] = [
+                (a, b, (1 - share) * mi + share * inserted_infos[a, b])
+                for a, b, mi in self.mutual_infos[rel_name]
+            ]
+
+        self.update_statistics(rel_name, inserted_df, deleted_df)
+
+        # The joins are assumed to keep the same distribution, only their sizes are adjusted
+        for fk in self.join_cards:
+            if rel_name in (fk[0], fk[2]):
+                self.invalidate_cache(join_name(fk))
+            if rel_name == fk[0]:
+                self.join_cards[fk] *= self.rel_cards[rel_name] / old_card if old_card else 0
+
+        # Flag the relation if its structure isn't good enough anymore
+        if chow_liu.calc_drift(bn, self.mutual_infos[rel_name]) > self.drift_threshold:
+            self.stale_relations.add(rel_name)
+
+        # Updating the counts decompresses the network
+        self.fit_memory_budget()
+
+        return rel_name in self.stale_relations
+
+    def calc_memory_usage(self) -> dict:
+        usage = {rel_name: bn.memory_usage() for rel_name, bn in self.bayes_nets.items()}
+        for fk, bn in self.join_bayes_nets.items():
+            usage[join_name(fk)] = bn.memory_usage()
+        return usage
+
+    def compress_models(self, min_mass: float):
+        for rel_name, bn in self.bayes_nets.items():
+            bn.compress(min_mass)
+            self.compiled_nets[rel_name] = bn.compile()
+        for fk, bn in self.join_bayes_nets.items():
+            bn.compress(min_mass)
+            self.join_compiled_nets[fk] = bn.compile()
+
+    def save_model(self, path: str) -> dict:
+        return {
+            'relations': {
+                rel_name: {
+                    'net': bn.save(os.path.join(path, rel_name)),
+                    'mutual_infos': [(a, b, float(mi)) for a, b, mi in self.mutual_infos[rel_name]],
+                    'stale': rel_name in self.stale_relations
+                }
+                for rel_name, bn in self.bayes_nets.items()
+            },
+            'joins': [
+                {
+                    'foreign_key': list(fk),
+                    'card': float(self.join_cards[fk]),
+                    'net': bn.save(os.path.join(path, 'joins', join_name(fk)))
+                }
+                for fk, bn in self.join_bayes_nets.items()
+            ]
+        }
+
+    def load_model(self, path: str, meta: dict, mmap_mode):
+        self.bayes_nets = {}
+        self.compiled_nets = {}
+        self.mutual_infos = {}
+        self.stale_relations = set()
+        for rel_name, rel_meta in meta['relations'].items():
+            bn = bayes_net.BayesNet.load(os.path.join(path, rel_name), rel_meta['net'], mmap_mode)
+            self.bayes_nets[rel_name] = bn
+            self.compiled_nets[rel_name] = bn.compile()
+            self.mutual_infos[rel_name] = [tuple(mi) for mi in rel_meta['mutual_infos']]
+            if rel_meta['stale']:
+                self.stale_relations.add(rel_name)
+
+        self.join_bayes_nets = {}
+        self.join_compiled_nets = {}
+        self.join_cards = {}
+        for join_meta in meta['joins']:
+            fk = tuple(join_meta['foreign_key'])
+            bn = bayes_net.BayesNet.load(os.path.join(path, 'joins', join_name(fk)), join_meta['net'], mmap_mode)
+            self.join_bayes_nets[fk] = bn
+            self.join_compiled_nets[fk] = bn.compile()
+            self.join_cards[fk] = join_meta['card']
+
+        self.fit_memory_budget()
@@ -0,0 +1,315 @@
+"""Parallel and resumable loading of delimited data files, such as the .dat files of dsdgen.
+
+Each file is split into chunks along line boundaries and every chunk is loaded with COPY in its own
+transaction. The transaction also records the chunk in a checkpoint table, hence after a crash the
+chunks which were committed are skipped and the ones which weren't have left no rows behind.
+"""
+import glob
+import multiprocessing
+import os
+import time
+
+import sqlalchemy
+
+
+CHECKPOINTS = 'load_checkpoints'
+DEFERRED = 'load_deferred'
+FINISHED = -1
+
+# Stages in which the deferred statements are run
+INDEXES = 0
+FOREIGN_KEYS = 1
+
+
+class DatReader():
+    """File-like object over a byte range of a data file which drops the delimiter that ends each
+    line, as dsdgen writes one after the last column."""
+
+    def __init__(self, path: str, start: int, end: int, sep='|', block_size=1 << 20):
+        self.file = open(path, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+        self.trailing = (sep + '\n').encode()
+        self.block_size = block_size
+        self.buffer = b''
+
+    def fill(self, size: int):
+        """Reads whole lines until the buffer holds at least size bytes or the range is exhausted."""
+        while len(self.buffer) < size and self.remaining > 0:
+            block = self.file.read(min(self.block_size, self.remaining))
+            # Complete the last line so that no delimiter is split across two blocks
+            if not block.endswith(b'\n') and len(block) < self.remaining:
+                block += self.file.readline(self.remaining - len(block))
+            self.remaining -= len(block)
+            self.buffer += block.replace(self.trailing, b'\n')
+
+    def read(self, size=-1) -> bytes:
+        self.fill(float('inf') if size is None or size < 0 else size)
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1) -> bytes:
+        while b'\n' not in self.buffer and self.remaining > 0:
+            self.fill(len(self.buffer) + 1)
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        return self.read(end if size is None or size < 0 else min(size, end))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def split_file(path: str, chunk_size: int) -> list:
+    """Returns the (start, end) byte ranges of chunks of about chunk_size bytes which end on a line
+    boundary."""
+
+    size = os.path.getsize(path)
+    bounds = [0]
+
+    with open(path, 'rb') as f:
+        while bounds[-1] < size:
+            f.seek(min(bounds[-1] + chunk_size, size))
+            if f.tell() < size:
+                f.readline()
+            bounds.append(f.tell())
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def list_tables(directory: str) -> dict:
+    """Returns the path of the data file of each table, the name of a table being the name of
+    its file."""
+    return {
+        os.path.basename(path).split('.')[0]: path
+        for path in sorted(glob.glob(os.path.join(directory, '*.dat')))
+    }
+
+
+def create_checkpoints(conn):
+    conn.execute(sqlalchemy.text('''
+    CREATE TABLE IF NOT EXISTS {} (table_name text, chunk integer, n_rows bigint,
+                                   PRIMARY KEY (table_name, chunk));
+    CREATE TABLE IF NOT EXISTS {} (table_name text, stage integer, statement text);
+    '''.format(CHECKPOINTS, DEFERRED)).execution_options(autocommit=True))
+
+
+def read_checkpoints(conn) -> dict:
+    """Returns the chunks of each table which have been committed."""
+    done = {}
+    for table_name, chunk in conn.execute('SELECT table_name, chunk FROM {}'.format(CHECKPOINTS)):
+        done.setdefault(table_name, set()).add(chunk)
+    return done
+
+
+def drop_checkpoints(conn):
+    conn.execute(sqlalchemy.text(
+        'DROP TABLE IF EXISTS {}, {}'.format(CHECKPOINTS, DEFERRED)
+    ).execution_options(autocommit=True))
+
+
+def defer_constraints(conn, table_names: list):
+    """Drops the indexes and the constraints of some tables, after recording the statements which
+    recreate them.
+
+    The foreign keys which reference the tables are dropped as well. They are recreated in a later
+    stage than the primary keys they depend on.
+    """
+
+    if not table_names:
+        return
+
+    constraints = conn.execute(sqlalchemy.text('''
+    SELECT conrelid::regclass::text, conname, contype, pg_get_constraintdef(oid)
+    FROM pg_constraint
+    WHERE contype IN ('p', 'u', 'f')
+    AND (conrelid::regclass::text IN :table_names OR confrelid::regclass::text IN :table_names)
+    ORDER BY contype = 'f' DESC
+    '''), table_names=tuple(table_names)).fetchall()
+
+    indexes = conn.execute(sqlalchemy.text('''
+    SELECT tablename, indexname, indexdef
+    FROM pg_indexes
+    WHERE tablename IN :table_names
+    AND indexname NOT IN (SELECT conname FROM pg_constraint)
+    '''), table_names=tuple(table_names)).fetchall()
+
+    insert = sqlalchemy.text(
+        'INSERT INTO {} VALUES (:table_name, :stage, :statement)'.format(DEFERRED)
+    )
+
+    with conn.begin():
+
+        for table_name, name, kind, definition in constraints:
+            conn.execute('ALTER TABLE {} DROP CONSTRAINT {}'.format(table_name, name))
+            conn.execute(
+                insert,
+                table_name=table_name,
+                stage=FOREIGN_KEYS if kind == 'f' else INDEXES,
+                statement='ALTER TABLE {} ADD CONSTRAINT {} {}'.format(table_name, name, definition)
+            )
+
+        for table_name, name, definition in indexes:
+            conn.execute('DROP INDEX {}'.format(name))
+            conn.execute(insert, table_name=table_name, stage=INDEXES, statement=definition)
+
+
+def restore_constraints(conn, stage: int, table_name: str = None):
+    """Runs the statements of a stage which were recorded by defer_constraints, optionally only
+    those of one table."""
+
+    rows = conn.execute(sqlalchemy.text('''
+    SELECT table_name, statement
+    FROM {}
+    WHERE stage = :stage AND (:table_name IS NULL OR table_name = :table_name)
+    '''.format(DEFERRED)), stage=stage, table_name=table_name).fetchall()
+
+    for table_name, statement in rows:
+        with conn.begin():
+            conn.execute(statement)
+            conn.execute(
+                sqlalchemy.text(
+                    'DELETE FROM {} WHERE table_name = :table_name AND statement = :statement'.format(DEFERRED)
+                ),
+                table_name=table_name,
+                statement=statement
+            )
+
+
+def init_worker(uri):
+    """Opens the database connection of a load worker process."""
+    global worker_engine
+    worker_engine = sqlalchemy.create_engine(uri, pool_size=1)
+
+
+def load_chunk(table_name: str, path: str, chunk: int, start: int, end: int, sep: str) -> tuple:
+    """Loads a chunk of a data file and records it as done, in a single transaction."""
+
+    tic = time.time()
+
+    conn = worker_engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        with DatReader(path, start, end, sep=sep) as f:
+            cursor.copy_from(f, table_name, sep=sep, null='')
+        n_rows = cursor.rowcount
+        cursor.execute(
+            'INSERT INTO {} VALUES (%s, %s, %s)'.format(CHECKPOINTS),
+            (table_name, chunk, n_rows)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+    return table_name, chunk, n_rows, time.time() - tic
+
+
+def finish_table(table_name: str, analyze: bool) -> tuple:
+    """Recreates the indexes of a table, runs ANALYZE on it and records it as finished."""
+
+    tic = time.time()
+
+    conn = worker_engine.connect()
+    try:
+        restore_constraints(conn, INDEXES, table_name)
+        with conn.begin():
+            if analyze:
+                conn.execute('ANALYZE {}'.format(table_name))
+            conn.execute(
+                sqlalchemy.text('INSERT INTO {} VALUES (:table_name, :chunk, NULL)'.format(CHECKPOINTS)),
+                table_name=table_name,
+                chunk=FINISHED
+            )
+    finally:
+        conn.close()
+
+    return table_name, time.time() - tic
+
+
+def load_task(task: tuple) -> tuple:
+    return load_chunk(*task)
+
+
+def load_directory(uri: str, directory: str, n_jobs=4, chunk_size=256 << 20, sep='|', defer=True,
+                   analyze=True, log=print):
+    """Loads each data file of a directory into the table of the same name.
+
+    Running this again after a crash resumes the load where it stopped, provided the chunk size is
+    the same.
+
+    Args:
+        uri (str): the database URI.
+        directory (str): the directory which contains the .dat files.
+        n_jobs (int): the number of worker processes, each of which has its own connection.
+        chunk_size (int): the number of bytes per chunk the data files are split into.
+        sep (str): the delimiter of the columns.
+        defer (bool): whether to drop the indexes and the constraints of the tables while they
+            are being loaded.
+        analyze (bool): whether to run ANALYZE on each table once it is loaded.
+        log (callable): called with a progress message after each step.
+    """
+
+    tables = list_tables(directory)
+
+    engine = sqlalchemy.create_engine(uri)
+    conn = engine.connect()
+
+    create_checkpoints(conn)
+    done = read_checkpoints(conn)
+    unfinished = [table_name for table_name in tables if FINISHED not in done.get(table_name, ())]
+
+    if defer:
+        defer_constraints(conn, unfinished)
+
+    # Empty the tables which haven't been started, the other ones keep their committed chunks
+    fresh = [table_name for table_name in unfinished if table_name not in done]
+    if fresh:
+        conn.execute(sqlalchemy.text('TRUNCATE TABLE {}{}'.format(
+            ', '.join(fresh),
+            ' CASCADE' if not done else ''
+        )).execution_options(autocommit=True))
+
+    # List the chunks which haven't been committed yet
+    tasks = [
+        (table_name, tables[table_name], chunk, start, end, sep)
+        for table_name in unfinished
+        for chunk, (start, end) in enumerate(split_file(tables[table_name], chunk_size))
+        if chunk not in done.get(table_name, ())
+    ]
+    remaining = {table_name: 0 for table_name in unfinished}
+    for task in tasks:
+        remaining[task[0]] += 1
+
+    pool = multiprocessing.Pool(processes=n_jobs, initializer=init_worker, initargs=(uri,))
+
+    # Each table is finished as soon as its last chunk is loaded, while the others keep loading
+    finishing = [
+        pool.apply_async(finish_table, (table_name, analyze))
+        for table_name, n in remaining.items()
+        if n == 0
+    ]
+    for table_name, chunk, n_rows, seconds in pool.imap_unordered(load_task, tasks):
+        remaining[table_name] -= 1
+        log('Loaded chunk {} of {} ({} rows, {:.1f}s, {} chunks left)'.format(
+            chunk, table_name, n_rows, seconds, remaining[table_name]
+        ))
+        if remaining[table_name] == 0:
+            finishing.append(pool.apply_async(finish_table, (table_name, analyze)))
+
+    for result in finishing:
+        table_name, seconds = result.get()
+        log('Finished {} ({:.1f}s)'.format(table_name, seconds))
+
+    pool.close()
+    pool.join()
+
+    # The foreign keys can only be restored once every table has its primary key back
+    restore_constraints(conn, FOREIGN_KEYS)
+    drop_checkpoints(conn)
+    conn.close()
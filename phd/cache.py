@@ -0,0 +1,68 @@
+"""Size-bounded cache of per-relation filter selectivities.
+
+Filters are keyed on their canonical form, hence two filters that only differ by the order of their
+predicates or of the values of an In operand share the same entry.
+"""
+from collections import OrderedDict
+
+from . import instrument
+
+
+def canonical_filter(conditions: dict) -> tuple:
+    """Returns a hashable form of a parsed filter where the attributes are sorted."""
+    return tuple((att, conditions[att].key()) for att in sorted(conditions))
+
+
+class SelectivityCache():
+    """Least recently used cache of selectivities, keyed on relation names and canonical filters.
+
+    Args:
+        max_size (int): the maximum number of entries, None means there is no limit and 0 disables
+            the cache.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, rel_name: str, key: tuple):
+        """Returns a cached selectivity, or None if there is none."""
+        try:
+            selectivity = self.entries[rel_name, key]
+        except KeyError:
+            self.misses += 1
+            instrument.count('cache.misses')
+            return None
+        self.entries.move_to_end((rel_name, key))
+        self.hits += 1
+        instrument.count('cache.hits')
+        return selectivity
+
+    def put(self, rel_name: str, key: tuple, selectivity: float):
+        if self.max_size == 0:
+            return
+        self.entries[rel_name, key] = selectivity
+        self.entries.move_to_end((rel_name, key))
+        if self.max_size is not None and len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, rel_name: str = None):
+        """Drops the entries of a relation, or every entry if no relation is specified."""
+        if rel_name is None:
+            self.entries.clear()
+            return
+        for entry in [entry for entry in self.entries if entry[0] == rel_name]:
+            del self.entries[entry]
+
+    def info(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries),
+            'max_size': self.max_size
+        }
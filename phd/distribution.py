@@ -1,89 +1,493 @@
-import itertools
+import bisect
+import sys
 
+import numpy as np
 import pandas as pd
 
+from phd import instrument
 from phd import operator
+from phd import store
+from phd import tools
 
 
-def parse_interval(s, is_numeric):
-    parse_val = lambda x: float(x) if is_numeric else x
+class Bins():
+    """Bin dictionary of an attribute.
 
-    if '%,%' in s:
-        left, right = s[1:-1].split(' %,% ')
+    The bins are made up of the most common values, the quantile intervals of the rest of the
+    values and None for the missing values. Each bin is identified by its position, which is
+    the code the distributions are indexed with.
+    """
 
-        if s.startswith('['):
-            if s.endswith(']'):
-                return pd.Interval(parse_val(left), parse_val(right), 'both')
-            return pd.Interval(parse_val(left), parse_val(right), 'left')
-        if s.endswith(']'):
-            return pd.Interval(parse_val(left), parse_val(right), 'right')
-        return pd.Interval(parse_val(left), parse_val(right), 'neither')
+    def __init__(self, values: list, is_mcv: np.ndarray, n_distinct: np.ndarray):
+        self.values = list(values)
+        self.is_mcv = np.asarray(is_mcv, dtype=bool)
+        self.n_distinct = np.asarray(n_distinct, dtype=float)
+        self.codes = {value: code for code, value in enumerate(self.values)}
+        self.is_interval = np.array([isinstance(v, pd.Interval) for v in self.values], dtype=bool)
 
-    # Not an interval
-    return parse_val(s) if s != 'None' else s
+        # The intervals are in ascending order, the most common values are sorted here if they
+        # can be compared with each other, so that ranges can be found by binary search
+        self.interval_codes = np.flatnonzero(self.is_interval)
+        self.lefts = [self.values[c].left for c in self.interval_codes]
+        self.rights = [self.values[c].right for c in self.interval_codes]
+        mcv_codes = np.flatnonzero(self.is_mcv)
+        try:
+            order = sorted(range(len(mcv_codes)), key=lambda i: self.values[mcv_codes[i]])
+            self.sorted_mcv_codes = mcv_codes[order] if len(mcv_codes) else mcv_codes
+        except TypeError:
+            self.sorted_mcv_codes = None
 
+    @classmethod
+    def from_series(cls, series: pd.Series, n_mcv: int, n_bins: int) -> tuple:
+        """Discretizes a series and returns the bin dictionary along with the code of each value."""
+        with instrument.span('discretize', att=series.name):
+            codes, values, is_mcv, n_distinct = tools.discretize(series, n_mcv=n_mcv, n_bins=n_bins)
+        codes[codes == -1] = len(values)
+        bins = cls(values + [None], np.append(is_mcv, False), np.append(n_distinct, 1))
+        return bins, codes
 
-class Distribution(dict):
+    @classmethod
+    def from_value_counts(cls, value_counts: pd.Series, n_null: int, n_mcv: int, n_bins: int) -> tuple:
+        """Discretizes a series given the number of times each value occurs and the number of
+        missing values, and returns the bin dictionary along with the number of rows in each bin."""
+        with instrument.span('discretize', att=value_counts.name):
+            values, is_mcv, n_distinct, counts = tools.discretize_counts(value_counts, n_mcv=n_mcv, n_bins=n_bins)
+        bins = cls(values + [None], np.append(is_mcv, False), np.append(n_distinct, 1))
+        return bins, np.append(counts, n_null)
 
-    def __init__(self, *args, **kwargs):
-        on = kwargs.pop('on', None)
-        by = kwargs.pop('by', None)
-        super().__init__(*args, **kwargs)
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, series: pd.Series) -> np.ndarray:
+        """Returns the code of the bin each value belongs to.
+
+        Values which are not MCVs are assigned to the first interval whose right bound is not
+        lower than them; values beyond the last interval are assigned to it. Values for which there
+        is no bin at all are encoded as -1.
+        """
+
+        s = tools.rstrip(series) if series.dtype == 'object' else series
+        codes = np.full(len(s), -1, dtype=np.int64)
+
+        # Most common values
+        mcv_codes = np.flatnonzero(self.is_mcv)
+        positions = pd.Index([self.values[c] for c in mcv_codes], dtype=object).get_indexer(s)
+        codes[positions != -1] = mcv_codes[positions[positions != -1]]
+
+        # Missing values
+        codes[s.isnull().values] = self.codes[None]
+
+        # Intervals
+        rest = codes == -1
+        interval_codes = np.flatnonzero(self.is_interval)
+        if rest.any() and len(interval_codes):
+            rights = [self.values[c].right for c in interval_codes]
+            positions = np.searchsorted(rights, s[rest].values, side='left')
+            codes[rest] = interval_codes[np.minimum(positions, len(interval_codes) - 1)]
+
+        return codes
+
+    def evidence(self, op: operator.Operator) -> tuple:
+        """Returns the exact mask, the interval mask and the coverage vector of an operator."""
+
+        if not op or isinstance(op, operator.Identity):
+            everything = np.ones(len(self), dtype=bool)
+            return everything, everything, np.ones(len(self))
+
+        if isinstance(op, operator.Range):
+            try:
+                return self.range_evidence(op)
+            except TypeError:
+                pass
+
+        exact = op_mask(op, [v for v, i in zip(self.values, self.is_interval) if not i], self.codes)
+        fuzzy = op_mask(op, [v for v, i in zip(self.values, self.is_interval) if i], self.codes)
+        if op.is_range:
+            exact |= fuzzy
+
+        coverage = np.ones(len(self))
+        for code in np.flatnonzero(self.is_interval & fuzzy):
+            coverage[code] = op.calc_coverage(self.values[code], self.n_distinct[code])
+
+        return exact, fuzzy, coverage
+
+    def range_slices(self, op: operator.Range) -> tuple:
+        """Returns the slices of sorted_mcv_codes and of interval_codes which a range overlaps,
+        each one being found by binary search.
+
+        Raises:
+            TypeError: if the bounds of the range can't be compared with the values.
+        """
+
+        if self.sorted_mcv_codes is None:
+            raise TypeError('The most common values are not sortable')
+
+        mcvs = [self.values[c] for c in self.sorted_mcv_codes]
+        mcv_slice = slice(
+            0 if op.low is None else bisect_left(mcvs, op.low, not op.low_closed),
+            len(mcvs) if op.high is None else bisect_right(mcvs, op.high, not op.high_closed)
+        )
+        interval_slice = slice(
+            0 if op.low is None else bisect_left(self.rights, op.low, False),
+            len(self.lefts) if op.high is None else bisect_right(self.lefts, op.high, False)
+        )
+
+        return mcv_slice, interval_slice
+
+    def range_evidence(self, op: operator.Range) -> tuple:
+        """Counterpart of evidence for ranges, where only the intervals at both ends of the range
+        can be partially covered."""
+
+        mcv_slice, interval_slice = self.range_slices(op)
+
+        exact = np.zeros(len(self), dtype=bool)
+        fuzzy = np.zeros(len(self), dtype=bool)
+        coverage = np.ones(len(self))
+
+        # Patterns are matched against each most common value within the bounds
+        mcv_codes = self.sorted_mcv_codes[mcv_slice]
+        if isinstance(op, operator.Like) and not op.is_prefix:
+            mcv_codes = [c for c in mcv_codes if op.contains(self.values[c])]
+        exact[mcv_codes] = True
+
+        interval_codes = self.interval_codes[interval_slice]
+        fuzzy[interval_codes] = True
+        for code in set(interval_codes[:1]) | set(interval_codes[-1:]):
+            coverage[code] = op.calc_coverage(self.values[code], self.n_distinct[code])
+        if isinstance(op, operator.Like) and not op.is_prefix:
+            coverage[interval_codes] = np.minimum(coverage[interval_codes], op.PATTERN_COVERAGE)
+
+        return exact | fuzzy, fuzzy, coverage
+
+    def keep_relevant(self, op: operator.Operator, present: np.ndarray) -> np.ndarray:
+        """Returns the mask of the present bins which are relevant to an operator."""
+        return keep_relevant(self.evidence(op), present)
+
+    def nbytes(self) -> int:
+        """Returns the approximate number of bytes taken up by the bin dictionary."""
+        return (
+            tools.sizeof(self.values) + sys.getsizeof(self.codes) +
+            tools.sizeof(self.lefts) + tools.sizeof(self.rights) +
+            sum(a.nbytes for a in (self.is_mcv, self.n_distinct, self.is_interval, self.interval_codes)) +
+            (0 if self.sorted_mcv_codes is None else self.sorted_mcv_codes.nbytes)
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            'values': [store.encode_key(v) for v in self.values],
+            'is_mcv': self.is_mcv.tolist(),
+            'n_distinct': self.n_distinct.tolist()
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        return cls([store.decode_key(v) for v in d['values']], d['is_mcv'], d['n_distinct'])
+
+
+class SparseArray():
+    """Compressed form of the probabilities of a distribution.
+
+    The rows which only hold zeros are removed and the rest are stored in compressed sparse row
+    form, with the probabilities quantized to a smaller float type. Within a row, each run of
+    consecutive cells whose probabilities are lower than min_mass is merged into a single value,
+    which is the mean of the run: the mass of the row is preserved and so is the presence of each
+    bin, whilst neighbouring bins, such as adjacent intervals, are the only ones to be blended. A
+    marginal distribution is stored as a single row.
+    """
+
+    def __init__(self, shape: tuple, rows: np.ndarray, indptr: np.ndarray, indices: np.ndarray,
+                 values: np.ndarray, run_rows: np.ndarray, run_starts: np.ndarray,
+                 run_ends: np.ndarray, run_values: np.ndarray, min_mass: float):
+        self.shape = shape
+        self.rows = rows
+        self.indptr = indptr
+        self.indices = indices
+        self.values = values
+        self.run_rows = run_rows
+        self.run_starts = run_starts
+        self.run_ends = run_ends
+        self.run_values = run_values
+        self.min_mass = min_mass
+
+    @classmethod
+    def from_dense(cls, array: np.ndarray, min_mass=0., dtype=np.float16):
+
+        shape = array.shape
+        dense = np.asarray(array, dtype=float).reshape(-1, shape[-1])
+        row_dtype = np.min_scalar_type(max(len(dense) - 1, 0))
+        index_dtype = np.min_scalar_type(shape[-1])
+        rows = np.flatnonzero((dense > 0).any(axis=1))
+        dense = dense[rows]
+
+        # Find the runs of low cells, each row being padded with a cell which ends its last run
+        width = shape[-1] + 1
+        low = np.zeros((len(rows), width), dtype=bool)
+        low[:, :-1] = (dense > 0) & (dense < min_mass)
+        steps = np.diff(np.concatenate([[0], low.ravel().astype(np.int8)]))
+        starts = np.flatnonzero(steps == 1)
+        ends = np.flatnonzero(steps == -1)
+
+        # Merging a single cell would save nothing
+        single = ends - starts == 1
+        low.ravel()[starts[single]] = False
+        starts, ends = starts[~single], ends[~single]
+        high = (dense > 0) & ~low[:, :-1]
+
+        padded = np.zeros((len(rows), width))
+        padded[:, :-1] = dense
+        sums = np.concatenate([[0], np.cumsum(padded.ravel())])
+        means = (sums[ends] - sums[starts]) / (ends - starts)
+
+        # Quantization must not turn a present bin into an absent one
+        tiny = np.nextafter(dtype(0), dtype(1))
+
+        return cls(
+            shape=shape,
+            rows=rows.astype(row_dtype),
+            indptr=np.concatenate([[0], np.cumsum(high.sum(axis=1))]).astype(np.int32),
+            indices=np.nonzero(high)[1].astype(index_dtype),
+            values=np.maximum(dense[high], tiny).astype(dtype),
+            run_rows=(starts // width).astype(row_dtype),
+            run_starts=(starts % width).astype(index_dtype),
+            run_ends=(ends - starts // width * width).astype(index_dtype),
+            run_values=np.maximum(means, tiny).astype(dtype),
+            min_mass=min_mass
+        )
+
+    def toarray(self) -> np.ndarray:
+
+        n_rows = 1 if len(self.shape) == 1 else self.shape[0]
+        dense = np.zeros((n_rows, self.shape[-1]))
+        dense[np.repeat(self.rows, np.diff(self.indptr)), self.indices] = self.values
+
+        # Spread the value of each run over its cells
+        lengths = self.run_ends.astype(np.int64) - self.run_starts
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        dense[
+            np.repeat(self.rows[self.run_rows], lengths),
+            np.repeat(self.run_starts, lengths) + offsets
+        ] = np.repeat(self.run_values, lengths)
+
+        return dense.reshape(self.shape)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in (
+            self.rows, self.indptr, self.indices, self.values,
+            self.run_rows, self.run_starts, self.run_ends, self.run_values
+        ))
+
+
+class Distribution():
+    """Probability distribution of an attribute, possibly conditioned on another one.
+
+    The probabilities are stored in an array indexed by bin codes. The array has shape
+    (n_on_bins,) for a marginal distribution and (n_by_bins, n_on_bins) for a conditional one.
+    A bin which has a probability of 0 is considered absent from the distribution. The counts the
+    probabilities are derived from are kept so that the distribution can be updated.
+
+    A distribution can be compressed to save memory, in which case the probabilities are held in
+    a SparseArray and the counts are derived from them and from the total count of each row. The
+    arrays are then decompressed each time they are accessed; modifying a compressed distribution
+    decompresses it for good.
+    """
+
+    def __init__(self, on: str, by: str = None, bins: dict = None, probs: np.ndarray = None,
+                 counts: np.ndarray = None):
         self.on = on
         self.by = by
+        self.bins = bins
+        self.sparse = None
+        self.totals = None
+        self.probs = probs
+        self.counts = counts
+
+    @property
+    def probs(self) -> np.ndarray:
+        if self.sparse is not None:
+            return self.sparse.toarray()
+        return self._probs
+
+    @probs.setter
+    def probs(self, probs: np.ndarray):
+        self.decompress()
+        self._probs = probs
+
+    @property
+    def counts(self) -> np.ndarray:
+        if self.sparse is not None:
+            totals = np.zeros(self.sparse.shape[0] if self.by else 1)
+            totals[self.sparse.rows] = self.totals
+            probs = self.sparse.toarray()
+            return probs * (totals[:, None] if self.by else totals[0])
+        return self._counts
+
+    @counts.setter
+    def counts(self, counts: np.ndarray):
+        self.decompress()
+        self._counts = counts
+
+    @property
+    def is_compressed(self) -> bool:
+        return self.sparse is not None
+
+    def compress(self, min_mass=0., dtype=np.float16):
+        """Compresses the probabilities, see SparseArray.
+
+        Compressing again with a lower min_mass does nothing, the merged cells can't be split.
+        """
+
+        if self.sparse is not None and self.sparse.min_mass >= min_mass:
+            return self
+
+        counts = self.counts
+        sparse = SparseArray.from_dense(self.probs, min_mass=min_mass, dtype=dtype)
+        totals = counts.sum(axis=-1).reshape(-1)[sparse.rows]
+
+        self._probs = None
+        self._counts = None
+        self.sparse = sparse
+        self.totals = totals
+        return self
+
+    def decompress(self):
+        if self.sparse is None:
+            return
+        probs, counts = self.probs, self.counts
+        self.sparse = None
+        self.totals = None
+        self._probs = probs
+        self._counts = counts
+
+    def nbytes(self) -> int:
+        """Returns the number of bytes taken up by the probabilities and the counts."""
+        if self.sparse is not None:
+            return self.sparse.nbytes + self.totals.nbytes
+        return sum(a.nbytes for a in (self._probs, self._counts) if a is not None)
+
+    def count_codes(self, codes) -> np.ndarray:
+        """Counts the co-occurrences of bin codes, rows with a code of -1 are ignored."""
 
-    def build_from_df(self, df: pd.DataFrame, types: dict):
+        on_codes = np.asarray(codes[self.on])
+        n_on = len(self.bins[self.on])
 
+        if not self.by:
+            return np.bincount(on_codes[on_codes >= 0], minlength=n_on)
+
+        by_codes = np.asarray(codes[self.by])
+        n_by = len(self.bins[self.by])
+        mask = (on_codes >= 0) & (by_codes >= 0)
+        return np.bincount(
+            by_codes[mask] * n_on + on_codes[mask],
+            minlength=n_by * n_on
+        ).reshape(n_by, n_on)
+
+    def normalize(self):
+        """Derives the probabilities from the counts."""
         if self.by:
-            calc_inner_dist = lambda g: Distribution(on=self.on).build_from_df(g, types)
-            counts = df.groupby(self.by, sort=False).apply(calc_inner_dist)
+            totals = self.counts.sum(axis=1, keepdims=True)
         else:
-            counts = df.groupby(self.on, sort=False).size() / len(df)
+            totals = self.counts.sum()
+        self.probs = np.divide(
+            self.counts,
+            totals,
+            out=np.zeros(self.counts.shape),
+            where=np.broadcast_to(totals, self.counts.shape) > 0
+        )
 
-        # In some cases a groupby followed by an apply can return a DataFrame
-        if isinstance(counts, pd.DataFrame):
-            counts = counts.stack()
+    def build_from_codes(self, codes, bins: dict):
+        """Counts the co-occurrences of bin codes.
 
-        # I hate this shit
-        on = self.by if self.by else self.on
-        is_numeric = types[on] in ('bigint', 'integer', 'numeric', 'double precision', 'real')
-        super().__init__({parse_interval(k, is_numeric): v for k, v in counts.items()})
+        Args:
+            codes (pandas.DataFrame or dict): the bin code of each row for each attribute.
+            bins (dict): the bin dictionary of each attribute.
+        """
+        with instrument.span('cpd_build', on=self.on, by=self.by):
+            self.bins = {att: bins[att] for att in (self.on, self.by) if att}
+            self.counts = self.count_codes(codes).astype(float)
+            self.normalize()
+        return self
+
+    def build_from_counts(self, counts: np.ndarray, bins: dict):
+        """Sets the counts of the bins of a marginal distribution.
 
+        Args:
+            counts (numpy.ndarray): the number of rows in each bin.
+            bins (dict): the bin dictionary of the attribute.
+        """
+        self.bins = {self.on: bins[self.on]}
+        self.counts = np.asarray(counts, dtype=float)
+        self.normalize()
         return self
 
+    def update_counts(self, codes, weight: float):
+        """Adds the weighted counts of some rows; a negative weight removes them instead."""
+        self.counts = np.clip(self.counts + weight * self.count_codes(codes), 0, None)
+        self.normalize()
+
+    def present(self, on: str) -> np.ndarray:
+        """Returns the mask of the bins of an attribute which have a non-zero probability."""
+        if not self.by:
+            return self.probs > 0
+        return (self.probs > 0).any(axis=0 if on == self.on else 1)
+
+    def restrict(self, on: str, mask: np.ndarray):
+        """Sets the probability of the bins of an attribute which are not in a mask to 0."""
+        if self.by and on == self.by:
+            mask = mask[:, None]
+        return Distribution(on=self.on, by=self.by, bins=self.bins, probs=np.where(mask, self.probs, 0))
+
     def subset(self, on: str, op: operator.Operator):
 
         # Maybe nothing has to be done
         if not op or isinstance(op, operator.Identity) or on not in (self.by, self.on):
             return self
 
-        # Outer keys
-        if not self.by or on == self.by:
-            return Distribution(
-                {k: self[k] for k in op.keep_relevant(self.keys())},
-                on=self.on,
-                by=self.by
-            )
-
-        # Inner keys
-        relevant = op.keep_relevant(set(itertools.chain(*self.values())))
-        clean = lambda x: {k: v for k, v in x.items() if v}
-        return Distribution(
-            clean({
-                k1: {
-                    k2: self[k1][k2]
-                    for k2 in relevant.intersection(v1.keys())
-                }
-                for k1, v1 in self.items()
-            }),
-            on=self.on,
-            by=self.by
-        )
-
-    @property
-    def _constructor(self):
-        return Distribution
+        return self.restrict(on, self.bins[on].keep_relevant(op, self.present(on)))
 
     def to_df(self) -> pd.DataFrame:
         """Returns the DataFrame representation of the CPD."""
-        return pd.DataFrame.from_dict(self, orient='index')
+
+        on_present = self.present(self.on)
+        on_values = pd.Index(self.bins[self.on].values, dtype=object)[on_present]
+
+        if not self.by:
+            return pd.DataFrame({self.on: self.probs[on_present]}, index=on_values)
+
+        by_present = self.present(self.by)
+        return pd.DataFrame(
+            self.probs[by_present][:, on_present],
+            index=pd.Index(self.bins[self.by].values, dtype=object)[by_present],
+            columns=on_values
+        )
+
+
+def bisect_left(values: list, x, strict: bool) -> int:
+    """Returns the position of the first value which is greater than (or equal to, unless strict)
+    x, values being sorted."""
+    return (bisect.bisect_right if strict else bisect.bisect_left)(values, x)
+
+
+def bisect_right(values: list, x, strict: bool) -> int:
+    """Returns the position after the last value which is lower than (or equal to, unless strict)
+    x, values being sorted."""
+    return (bisect.bisect_left if strict else bisect.bisect_right)(values, x)
+
+
+def op_mask(op: operator.Operator, values, codes: dict) -> np.ndarray:
+    """Returns a boolean mask over a bin dictionary of the values an operator deems relevant."""
+    mask = np.zeros(len(codes), dtype=bool)
+    for value in op.keep_relevant(values):
+        mask[codes[value]] = True
+    return mask
+
+
+def keep_relevant(evidence: tuple, present: np.ndarray) -> np.ndarray:
+    """Vectorized counterpart of Operator.keep_relevant restricted to the present values.
+
+    Exact matches are preferred; if there are none then the intervals that overlap with the
+    operand are kept. The masks can have a leading batch dimension.
+    """
+    exact, fuzzy, _ = evidence
+    relevant = exact & present
+    return np.where(relevant.any(axis=-1, keepdims=True), relevant, fuzzy & present)
@@ -1,15 +1,33 @@
 from collections import defaultdict
 import functools
+import inspect
+import io
 import itertools
+import multiprocessing
 import operator
-import re
+import os
 
+import pandas as pd
 import sqlalchemy
 
+from . import adaptive
+from . import cache
+from . import expression
+from . import instrument
+from . import loaders
 from . import relationship
+from . import sketch
+from . import sql
+from . import store
 from . import tools
 
 
+# Probabilities under which the cells of a distribution are merged, which are tried in turn until
+# the models fit within their memory budget. Higher ones would merge the most common values with
+# the intervals, which carry a lot more mass each
+MIN_MASSES = (0., 0.001, 0.005, 0.01)
+
+
 class Estimator():
 
     def __init__(self):
@@ -19,13 +37,33 @@ class Estimator():
         self.null_fracs = None
         self.rel_names = None
         self.att_types = None
+        self.foreign_keys = None
+        self.join_keys = None
+        self.key_sketches = {}
+        self.join_cards = {}
+        self.sampling_ratios = {}
+        self.pilot_samples = {}
+        self.cache = cache.SelectivityCache()
 
     def setup(self, engine: sqlalchemy.engine.base.Engine):
 
+        # The cached selectivities belong to the previous models
+        self.cache.invalidate()
+
         # Retrieve the metadata to know what tables and joins are available
         metadata = tools.get_metadata(engine)
         self.rel_names = tuple(metadata.tables.keys())
 
+        # Both sides of each foreign key are join keys
+        self.foreign_keys = []
+        self.join_keys = defaultdict(list)
+        for table in metadata.tables.values():
+            for fk in table.foreign_keys:
+                self.foreign_keys.append((table.name, fk.parent.name, fk.column.table.name, fk.column.name))
+                for rel_name, att in ((table.name, fk.parent.name), (fk.column.table.name, fk.column.name)):
+                    if att not in self.join_keys[rel_name]:
+                        self.join_keys[rel_name].append(att)
+
         # Create a connection to the database
         conn = engine.connect()
 
@@ -67,17 +105,639 @@ class Estimator():
         # Close the connection to the database
         conn.close()
 
+    def fetch_sample(self, conn, rel_name: str, sampling_ratio: float = None) -> pd.DataFrame:
+        """Samples a relation and normalizes the types of its columns, see iter_sample."""
+        return concat_chunks(self.iter_sample(conn, rel_name, sampling_ratio), self.att_types[rel_name])
+
+    def iter_sample(self, conn, rel_name: str, sampling_ratio: float = None):
+        """Samples a relation and yields its rows in normalized chunks.
+
+        In adaptive mode the pilot sample of the relation is reused, see iter_planned_sample.
+        """
+        if sampling_ratio is None and rel_name in self.pilot_samples:
+            yield from self.iter_planned_sample(conn, rel_name)
+            return
+        query = 'SELECT * FROM {}{}'.format(rel_name, self.sampling_clause(rel_name, sampling_ratio))
+        yield from self.iter_rows(conn, query, self.att_types[rel_name])
+
+    def fetch_pilot_sample(self, conn, rel_name: str, sampling_ratio: float) -> tuple:
+        """Samples a relation along with the physical location of each sampled row.
+
+        Returns:
+            tuple: the sample and the ctid of each of its rows.
+        """
+        query = 'SELECT ctid, * FROM {}{}'.format(rel_name, self.sampling_clause(rel_name, sampling_ratio))
+        rel = self.fetch_rows(conn, query, dict(ctid='tid', **self.att_types[rel_name]))
+        return rel.drop(columns='ctid'), rel['ctid'].astype(str).tolist()
+
+    def iter_planned_sample(self, conn, rel_name: str):
+        """Yields the sample planned by plan_sampling, given the pilot sample of the relation.
+
+        The pilot sample is yielded as is if its ratio is the planned one. Otherwise only the rows
+        it lacks are fetched: with the same seed, PostgreSQL's sampling methods keep a row if a
+        hash of its location falls under a threshold which grows with the ratio, hence a sample
+        contains the samples of lower ratios and the pilot rows are excluded by their ctid.
+        """
+
+        pilot_ratio, rel, ctids = self.pilot_samples[rel_name]
+        yield rel
+        sampling_ratio = self.sampling_ratios[rel_name]
+        if sampling_ratio <= pilot_ratio:
+            return
+
+        sampling_clause = self.sampling_clause(rel_name, sampling_ratio)
+        if not ctids:
+            query = 'SELECT * FROM {}{}'.format(rel_name, sampling_clause)
+            yield from self.iter_rows(conn, query, self.att_types[rel_name])
+            return
+
+        # The pilot ctids are copied into a temporary table instead of being spelled out in the
+        # query, and they are compared as text so that the anti-join can use a hash table
+        table = 'pilot_ctids_{}'.format(rel_name)
+        self.copy_ctids(conn, table, ctids)
+        query = (
+            'SELECT r.* FROM {} AS r{} '
+            'WHERE NOT EXISTS (SELECT 1 FROM {} AS p WHERE p.ctid = r.ctid::text)'
+        ).format(rel_name, sampling_clause, table)
+        try:
+            yield from self.iter_rows(conn, query, self.att_types[rel_name])
+        finally:
+            conn.execute('DROP TABLE IF EXISTS {}'.format(table))
+
+    def copy_ctids(self, conn, table: str, ctids: list):
+        """Creates a temporary table which holds ctids as text, they are loaded with COPY."""
+        conn.execute('CREATE TEMPORARY TABLE {} (ctid text)'.format(table))
+        cursor = conn.connection.cursor()
+        cursor.copy_from(io.StringIO('\n'.join(ctids)), table, columns=('ctid',))
+        cursor.close()
+        conn.execute('ANALYZE {}'.format(table))
+
+    def sampling_clause(self, rel_name: str, sampling_ratio: float = None) -> str:
+        """Returns the TABLESAMPLE clause of a relation, which is empty if it is read in full.
+
+        The sampling ratio defaults to the one planned by plan_sampling in adaptive mode, and
+        otherwise to sampling_ratio, with at least min_rows rows.
+        """
+
+        if sampling_ratio is None and rel_name in self.sampling_ratios:
+            sampling_ratio = self.sampling_ratios[rel_name]
+        elif sampling_ratio is None:
+            sampling_ratio = max(self.sampling_ratio, self.min_rows / self.rel_cards[rel_name])
+
+        # Add a sampling statement if the sampling ratio is lower than 1
+        if sampling_ratio >= 1:
+            return ''
+        # Make sure there won't be less samples then the minimum number of allowed rows
+        return ' TABLESAMPLE {} ({}) REPEATABLE ({})'.format(
+            {True: 'SYSTEM', False: 'BERNOULLI'}[self.block_sampling],
+            sampling_ratio * 100,
+            self.seed
+        )
+
+    def fetch_rows(self, conn, query: str, att_types: dict) -> pd.DataFrame:
+        """Runs a query with the loader and normalizes the types of the resulting columns.
+
+        The chunks of iter_rows are concatenated, hence the whole result is held in memory, and
+        briefly twice over. The models which can be built from counts accumulated over the chunks
+        should iterate over them instead.
+        """
+        return concat_chunks(self.iter_rows(conn, query, att_types), att_types)
+
+    def iter_rows(self, conn, query: str, att_types: dict):
+        """Runs a query with the loader and yields the rows chunk_size at a time, the types of
+        the columns of each chunk being normalized as it comes.
+
+        Args:
+            conn: the database connection.
+            query (str): the query, whose columns are the keys of att_types.
+            att_types (dict): the PostgreSQL type of each column.
+        """
+
+        if self.loader not in loaders.LOADERS:
+            raise ValueError('Unknown loader {}, choose one of {}'.format(
+                self.loader,
+                ', '.join(loaders.LOADERS)
+            ))
+
+        with instrument.span('sample_fetch', loader=self.loader):
+            for chunk in loaders.LOADERS[self.loader](conn, query, att_types, self.chunk_size):
+                yield normalize_types(chunk, att_types)
+
+    def normalize_types(self, rel_name: str, rel: pd.DataFrame) -> pd.DataFrame:
+        """Converts the dates to ISO formatted strings and strips the whitespace from strings.
+
+        Each distinct value is only converted once. Missing dates are mapped to None.
+        """
+        return normalize_types(rel, self.att_types[rel_name])
+
+    def fetch_join_sample(self, conn, fk: tuple) -> tuple:
+        """Samples the join along a foreign key.
+
+        The sample is taken on the referencing relation, hence each sampled row matches at most one
+        row of the referenced relation and the join needs no fan-out correction. The attributes are
+        named rel_name.att.
+
+        Args:
+            conn: the database connection.
+            fk (tuple): the referencing relation and attribute followed by the referenced ones.
+
+        Returns:
+            tuple: the sampled rows which have a match, or None if there are none, along with the
+                estimated number of rows of the join.
+        """
+
+        child, child_on, parent, parent_on = fk
+
+        att_types = {}
+        columns = []
+        for alias, rel_name in (('c', child), ('p', parent)):
+            for att, typ in self.att_types[rel_name].items():
+                att_types['{}.{}'.format(rel_name, att)] = typ
+                columns.append('{}.{} AS "{}.{}"'.format(alias, att, rel_name, att))
+
+        query = 'SELECT {} FROM {} AS c{} LEFT JOIN {} AS p ON c.{} = p.{}'.format(
+            ', '.join(columns),
+            child,
+            self.sampling_clause(child),
+            parent,
+            child_on,
+            parent_on
+        )
+        rows = self.fetch_rows(conn, query, att_types)
+
+        # The referencing rows without a match are not part of the join
+        matched = rows['{}.{}'.format(parent, parent_on)].notnull()
+        if not matched.any():
+            return None, 0
+        card = self.rel_cards[child] * matched.mean()
+
+        return rows[matched.values].reset_index(drop=True), card
+
+    def calc_blacklist(self, rel_name: str, rel: pd.DataFrame) -> list:
+        """Returns the ID columns and the columns where each value is unique."""
+        rel_card = self.rel_cards[rel_name]
+        return [
+            att for att in rel.columns
+            if '_id' in att
+            or 'id_' in att
+            or att == 'id'
+            or '_sk' in att
+            or self.att_types[rel_name][att] == 'character varying'
+            or round(rel_card * self.null_fracs[rel_name][att] + self.att_cards[rel_name][att]) == rel_card
+        ]
+
+    def calc_join_keys(self, rel_name: str, rel: pd.DataFrame) -> list:
+        """Returns the foreign key columns along with the ones whose name suggests they are IDs."""
+        return [
+            att for att in rel.columns
+            if att in self.join_keys.get(rel_name, [])
+            or '_id' in att
+            or 'id_' in att
+            or att == 'id'
+            or '_sk' in att
+        ]
+
+    def build_key_sketches(self, rel_name: str, rel: pd.DataFrame) -> dict:
+        """Builds the frequency sketch of each join key of a sampled relation."""
+        return self.build_key_sketches_from_counts(rel_name, {
+            att: rel[att].value_counts()
+            for att in self.calc_join_keys(rel_name, rel)
+        })
+
+    def build_key_sketches_from_counts(self, rel_name: str, value_counts: dict) -> dict:
+        """Builds the frequency sketch of each join key given the value counts of its sample."""
+        rel_card = self.rel_cards[rel_name]
+        return {
+            att: sketch.KeySketch.from_value_counts(
+                counts,
+                n_rows=rel_card * (1 - self.null_fracs[rel_name].get(att, 0)),
+                n_distinct=self.att_cards[rel_name].get(att, len(counts)),
+                size=self.sketch_size
+            )
+            for att, counts in value_counts.items()
+        }
+
+    def plan_sampling(self, engine: sqlalchemy.engine.base.Engine) -> tuple:
+        """Picks the sampling ratio of each relation in adaptive mode, see phd.adaptive.
+
+        Each relation is first sampled with min_rows rows. The relations whose bootstrap error
+        exceeds sampling_tolerance are then sampled further, within sample_budget rows and
+        time_budget seconds of sampling if they are specified. The time budget includes the
+        pilot samples, the time a sampled row takes is extrapolated from them.
+
+        The pilot samples are kept in pilot_samples, hence building a relation whose pilot
+        sample is large enough doesn't read it again, and the others only fetch the rows their
+        pilot sample lacks.
+
+        Returns:
+            tuple: the sampling ratio of each relation, the pilot sample of each relation along
+                with its ratio and the ctids of its rows, and the time spent on each pilot sample.
+        """
+
+        pilots = {}
+        pilot_samples = {}
+        duration = {}
+        conn = engine.connect()
+
+        for rel_name in self.rel_names:
+            n_rows = self.rel_cards[rel_name]
+            pilot_ratio = min(self.min_rows / n_rows, 1) if n_rows else 1
+            with instrument.timer('pilot', rel_name=rel_name) as timer:
+                rel, ctids = self.fetch_pilot_sample(conn, rel_name, pilot_ratio)
+            duration[rel_name] = timer.duration
+            pilot_samples[rel_name] = (pilot_ratio, rel, ctids)
+
+            # A relation which is read in full has no sampling error
+            error = 0.
+            if pilot_ratio < 1:
+                blacklist = self.calc_blacklist(rel_name, rel)
+                error = adaptive.sample_error(
+                    rel,
+                    atts=[att for att in rel.columns if att not in blacklist],
+                    n_rows=n_rows,
+                    n_mcv=getattr(self, 'n_mcv', adaptive.N_MCV),
+                    n_bins=getattr(self, 'n_bins', adaptive.N_BINS),
+                    seed=self.seed
+                )
+            pilots[rel_name] = (max(len(rel), 1), error, max(n_rows, len(rel), 1))
+            instrument.event('pilot_sample', rel_name=rel_name, n_rows=len(rel), error=error)
+
+        conn.close()
+
+        # The budgets are expressed as a cost per row, a budget of 1 being the whole of both
+        costs = {rel_name: 0. for rel_name in pilots}
+        if self.sample_budget is not None:
+            costs = {rel_name: 1 / self.sample_budget for rel_name in pilots}
+        if self.time_budget is not None:
+            # The rows of the pilot samples are counted along with the rest, hence the time they
+            # took is part of the cost rather than taken off the budget
+            for rel_name, (pilot_rows, _, _) in pilots.items():
+                seconds = duration[rel_name] / pilot_rows
+                costs[rel_name] = max(costs[rel_name], seconds / self.time_budget if self.time_budget > 0 else float('inf'))
+        budget = None if self.sample_budget is None and self.time_budget is None else 1
+
+        rows = adaptive.allocate(pilots, self.sampling_tolerance, costs=costs, budget=budget)
+        sampling_ratios = {}
+        for rel_name, (pilot_rows, _, n_rows) in pilots.items():
+            # The pilot sample is kept as is if it has enough rows
+            if rows[rel_name] <= pilot_rows:
+                sampling_ratios[rel_name] = pilot_samples[rel_name][0]
+            else:
+                sampling_ratios[rel_name] = min(rows[rel_name] / n_rows, 1)
+
+        return sampling_ratios, pilot_samples, duration
+
+    def build_relation(self, conn, rel_name: str) -> tuple:
+        """Builds the model of a single relation.
+
+        Returns:
+            tuple: the model and a dict that contains the time spent on each step.
+        """
+        raise NotImplementedError
+
+    @instrument.profiled('build_relations')
+    def build_relations(self, engine: sqlalchemy.engine.base.Engine) -> tuple:
+        """Calls build_relation on each relation, in parallel if n_jobs is not 1.
+
+        Each worker process opens its own connection to the database. The models are returned in
+        the same order as self.rel_names regardless of the order in which they were built.
+        """
+
+        n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+
+        # The sampling ratios are picked beforehand in adaptive mode
+        self.sampling_ratios, self.pilot_samples, planning = (
+            self.plan_sampling(engine) if self.adaptive else ({}, {}, {})
+        )
+
+        if n_jobs == 1:
+            conn = engine.connect()
+            outputs = [
+                self.build_relation(conn, rel_name) + (os.getpid(),)
+                for rel_name in self.rel_names
+            ]
+            conn.close()
+        else:
+            pool = multiprocessing.Pool(
+                processes=min(n_jobs, len(self.rel_names)),
+                initializer=init_worker,
+                initargs=(engine.url,)
+            )
+            # Each task only carries the pilot sample of its own relation
+            pilot_samples, self.pilot_samples = self.pilot_samples, {}
+            outputs = pool.starmap(build_in_worker, [
+                (self, rel_name, pilot_samples.get(rel_name))
+                for rel_name in self.rel_names
+            ])
+            pool.close()
+            pool.join()
+
+        # The pilot samples are only needed to build the relations
+        self.pilot_samples = {}
+
+        # Record the time spent per step and per worker
+        models = {}
+        duration = defaultdict(dict)
+        for rel_name, (model, rel_duration, pid) in zip(self.rel_names, outputs):
+            models[rel_name] = model
+            for step, seconds in rel_duration.items():
+                duration[step][rel_name] = seconds
+            duration['workers'][pid] = duration['workers'].get(pid, 0) + sum(rel_duration.values())
+        if planning:
+            duration['planning'] = planning
+
+        return models, dict(duration)
+
+    @instrument.profiled('build_joins')
+    def build_joins(self, engine: sqlalchemy.engine.base.Engine) -> tuple:
+        """Calls build_join on each foreign key.
+
+        Returns:
+            tuple: the model and the number of rows of each join, keyed by foreign key, along with
+                the time spent on each one.
+        """
+
+        models = {}
+        duration = {}
+        conn = engine.connect()
+
+        for fk in self.foreign_keys:
+            # Self-referencing foreign keys would need aliases for the attributes of both sides
+            if fk[0] == fk[2] or fk in models:
+                continue
+            with instrument.timer('join', fk=join_name(fk)) as timer:
+                model, card = self.build_join(conn, fk)
+            duration[join_name(fk)] = timer.duration
+            if model is not None:
+                models[fk] = model, card
+
+        conn.close()
+
+        return models, duration
+
+    def build_join(self, conn, fk: tuple) -> tuple:
+        """Builds the model of the join along a foreign key.
+
+        Returns:
+            tuple: the model, or None if the join is empty, and the number of rows of the join.
+        """
+        raise NotImplementedError
+
+    def update(self, rel_name: str, inserted_df: pd.DataFrame = None,
+               deleted_df: pd.DataFrame = None) -> bool:
+        """Updates the model of a relation after rows were inserted and/or deleted.
+
+        Returns:
+            bool: whether the model has drifted enough that the relation should be rebuilt.
+        """
+        raise NotImplementedError
+
+    def update_statistics(self, rel_name: str, inserted_df: pd.DataFrame, deleted_df: pd.DataFrame):
+        """Refreshes the cardinalities and the null fractions of a relation.
+
+        Like PostgreSQL, the number of distinct values of an attribute is assumed to grow with the
+        relation if it exceeds 10% of the number of rows; otherwise it is assumed to be fixed, save
+        for the inserted values that push it higher.
+        """
+
+        old_card = self.rel_cards[rel_name]
+        new_card = max(old_card + len(inserted_df) - len(deleted_df), 0)
+
+        for att, null_frac in self.null_fracs[rel_name].items():
+
+            # Null fractions
+            n_nulls = old_card * null_frac
+            if att in inserted_df:
+                n_nulls += inserted_df[att].isnull().sum()
+            if att in deleted_df:
+                n_nulls -= deleted_df[att].isnull().sum()
+            self.null_fracs[rel_name][att] = min(max(n_nulls / new_card, 0), 1) if new_card else 0
+
+            # Attribute cardinalities
+            att_card = self.att_cards[rel_name].get(att)
+            if att_card is None:
+                continue
+            if old_card and att_card > 0.1 * old_card:
+                att_card *= new_card / old_card
+            elif att in inserted_df:
+                att_card = max(att_card, inserted_df[att].nunique())
+            self.att_cards[rel_name][att] = att_card
+
+        # The join keys are assumed to keep the same distribution
+        for att, key_sketch in self.key_sketches.get(rel_name, {}).items():
+            n_rows = new_card * (1 - self.null_fracs[rel_name].get(att, 0))
+            key_sketch.freqs = key_sketch.freqs * (n_rows / key_sketch.n_rows if key_sketch.n_rows else 0)
+            key_sketch.n_rows = n_rows
+            key_sketch.n_distinct = max(self.att_cards[rel_name].get(att, 0), len(key_sketch))
+
+        self.rel_cards[rel_name] = new_card
+
+    def get_params(self) -> dict:
+        """Returns the parameters the estimator was initialised with."""
+        return {
+            name: getattr(self, name)
+            for name in inspect.signature(type(self).__init__).parameters
+            if name != 'self'
+        }
+
+    def save(self, path: str):
+        """Saves the fitted estimator to a directory."""
+
+        os.makedirs(path, exist_ok=True)
+
+        meta = {
+            'estimator': type(self).__name__,
+            'params': self.get_params(),
+            'rel_names': list(self.rel_names),
+            'rel_cards': self.rel_cards,
+            'att_cards': self.att_cards,
+            'null_fracs': self.null_fracs,
+            'att_types': self.att_types,
+            'foreign_keys': self.foreign_keys,
+            'join_keys': self.join_keys,
+            'key_sketches': {
+                rel_name: {att: key_sketch.to_dict() for att, key_sketch in sketches.items()}
+                for rel_name, sketches in self.key_sketches.items()
+            }
+        }
+        meta['model'] = self.save_model(path)
+
+        store.write_meta(path, meta)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode='r'):
+        """Loads an estimator that was saved with save.
+
+        Args:
+            path (str): the directory the estimator was saved to.
+            mmap_mode (str): passed to numpy.load, the arrays are memory-mapped by default so
+                that processes which load the same model share pages.
+        """
+
+        meta = store.read_meta(path)
+        if meta['estimator'] != cls.__name__:
+            raise ValueError('{} contains a {}, not a {}'.format(path, meta['estimator'], cls.__name__))
+
+        est = cls(**meta['params'])
+        est.rel_names = tuple(meta['rel_names'])
+        est.rel_cards = meta['rel_cards']
+        est.att_cards = defaultdict(dict, meta['att_cards'])
+        est.null_fracs = defaultdict(dict, meta['null_fracs'])
+        est.att_types = defaultdict(dict, meta['att_types'])
+        est.foreign_keys = [tuple(fk) for fk in meta['foreign_keys']]
+        est.join_keys = defaultdict(list, meta['join_keys'])
+        est.key_sketches = {
+            rel_name: {att: sketch.KeySketch.from_dict(d) for att, d in sketches.items()}
+            for rel_name, sketches in meta['key_sketches'].items()
+        }
+        est.load_model(path, meta['model'], mmap_mode)
+
+        return est
+
+    def save_model(self, path: str) -> dict:
+        """Saves the arrays of the fitted model and returns the associated metadata."""
+        raise NotImplementedError
+
+    def load_model(self, path: str, meta: dict, mmap_mode):
+        raise NotImplementedError
+
     def calc_cartesian_prod_card(self, rel_names):
-        return functools.reduce(operator.mul, [self.rel_cards[name] for name in rel_names])
+        return functools.reduce(operator.mul, [self.rel_cards[name] for name in rel_names], 1)
+
+    def calc_joint_card(self, relationships, filters: dict, aliases: dict = None) -> tuple:
+        """Estimates the joins which have a model of their own along with the filters of both sides.
+
+        The foreign keys which have a join model are the keys of join_cards, which holds the number
+        of rows of each join. Each relation is covered by at most one join model, the joins are
+        picked in query order.
+
+        Args:
+            relationships (list of Relationship)
+            filters (dict): the filter query of each relation, as returned by parse_query.
+            aliases (dict): the relation name of each alias of the query, see relation_aliases.
+
+        Returns:
+            tuple: the estimated number of rows, the relations which were covered, by alias if
+                the query has aliases, and the relationships which are left to estimate.
+        """
+
+        aliases = aliases or {}
+        joint_card = 1
+        covered = set()
+        remaining = []
+
+        for r in relationships:
+            left, right = aliases.get(r.left, r.left), aliases.get(r.right, r.right)
+            fk, sides = next(
+                (
+                    (fk, sides) for fk, sides in (((left, r.left_on, right, r.right_on), (r.left, r.right)),
+                                                  ((right, r.right_on, left, r.left_on), (r.right, r.left)))
+                    if fk in self.join_cards
+                ),
+                (None, None)
+            )
+            if fk is None or sides[0] in covered or sides[1] in covered:
+                remaining.append(r)
+                continue
+
+            # The attributes of both sides are prefixed with their relation
+            terms = functools.reduce(expression.multiply, [
+                [
+                    (coef, {'{}.{}'.format(rel_name, att): op for att, op in conditions.items()})
+                    for coef, conditions in expression.expand(filters.get(side, ''))
+                ]
+                for rel_name, side in zip((fk[0], fk[2]), sides)
+            ])
+            p = expression.combine(terms, [
+                self.calc_cached_joint_selectivity(fk, conditions)
+                for _, conditions in terms
+            ])
+            instrument.event('joint_selectivity', join=join_name(fk), selectivity=p)
+            joint_card *= self.join_cards[fk] * p
+            covered |= set(sides)
+
+        return joint_card, covered, remaining
+
+    def calc_joint_selectivity(self, fk: tuple, conditions: dict) -> float:
+        """Returns the fraction of the rows of the join along a foreign key which satisfy some
+        conditions, the attributes being named rel_name.att."""
+        raise NotImplementedError
+
+    def calc_cached_joint_selectivity(self, fk: tuple, conditions: dict) -> float:
 
-    def calc_join_selectivity(self, relationships):
+        if not conditions:
+            return 1
+
+        key = cache.canonical_filter(conditions)
+        p = self.cache.get(join_name(fk), key)
+        if p is None:
+            p = self.calc_joint_selectivity(fk, conditions)
+            self.cache.put(join_name(fk), key, p)
+
+        return p
+
+    def calc_join_selectivity(self, relationships, filters=None, aliases=None):
+        """Returns the selectivity of the joins of a query.
+
+        The selectivity of each join is derived from the sketches of its keys, once they have been
+        conditioned on the filters of their relation. If a key has no sketch then the keys are
+        assumed to be uniform and independent.
+
+        Args:
+            relationships (list of Relationship)
+            filters (dict): the filter query of each relation, as returned by parse_query.
+            aliases (dict): the relation name of each alias of the query, see relation_aliases.
+        """
+
+        filters = filters or {}
+        aliases = aliases or {}
         join_selectivity = 1
+
         for r in relationships:
-            left_key_density = 1 / self.att_cards[r.left][r.left_on]
-            right_key_density = 1 / self.att_cards[r.right][r.right_on]
-            join_selectivity *= min(left_key_density, right_key_density)
+
+            left_name, right_name = aliases.get(r.left, r.left), aliases.get(r.right, r.right)
+
+            if (r.left_on not in self.key_sketches.get(left_name, {}) or
+                    r.right_on not in self.key_sketches.get(right_name, {})):
+                left_key_density = 1 / self.att_cards[left_name][r.left_on]
+                right_key_density = 1 / self.att_cards[right_name][r.right_on]
+                join_selectivity *= min(left_key_density, right_key_density)
+                continue
+
+            left, left_p = self.calc_cached_key_sketch(left_name, r.left_on, filters.get(r.left))
+            right, right_p = self.calc_cached_key_sketch(right_name, r.right_on, filters.get(r.right))
+            join_selectivity *= sketch.calc_join_selectivity(
+                left,
+                right,
+                self.rel_cards[left_name] * left_p,
+                self.rel_cards[right_name] * right_p
+            )
+
         return join_selectivity
 
+    def calc_key_sketch(self, rel_name: str, att: str, f: str) -> tuple:
+        """Returns the sketch of a join key amongst the rows which satisfy a filter, along with the
+        selectivity of the filter.
+
+        By default the key is assumed to be independent of the filter, in which case the sketch is
+        left as is.
+        """
+        return self.key_sketches[rel_name][att], 1
+
+    def calc_cached_key_sketch(self, rel_name: str, att: str, f: str) -> tuple:
+        """Returns the output of calc_key_sketch, which is cached alongside the selectivities."""
+
+        if not f:
+            return self.key_sketches[rel_name][att], 1
+
+        key = ('sketch', att, expression.canonical(f))
+        conditioned = self.cache.get(rel_name, key)
+        if conditioned is None:
+            conditioned = self.calc_key_sketch(rel_name, att, f)
+            self.cache.put(rel_name, key, conditioned)
+
+        return conditioned
+
     def parse_join_query(self, join_query: str):
 
         def join_to_relation(join: str) -> relationship.Relationship:
@@ -97,29 +757,255 @@ class Estimator():
         ))
 
     def parse_filter_query(self, filter_query: str):
+        """Returns the filter of each relation.
 
-        filter_query = ' '.join(filter_query.replace('\n', '').split())
+        Each member of the top-level conjunction has to be about a single relation, the members
+        of a relation are then joined back together without the relation prefix.
 
-        if len(filter_query) == 0:
-            return {}
+        Raises:
+            ValueError: if a member involves several relations, such as a disjunction of
+                predicates on two relations.
+        """
 
-        return dict(
-            (k, ' and '.join([re.sub('\w+\.', '', v[1]) for v in g]))
-            for k, g in itertools.groupby(
-                [
-                    (re.split(' (==|in) ', part)[0].split('.')[0], part)
-                    for part in filter_query.split(' and ')
-                ],
-                lambda x: x[0]
+        members = defaultdict(list)
+        for member in expression.conjuncts(expression.parse(filter_query)):
+            rel_names = set(p.att.split('.')[0] for p in expression.predicates(member))
+            if len(rel_names) > 1:
+                raise ValueError('Filters on several relations are not supported: {}'.format(
+                    expression.to_string(member)
+                ))
+            members[rel_names.pop()].append(
+                expression.rename(member, lambda att: att.split('.', 1)[1])
             )
-        )
+
+        return {
+            rel_name: expression.to_string(
+                rel_members[0] if len(rel_members) == 1 else expression.And(tuple(rel_members))
+            )
+            for rel_name, rel_members in sorted(members.items())
+        }
 
     def parse_query(self, join_query, filter_query):
-        relationships = self.parse_join_query(join_query)
-        filters = self.parse_filter_query(filter_query)
+        with instrument.span('parse'):
+            relationships = self.parse_join_query(join_query)
+            filters = self.parse_filter_query(filter_query)
         relation_names = set(itertools.chain.from_iterable([(r.left, r.right) for r in relationships]))
         relation_names = relation_names.union(set(filters.keys()))
         return relationships, filters, relation_names
 
     def estimate_selectivity(self, join_query: str, filter_query: str, relation_names=None):
         raise NotImplementedError
+
+    def calc_filter_selectivities(self, rel_name: str, conditions: list) -> list:
+        """Returns the selectivity of each conjunction of conditions on a relation, each one being
+        a dict of attributes to operators."""
+        raise NotImplementedError
+
+    def calc_cached_filter_selectivities(self, rel_name: str, filters: list) -> list:
+        """Returns the selectivity of each filter on a relation.
+
+        Each filter is expanded into conjunctions, see phd.expression. The conjunctions of all the
+        filters are pooled so that each distinct one which is not cached is evaluated once.
+        """
+
+        expansions = [expression.expand(f) for f in filters]
+        keys = set(
+            cache.canonical_filter(conditions)
+            for terms in expansions
+            for _, conditions in terms
+        )
+        with instrument.span('cache_lookup', rel_name=rel_name, n_keys=len(keys)):
+            selectivities = {key: self.cache.get(rel_name, key) for key in keys}
+        selectivities[()] = 1
+
+        # Evaluate each distinct missing conjunction once
+        missing = {}
+        for terms in expansions:
+            for _, conditions in terms:
+                key = cache.canonical_filter(conditions)
+                if selectivities[key] is None:
+                    missing[key] = conditions
+        if missing:
+            computed = self.calc_filter_selectivities(rel_name, list(missing.values()))
+            for key, selectivity in zip(missing, computed):
+                self.cache.put(rel_name, key, selectivity)
+                selectivities[key] = selectivity
+
+        return [
+            expression.combine(terms, [
+                selectivities[cache.canonical_filter(conditions)]
+                for _, conditions in terms
+            ])
+            for terms in expansions
+        ]
+
+    def calc_cached_filter_selectivity(self, rel_name: str, f: str) -> float:
+        return self.calc_cached_filter_selectivities(rel_name, [f])[0]
+
+    def invalidate_cache(self, rel_name: str = None):
+        """Drops the cached selectivities of a relation, or of every relation if none is given."""
+        self.cache.invalidate(rel_name)
+
+    def cache_info(self) -> dict:
+        """Returns the number of cache hits and misses along with the size of the cache."""
+        return self.cache.info()
+
+    def calc_memory_usage(self) -> dict:
+        """Returns the number of bytes taken up by the model of each attribute of each relation,
+        the models of the joins being listed under the name of their join."""
+        raise NotImplementedError
+
+    def memory_report(self) -> dict:
+        """Returns the number of bytes taken up by each attribute of each relation, the sketches
+        of the join keys included."""
+
+        report = self.calc_memory_usage()
+        for rel_name, key_sketches in self.key_sketches.items():
+            usage = report.setdefault(rel_name, {})
+            for att, key_sketch in key_sketches.items():
+                usage[att] = usage.get(att, 0) + key_sketch.nbytes()
+
+        return report
+
+    def calc_memory_bytes(self) -> int:
+        """Returns the number of bytes taken up by the models, see memory_report."""
+        return sum(sum(usage.values()) for usage in self.memory_report().values())
+
+    def compress_models(self, min_mass: float):
+        """Compresses the distributions of the models, see phd.distribution.SparseArray."""
+        raise NotImplementedError
+
+    def fit_memory_budget(self):
+        """Compresses the models until they take up less than memory_budget bytes.
+
+        The cells of the distributions are merged with increasing thresholds, see MIN_MASSES. If
+        the models still don't fit then they are left as compressed as they can be.
+        """
+
+        if self.memory_budget is None:
+            return
+
+        for min_mass in MIN_MASSES:
+            if self.calc_memory_bytes() <= self.memory_budget:
+                return
+            self.compress_models(min_mass)
+            self.invalidate_cache()
+
+        nbytes = self.calc_memory_bytes()
+        if nbytes > self.memory_budget:
+            instrument.event('memory_budget_exceeded', budget=self.memory_budget, nbytes=nbytes)
+
+    def estimate_sql(self, query: str) -> float:
+        """Estimates the cardinality of a SELECT-FROM-WHERE query written in SQL.
+
+        The query is parsed once and then memoized, see phd.sql.
+        """
+        with instrument.span('parse', sql=True):
+            join_query, filter_query, relation_names = sql.parse(query)
+        return self.estimate_selectivity(join_query, filter_query, relation_names)
+
+    @instrument.profiled('estimate_many')
+    def estimate_many(self, queries) -> list:
+        """Estimates a batch of queries at once.
+
+        Args:
+            queries (iterable of tuples): each query is a (join_query, filter_query) pair, optionally
+                followed by the relation names to use for the cartesian product, or by a dict of
+                the aliases the queries refer to the relations by, see relation_aliases.
+        """
+
+        parsed = []
+        filters = defaultdict(set)
+        for join_query, filter_query, *relation_names in queries:
+            relationships, rel_filters, rel_names = self.parse_query(join_query, filter_query)
+            if relation_names and relation_names[0]:
+                rel_names = relation_names[0]
+            aliases = relation_aliases(rel_names)
+            joint_card, covered, relationships = self.calc_joint_card(relationships, rel_filters, aliases)
+            rel_names = [aliases[alias] for alias in aliases if alias not in covered]
+            # Each occurrence of a relation which appears more than once has a filter of its own
+            remaining = [
+                (aliases.get(alias, alias), f)
+                for alias, f in rel_filters.items()
+                if alias not in covered
+            ]
+            parsed.append((joint_card, relationships, rel_filters, remaining, rel_names, aliases))
+            for rel_name, f in remaining:
+                filters[rel_name].add(f)
+
+        # Evaluate the distinct filters of each relation in bulk, skipping the cached ones
+        selectivities = {}
+        for rel_name, rel_filters in filters.items():
+            rel_filters = list(rel_filters)
+            selectivities[rel_name] = dict(zip(
+                rel_filters,
+                self.calc_cached_filter_selectivities(rel_name, rel_filters)
+            ))
+
+        return [
+            joint_card *
+            self.calc_cartesian_prod_card(rel_names) *
+            self.calc_join_selectivity(relationships, rel_filters, aliases) *
+            functools.reduce(
+                operator.mul,
+                [selectivities[rel_name][f] for rel_name, f in remaining],
+                1
+            )
+            for joint_card, relationships, rel_filters, remaining, rel_names, aliases in parsed
+        ]
+
+
+def relation_aliases(relation_names) -> dict:
+    """Returns the relation name of each relation of a query, keyed by the name the join and
+    filter queries refer to it by.
+
+    The relations are referred to by their aliases if relation_names is a dict of aliases to
+    relation names, which is how phd.sql tells apart the occurrences of a relation which appears
+    more than once, and by their names otherwise.
+    """
+    if isinstance(relation_names, dict):
+        return dict(relation_names)
+    return {rel_name: rel_name for rel_name in relation_names}
+
+
+def join_name(fk: tuple) -> str:
+    """Returns the name of the join along a (rel_name, att, referenced rel_name, referenced att)
+    foreign key."""
+    return '{}.{}-{}.{}'.format(*fk)
+
+
+def normalize_types(rel: pd.DataFrame, att_types: dict) -> pd.DataFrame:
+    """Converts the dates to ISO formatted strings and strips the whitespace from strings."""
+
+    # Convert the datetimes to ISO formatted strings
+    for att, typ in att_types.items():
+        if typ == 'date' and att in rel and pd.api.types.is_datetime64_any_dtype(rel[att]):
+            rel[att] = tools.map_distinct(rel[att], lambda x: x.isoformat())
+
+    # Strip the whitespace from the string columns
+    for att in rel.columns:
+        if rel[att].dtype == 'object':
+            rel[att] = tools.rstrip(rel[att])
+
+    return rel
+
+
+def concat_chunks(chunks, att_types: dict) -> pd.DataFrame:
+    """Concatenates chunks of rows, which are possibly none at all."""
+    chunks = list(chunks)
+    if not chunks:
+        return pd.DataFrame(columns=list(att_types))
+    return pd.concat(chunks, ignore_index=True)
+
+
+def init_worker(uri):
+    """Opens the database connection of an Estimator.build_relations worker process."""
+    global worker_conn
+    worker_conn = sqlalchemy.create_engine(uri).connect()
+
+
+def build_in_worker(est: Estimator, rel_name: str, pilot_sample: tuple = None) -> tuple:
+    if pilot_sample is not None:
+        est.pilot_samples = {rel_name: pilot_sample}
+    model, duration = est.build_relation(worker_conn, rel_name)
+    return model, duration, os.getpid()
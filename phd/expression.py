@@ -0,0 +1,289 @@
+"""Boolean filters made up of predicates combined with and, or, not and parentheses.
+
+A filter is parsed once into a tree, which is memoized. The selectivity of a tree is a linear
+combination of the selectivities of conjunctions, which is what the estimators evaluate:
+
+    P(A or B) = P(A) + P(B) - P(A and B)
+    P(not A) = 1 - P(A)
+
+The expansion of a tree lists these conjunctions along with their coefficients. Disjunctions of
+predicates on the same attribute are first merged into a single operator, hence inclusion-exclusion
+is only needed across attributes, its number of terms growing exponentially with the number of
+attributes involved. The conjunctions of different filters often overlap, they can then share
+their evaluation and their cache entries.
+"""
+import collections
+import functools
+import itertools
+import re
+
+import numpy as np
+
+from . import cache
+from . import operator as op
+from . import tools
+
+
+Predicate = collections.namedtuple('Predicate', ['att', 'text'])
+And = collections.namedtuple('And', ['children'])
+Or = collections.namedtuple('Or', ['children'])
+Not = collections.namedtuple('Not', ['child'])
+
+
+KEYWORD = re.compile(r'(and|or|not)(?=[\s(])')
+CONNECTIVE = re.compile(r' +(and|or) ')
+
+
+def tokenize(f: str) -> list:
+    """Splits a filter into parentheses, connectives and predicates."""
+
+    tokens = []
+    i = 0
+    while i < len(f):
+        if f[i].isspace():
+            i += 1
+            continue
+        if f[i] in '()':
+            tokens.append(f[i])
+            i += 1
+            continue
+        keyword = KEYWORD.match(f, i)
+        if keyword:
+            tokens.append(keyword.group(1))
+            i = keyword.end()
+            continue
+
+        # A predicate ends with a connective or with a closing parenthesis, ignoring the ones
+        # within its operand
+        j, depth, quote = i, 0, None
+        while j < len(f):
+            c = f[j]
+            if quote:
+                if c == '\\':
+                    j += 1
+                elif c == quote:
+                    quote = None
+            elif c in '\'"':
+                quote = c
+            elif c in '([':
+                depth += 1
+            elif c in ')]':
+                if not depth:
+                    break
+                depth -= 1
+            elif not depth and CONNECTIVE.match(f, j):
+                break
+            j += 1
+        tokens.append(Predicate(*f[i:j].strip().split(' ', 1)))
+        i = j
+
+    return tokens
+
+
+@functools.lru_cache(maxsize=4096)
+def parse(f: str):
+    """Returns the tree of a filter, which is None if the filter is empty."""
+
+    tokens = tokenize(' '.join(f.split()))
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def accept(token) -> bool:
+        nonlocal position
+        if peek() == token:
+            position += 1
+            return True
+        return False
+
+    def parse_or():
+        children = [parse_and()]
+        while accept('or'):
+            children.append(parse_and())
+        return children[0] if len(children) == 1 else Or(tuple(children))
+
+    def parse_and():
+        children = [parse_not()]
+        while accept('and'):
+            children.append(parse_not())
+        return children[0] if len(children) == 1 else And(tuple(children))
+
+    def parse_not():
+        nonlocal position
+        if accept('not'):
+            return Not(parse_not())
+        if accept('('):
+            node = parse_or()
+            if not accept(')'):
+                raise ValueError('Unbalanced parentheses in filter "{}"'.format(f))
+            return node
+        token = peek()
+        if not isinstance(token, Predicate):
+            raise ValueError('Expected a predicate in filter "{}" but got {!r}'.format(f, token))
+        position += 1
+        return token
+
+    if not tokens:
+        return None
+    tree = parse_or()
+    if position < len(tokens):
+        raise ValueError('Unexpected {!r} in filter "{}"'.format(peek(), f))
+    return tree
+
+
+def to_string(node) -> str:
+    """Writes a tree back in the filter syntax."""
+
+    def wrap(child, types):
+        s = to_string(child)
+        return '({})'.format(s) if isinstance(child, types) else s
+
+    if isinstance(node, Predicate):
+        return '{} {}'.format(node.att, node.text)
+    if isinstance(node, And):
+        return ' and '.join(wrap(child, Or) for child in node.children)
+    if isinstance(node, Or):
+        return ' or '.join(wrap(child, And) for child in node.children)
+    return 'not {}'.format(wrap(node.child, (And, Or)))
+
+
+def conjuncts(node) -> list:
+    """Returns the members of the top-level conjunction of a tree."""
+    if node is None:
+        return []
+    if isinstance(node, And):
+        return [c for child in node.children for c in conjuncts(child)]
+    return [node]
+
+
+def predicates(node) -> list:
+    if isinstance(node, Predicate):
+        return [node]
+    children = node.children if isinstance(node, (And, Or)) else [node.child]
+    return [p for child in children for p in predicates(child)]
+
+
+def rename(node, rename_att):
+    """Returns a copy of a tree where each attribute is renamed."""
+    if isinstance(node, Predicate):
+        return Predicate(rename_att(node.att), node.text)
+    if isinstance(node, Not):
+        return Not(rename(node.child, rename_att))
+    return type(node)(tuple(rename(child, rename_att) for child in node.children))
+
+
+def to_operator(node: Predicate) -> op.Operator:
+    return tools.parse_predicate(to_string(node))[1]
+
+
+def multiply(a: list, b: list) -> list:
+    """Returns the expansion of the conjunction of two expansions."""
+
+    terms = []
+    for (coef_a, conditions_a), (coef_b, conditions_b) in itertools.product(a, b):
+        conditions = dict(conditions_a)
+        for att, operator in conditions_b.items():
+            conditions[att] = op.intersect(conditions[att], operator) if att in conditions else operator
+        terms.append((coef_a * coef_b, conditions))
+
+    return terms
+
+
+def simplify(terms: list) -> list:
+    """Sums the coefficients of identical conjunctions and drops the ones which cancel out."""
+
+    coefs = collections.OrderedDict()
+    conditions = {}
+    for coef, condition in terms:
+        key = cache.canonical_filter(condition)
+        coefs[key] = coefs.get(key, 0) + coef
+        conditions[key] = condition
+
+    return [(coef, conditions[key]) for key, coef in coefs.items() if coef]
+
+
+def expand_node(node) -> list:
+
+    if node is None:
+        return [(1, {})]
+
+    if isinstance(node, Predicate):
+        return [(1, {node.att: to_operator(node)})]
+
+    if isinstance(node, And):
+        return simplify(functools.reduce(multiply, [expand_node(child) for child in node.children]))
+
+    if isinstance(node, Not):
+
+        # Only the non-null values can fail to satisfy a predicate, as in SQL
+        if isinstance(node.child, Predicate) and node.child.text not in ('is null', 'is not null'):
+            return simplify([
+                (1, {node.child.att: op.IsNotNull()}),
+                (-1, {node.child.att: to_operator(node.child)})
+            ])
+
+        return simplify([(1, {})] + [(-coef, conditions) for coef, conditions in expand_node(node.child)])
+
+    # The members of a disjunction which are predicates on the same attribute are merged into a
+    # single operator
+    groups = collections.OrderedDict()
+    members = []
+    for child in node.children:
+        if isinstance(child, Predicate):
+            groups.setdefault(child.att, []).append(to_operator(child))
+        else:
+            members.append(expand_node(child))
+    members = [[(1, {att: op.union(operators)})] for att, operators in groups.items()] + members
+    if len(members) == 1:
+        return members[0]
+
+    # Inclusion-exclusion over the members of the disjunction
+    terms = []
+    for k in range(1, len(members) + 1):
+        for subset in itertools.combinations(members, k):
+            sign = 1 if k % 2 else -1
+            terms.extend(
+                (sign * coef, conditions)
+                for coef, conditions in functools.reduce(multiply, subset)
+            )
+
+    return simplify(terms)
+
+
+@functools.lru_cache(maxsize=4096)
+def expand(f: str) -> list:
+    """Returns the (coefficient, conditions) pairs whose weighted sum of selectivities is the
+    selectivity of a filter, the conditions mapping attributes to operators."""
+    return expand_node(parse(f))
+
+
+def canonical(f: str) -> tuple:
+    """Returns a hashable form of a filter which doesn't depend on how it is written."""
+    return tuple(sorted(
+        ((coef, cache.canonical_filter(conditions)) for coef, conditions in expand(f)),
+        key=str
+    ))
+
+
+def evaluate(node, calc_mask) -> np.ndarray:
+    """Returns the boolean mask of the rows which satisfy a tree, given a function which returns
+    the mask of an operator on an attribute."""
+
+    if isinstance(node, Predicate):
+        return calc_mask(node.att, to_operator(node))
+    if isinstance(node, And):
+        return np.logical_and.reduce([evaluate(child, calc_mask) for child in node.children])
+    if isinstance(node, Or):
+        return np.logical_or.reduce([evaluate(child, calc_mask) for child in node.children])
+
+    # Only the non-null values can fail to satisfy a predicate, as in SQL
+    mask = ~evaluate(node.child, calc_mask)
+    if isinstance(node.child, Predicate) and node.child.text not in ('is null', 'is not null'):
+        mask &= calc_mask(node.child.att, op.IsNotNull())
+    return mask
+
+
+def combine(terms: list, selectivities) -> float:
+    """Returns the selectivity of an expansion given the selectivity of each of its conjunctions."""
+    return min(max(sum(coef * p for (coef, _), p in zip(terms, selectivities)), 0), 1)
@@ -0,0 +1,178 @@
+"""Bitmap and sorted-column indexes over in-memory samples.
+
+Each column is factorized into codes which follow the order of the distinct values. The most common
+values get a packed bitmap each, while the rows of every value can be found in a single array of
+row numbers sorted by code, which is how ranges of values map to contiguous slices. A conjunctive
+filter is then evaluated as a few bitmap intersections and its selectivity is given by a popcount.
+"""
+import sys
+
+import numpy as np
+import pandas as pd
+
+from . import operator as op
+
+
+# Number of set bits of each byte
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(bitmap: np.ndarray) -> int:
+    """Returns the number of set bits of a packed bitmap."""
+    return int(POPCOUNT[bitmap].sum(dtype=np.int64))
+
+
+class ColumnIndex():
+    """Index of a single column.
+
+    Args:
+        series (pandas.Series): the values of the column.
+        n_bitmaps (int): the number of most common values which get a precomputed bitmap.
+    """
+
+    def __init__(self, series: pd.Series, n_bitmaps=64):
+
+        self.n_rows = len(series)
+
+        # The distinct values are sorted if they can be compared with each other
+        try:
+            codes, values = pd.factorize(series, sort=True)
+            self.sorted = True
+        except TypeError:
+            codes, values = pd.factorize(series)
+            self.sorted = False
+        self.values = values
+        self.codes = {value: code for code, value in enumerate(values)}
+
+        # Row numbers grouped by code, the nulls being left out
+        self.order = np.argsort(codes, kind='mergesort')
+        counts = np.bincount(codes[codes >= 0], minlength=len(values))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]) + np.count_nonzero(codes < 0)
+
+        # Precompute the bitmaps of the most common values
+        self.bitmaps = {
+            code: np.packbits(codes == code)
+            for code in np.argsort(-counts, kind='mergesort')[:n_bitmaps]
+        }
+
+    def __len__(self):
+        return self.n_rows
+
+    def nbytes(self) -> int:
+        return (
+            self.values.memory_usage(deep=True) + sys.getsizeof(self.codes) + self.order.nbytes + self.offsets.nbytes +
+            sum(bitmap.nbytes for bitmap in self.bitmaps.values())
+        )
+
+    def rows(self, code: int) -> np.ndarray:
+        """Returns the row numbers where a value occurs."""
+        return self.order[self.offsets[code]:self.offsets[code + 1]]
+
+    def range_codes(self, operator: op.Range) -> tuple:
+        """Returns the first code and the code after the last one of the values within a range."""
+        start, stop = 0, len(self.values)
+        if operator.low is not None:
+            side = 'left' if operator.low_closed else 'right'
+            start = int(np.searchsorted(self.values, operator.low, side=side))
+        if operator.high is not None:
+            side = 'right' if operator.high_closed else 'left'
+            stop = int(np.searchsorted(self.values, operator.high, side=side))
+        return start, max(start, stop)
+
+    def packbits(self, rows: np.ndarray) -> np.ndarray:
+        """Returns the packed bitmap of some row numbers."""
+        mask = np.zeros(self.n_rows, dtype=bool)
+        mask[rows] = True
+        return np.packbits(mask)
+
+    def lookup(self, operator: op.Operator):
+        """Returns the packed bitmap of the rows which satisfy an operator, or None if the operator
+        can't be resolved with the index."""
+
+        if isinstance(operator, op.Identity):
+            return np.packbits(np.ones(self.n_rows, dtype=bool))
+
+        if isinstance(operator, op.IsNull):
+            return self.packbits(self.order[:self.offsets[0]])
+
+        # The values within a range have contiguous codes, patterns are left to the fallback
+        if isinstance(operator, op.Range):
+            if not self.sorted or (isinstance(operator, op.Like) and not operator.is_prefix):
+                return None
+            try:
+                start, stop = self.range_codes(operator)
+            except (TypeError, ValueError):
+                return None
+            return self.packbits(self.order[self.offsets[start]:self.offsets[stop]])
+
+        if isinstance(operator, op.Equal):
+            operands = [operator.operand]
+        elif isinstance(operator, op.In):
+            operands = list(operator.iterable)
+        else:
+            return None
+
+        # Intervals are ranges of values rather than values
+        if any(isinstance(value, pd.Interval) for value in operands):
+            return None
+        codes = set(self.codes[value] for value in operands if value in self.codes)
+
+        if len(codes) == 1 and next(iter(codes)) in self.bitmaps:
+            return self.bitmaps[next(iter(codes))]
+
+        mask = np.zeros(self.n_rows, dtype=bool)
+        for code in codes:
+            mask[self.rows(code)] = True
+
+        return np.packbits(mask)
+
+
+class SampleIndex():
+    """Indexes of the columns of a sample.
+
+    Args:
+        rel (pandas.DataFrame): the sample, which is kept to evaluate the operators which the
+            column indexes can't resolve.
+        n_bitmaps (int): the number of most common values per column which get a bitmap.
+    """
+
+    def __init__(self, rel: pd.DataFrame, n_bitmaps=64):
+        self.rel = rel
+        self.columns = {att: ColumnIndex(rel[att], n_bitmaps) for att in rel.columns}
+
+    def __len__(self):
+        return len(self.rel)
+
+    def lookup(self, att: str, operator: op.Operator) -> np.ndarray:
+        """Returns the packed bitmap of the rows which satisfy an operator on an attribute."""
+        bitmap = self.columns[att].lookup(operator)
+        if bitmap is None:
+            bitmap = np.packbits(operator.calc_mask(self.rel[att]))
+        return bitmap
+
+    def bitmaps(self, conditions: list) -> list:
+        """Returns the packed bitmap of the rows which satisfy each set of conditions."""
+
+        # Look up each distinct predicate once
+        bitmaps = {}
+        for condition in conditions:
+            for att, operator in condition.items():
+                if (att, operator.key()) not in bitmaps:
+                    bitmaps[att, operator.key()] = self.lookup(att, operator)
+
+        full = np.packbits(np.ones(len(self), dtype=bool))
+
+        return [
+            np.bitwise_and.reduce([full] + [bitmaps[att, operator.key()] for att, operator in condition.items()])
+            for condition in conditions
+        ]
+
+    def mask(self, conditions: dict) -> np.ndarray:
+        """Returns a boolean mask of the rows which satisfy a set of conditions."""
+        return np.unpackbits(self.bitmaps([conditions])[0])[:len(self)].astype(bool)
+
+    def selectivities(self, conditions: list) -> list:
+        """Returns the fraction of rows which satisfy each set of conditions."""
+        if not len(self):
+            return [0] * len(conditions)
+        return [popcount(bitmap) / len(self) for bitmap in self.bitmaps(conditions)]
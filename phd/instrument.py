@@ -0,0 +1,311 @@
+"""Instrumentation of the hot paths of estimation and building.
+
+The code is instrumented with named spans, which time a block, with counters and with debug
+events. They are handed to the current recorder, which by default is a NullRecorder that drops
+them, hence a span then only costs a couple of function calls. A Recorder keeps them and exports
+them as JSON or in the Chrome trace format, which chrome://tracing and Perfetto can open:
+
+    with instrument.recording() as recorder:
+        est.estimate_many(queries)
+    recorder.to_chrome_trace('trace.json')
+
+The spans are parse, steiner_tree, subset, propagate, cache_lookup, sample_fetch, discretize,
+mutual_info and cpd_build, along with the steps of the build reported by build_from_engine. The
+counters are cache.hits and cache.misses. Only what happens in the current process is recorded,
+the work of the build_relations worker processes is not.
+
+Setting the PHD_PROFILE environment variable to cprofile or pyinstrument profiles the calls to the
+functions decorated with profiled, such as Estimator.estimate_many; each profile is written to
+the PHD_PROFILE_DIR directory, which is the working directory by default.
+"""
+from collections import Counter
+import contextlib
+import cProfile
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+
+class NullSpan():
+    """Span which doesn't measure anything."""
+
+    duration = 0.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span():
+    """Times a block, the duration is in seconds.
+
+    Args:
+        recorder (Recorder): the recorder the span is handed to once it ends, None means it is
+            only timed.
+        name (str)
+        attrs (dict): arbitrary attributes which are exported along with the span.
+    """
+
+    def __init__(self, recorder, name: str, attrs: dict):
+        self.recorder = recorder
+        self.name = name
+        self.attrs = attrs
+        self.start = None
+        self.duration = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration = time.perf_counter() - self.start
+        if self.recorder is not None:
+            self.recorder.add_span(self)
+        return False
+
+
+class NullRecorder():
+    """Default recorder, which drops everything."""
+
+    enabled = False
+
+    def span(self, name: str, **attrs):
+        return NULL_SPAN
+
+    def count(self, name: str, n=1):
+        pass
+
+    def event(self, name: str, **fields):
+        pass
+
+
+class Recorder():
+    """Keeps the spans, counters and events of the current process."""
+
+    enabled = True
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.counters = Counter()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def span(self, name: str, **attrs) -> Span:
+        return Span(self, name, attrs)
+
+    def add_span(self, span: Span):
+        with self.lock:
+            self.spans.append({
+                'name': span.name,
+                'ts': span.start - self.origin,
+                'dur': span.duration,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'attrs': span.attrs
+            })
+
+    def count(self, name: str, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def event(self, name: str, **fields):
+        with self.lock:
+            self.events.append({
+                'name': name,
+                'ts': time.perf_counter() - self.origin,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'fields': fields
+            })
+
+    def summary(self) -> dict:
+        """Returns the number of occurrences along with the total, mean and maximum duration of
+        each span."""
+
+        durations = {}
+        for span in self.spans:
+            durations.setdefault(span['name'], []).append(span['dur'])
+
+        return {
+            name: {
+                'count': len(d),
+                'total': sum(d),
+                'mean': sum(d) / len(d),
+                'max': max(d)
+            }
+            for name, d in durations.items()
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            'spans': self.spans,
+            'counters': dict(self.counters),
+            'events': self.events,
+            'summary': self.summary()
+        }
+
+    def to_json(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4, default=str)
+
+    def to_chrome_trace(self, path: str):
+        """Writes the spans as complete events and the events as instant events, the timestamps
+        being in microseconds."""
+
+        trace = [
+            {
+                'name': span['name'],
+                'ph': 'X',
+                'ts': span['ts'] * 1e6,
+                'dur': span['dur'] * 1e6,
+                'pid': span['pid'],
+                'tid': span['tid'],
+                'args': span['attrs']
+            }
+            for span in self.spans
+        ] + [
+            {
+                'name': event['name'],
+                'ph': 'i',
+                's': 't',
+                'ts': event['ts'] * 1e6,
+                'pid': event['pid'],
+                'tid': event['tid'],
+                'args': event['fields']
+            }
+            for event in self.events
+        ]
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'otherData': {'counters': dict(self.counters)}}, f, default=str)
+
+
+recorder = NullRecorder()
+
+
+def get_recorder():
+    return recorder
+
+
+def set_recorder(new_recorder):
+    """Replaces the current recorder, None restores the NullRecorder."""
+    global recorder
+    recorder = NullRecorder() if new_recorder is None else new_recorder
+
+
+@contextlib.contextmanager
+def recording(new_recorder=None):
+    """Records what happens within a block and restores the previous recorder afterwards."""
+
+    previous = recorder
+    new_recorder = Recorder() if new_recorder is None else new_recorder
+    set_recorder(new_recorder)
+    try:
+        yield new_recorder
+    finally:
+        set_recorder(previous)
+
+
+def span(name: str, **attrs):
+    """Returns a context manager which times a block if a recorder is enabled."""
+    if not recorder.enabled:
+        return NULL_SPAN
+    return recorder.span(name, **attrs)
+
+
+def timer(name: str, **attrs) -> Span:
+    """Counterpart of span which always measures the duration of the block, for the callers who
+    need it regardless of the recorder."""
+    return Span(recorder if recorder.enabled else None, name, attrs)
+
+
+def count(name: str, n=1):
+    if recorder.enabled:
+        recorder.count(name, n)
+
+
+def event(name: str, **fields):
+    """Records a structured debug event."""
+    if recorder.enabled:
+        recorder.event(name, **fields)
+
+
+# Profiles are numbered so that the calls of a process don't overwrite each other's profiles
+profile_ids = itertools.count()
+profiling = threading.local()
+
+
+@contextlib.contextmanager
+def profile(name: str, profiler: str = None):
+    """Profiles a block with cProfile or pyinstrument, see the module's docstring.
+
+    Nested blocks are profiled as part of the outermost one.
+
+    Raises:
+        ValueError: if the profiler is unknown.
+        ImportError: if pyinstrument is asked for but isn't installed.
+    """
+
+    profiler = profiler or os.environ.get('PHD_PROFILE')
+    if not profiler or getattr(profiling, 'active', False):
+        yield
+        return
+
+    directory = os.environ.get('PHD_PROFILE_DIR', '.')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '{}-{}-{}'.format(name, os.getpid(), next(profile_ids)))
+
+    if profiler == 'cprofile':
+        prof = cProfile.Profile()
+        start, stop = prof.enable, prof.disable
+    elif profiler == 'pyinstrument':
+        if pyinstrument is None:
+            raise ImportError('pyinstrument is not installed')
+        prof = pyinstrument.Profiler()
+        start, stop = prof.start, prof.stop
+    else:
+        raise ValueError('Unknown profiler {}, choose one of cprofile, pyinstrument'.format(profiler))
+
+    profiling.active = True
+    start()
+    try:
+        yield
+    finally:
+        stop()
+        profiling.active = False
+        if profiler == 'cprofile':
+            prof.dump_stats(path + '.prof')
+        else:
+            with open(path + '.html', 'w') as f:
+                f.write(prof.output_html())
+
+
+def profiled(name: str):
+    """Decorator which profiles each call of a function if PHD_PROFILE is set."""
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not os.environ.get('PHD_PROFILE'):
+                return func(*args, **kwargs)
+            with profile(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
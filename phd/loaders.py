@@ -0,0 +1,123 @@
+"""Backends which read the result of a query into DataFrame chunks.
+
+Each loader is a function which takes a SQLAlchemy connection, a SELECT query, the type of each
+attribute as reported by information_schema and a number of rows per chunk, and which yields
+DataFrames. The chunks are normalized by the estimator as they come.
+"""
+import tempfile
+
+import pandas as pd
+
+try:
+    import pyarrow.csv
+except ImportError:
+    pyarrow = None
+
+
+NULL = '\\N'
+STRING_TYPES = ('character', 'character varying', 'text')
+
+# Arrow types of the PostgreSQL types, the types of the other columns are inferred
+ARROW_TYPES = {
+    **{typ: 'string' for typ in STRING_TYPES},
+    'smallint': 'int64',
+    'integer': 'int64',
+    'bigint': 'int64',
+    'numeric': 'float64',
+    'real': 'float64',
+    'double precision': 'float64',
+    'boolean': 'bool_'
+}
+
+
+def read_sql(conn, query: str, att_types: dict, chunk_size: int):
+    """Reads the rows through a server-side cursor with pd.read_sql_query."""
+    date_atts = [att for att, typ in att_types.items() if typ == 'date']
+    yield from pd.read_sql_query(
+        sql=query,
+        con=conn.execution_options(stream_results=True),
+        parse_dates=date_atts,
+        chunksize=chunk_size
+    )
+
+
+def read_copy(conn, query: str, att_types: dict, chunk_size: int):
+    """Exports the rows with PostgreSQL's COPY and parses them without going through row objects.
+
+    The rows are spooled to a temporary file in CSV form by psycopg2's copy_expert, and then parsed
+    column by column, either by pandas' C parser or by Arrow if it is installed.
+    """
+
+    with tempfile.TemporaryFile() as f:
+
+        # Export the rows
+        cursor = conn.connection.cursor()
+        cursor.copy_expert(
+            "COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true, NULL '{}')".format(query, NULL),
+            f
+        )
+        cursor.close()
+        f.seek(0)
+
+        if pyarrow is not None:
+            yield from read_csv_arrow(f, att_types, chunk_size)
+            return
+
+        yield from pd.read_csv(
+            f,
+            dtype={att: object for att, typ in att_types.items() if typ in STRING_TYPES},
+            parse_dates=[att for att, typ in att_types.items() if typ == 'date'],
+            true_values=['t'],
+            false_values=['f'],
+            na_values=[NULL],
+            keep_default_na=False,
+            chunksize=chunk_size
+        )
+
+
+def read_csv_arrow(f, att_types: dict, chunk_size: int):
+    """Parses a COPY export with Arrow, which decodes straight into columnar buffers.
+
+    The export is read as a stream of record batches, which are turned into DataFrames of
+    chunk_size rows. The type of each column is set from information_schema when it is known,
+    since otherwise Arrow would infer it from the first batch alone.
+    """
+
+    reader = pyarrow.csv.open_csv(
+        f,
+        convert_options=pyarrow.csv.ConvertOptions(
+            column_types={
+                att: pyarrow.timestamp('s') if typ == 'date' else getattr(pyarrow, ARROW_TYPES[typ])()
+                for att, typ in att_types.items()
+                if typ in ARROW_TYPES or typ == 'date'
+            },
+            null_values=[NULL],
+            strings_can_be_null=True,
+            true_values=['t'],
+            false_values=['f']
+        )
+    )
+
+    # The batches are sliced at chunk_size rows, slices being views of the batches
+    batches = []
+    n_rows = 0
+    for batch in reader:
+        batches.append(batch)
+        n_rows += batch.num_rows
+        if n_rows < chunk_size:
+            continue
+        table = pyarrow.Table.from_batches(batches)
+        for start in range(0, n_rows - chunk_size + 1, chunk_size):
+            yield table.slice(start, chunk_size).to_pandas()
+        rest = n_rows % chunk_size
+        batches = table.slice(n_rows - rest).to_batches() if rest else []
+        n_rows = rest
+
+    if batches:
+        yield pyarrow.Table.from_batches(batches).to_pandas()
+
+
+LOADERS = {
+    'sql': read_sql,
+    'copy': read_copy
+}
@@ -1,5 +1,7 @@
+import re
 from typing import Iterable
 
+import numpy as np
 import pandas as pd
 
 from phd import tools
@@ -7,6 +9,10 @@ from phd import tools
 
 class Operator():
 
+    # Whether the operator matches ranges of values, in which case the most common values and the
+    # intervals it overlaps are all relevant, instead of the intervals being a fallback
+    is_range = False
+
     def __init__(self, operand):
         self.operand = operand
 
@@ -16,6 +22,14 @@ class Operator():
     def keep_relevant(self, values):
         return NotImplementedError
 
+    def calc_mask(self, values: pd.Series) -> np.ndarray:
+        """Returns a boolean mask indicating which values satisfy the operator."""
+        raise NotImplementedError
+
+    def key(self) -> tuple:
+        """Returns a hashable representation of the operator which doesn't depend on ordering."""
+        raise NotImplementedError
+
     def __str__(self) -> str:
         raise NotImplementedError
 
@@ -34,6 +48,12 @@ class Identity(Operator):
     def keep_relevant(self, values):
         return set(values)
 
+    def calc_mask(self, values: pd.Series) -> np.ndarray:
+        return np.ones(len(values), dtype=bool)
+
+    def key(self) -> tuple:
+        return ('1',)
+
     def __str__(self) -> str:
         return '1'
 
@@ -56,6 +76,12 @@ class Equal(Operator):
             if isinstance(v, pd.Interval) and self.operand in v
         )
 
+    def calc_mask(self, values: pd.Series) -> np.ndarray:
+        return values.isin([self.operand]).values
+
+    def key(self) -> tuple:
+        return ('==', self.operand)
+
     def __str__(self) -> str:
         return 'x == {}'.format(self.operand)
 
@@ -79,5 +105,288 @@ class In(Operator):
             and self.calc_coverage(v, 2) > 0
         )
 
+    def calc_mask(self, values: pd.Series) -> np.ndarray:
+        return values.isin(list(self.iterable)).values
+
+    def key(self) -> tuple:
+        return ('in', frozenset(self.iterable))
+
     def __str__(self) -> str:
         return 'x in {}'.format(self.iterable)
+
+
+class Range(Operator):
+    """Values between two bounds, a bound of None meaning there is none. Nulls never match."""
+
+    is_range = True
+
+    def __init__(self, low=None, high=None, low_closed=True, high_closed=True):
+        self.low = low
+        self.high = high
+        self.low_closed = low_closed
+        self.high_closed = high_closed
+
+    def contains(self, value) -> bool:
+        if value is None or value != value:
+            return False
+        try:
+            if self.low is not None and (value < self.low or (value == self.low and not self.low_closed)):
+                return False
+            if self.high is not None and (value > self.high or (value == self.high and not self.high_closed)):
+                return False
+        except TypeError:
+            return False
+        return True
+
+    def overlaps(self, interval: pd.Interval) -> bool:
+        try:
+            if self.low is not None and (interval.right < self.low or
+                                         (interval.right == self.low and not self.low_closed)):
+                return False
+            if self.high is not None and (interval.left > self.high or
+                                          (interval.left == self.high and not self.high_closed)):
+                return False
+        except TypeError:
+            return False
+        return True
+
+    def intersect(self, other: 'Range') -> 'Range':
+        """Returns the range of the values which are within both ranges."""
+
+        low, low_closed = self.low, self.low_closed
+        if other.low is not None and (low is None or other.low > low):
+            low, low_closed = other.low, other.low_closed
+        elif other.low is not None and other.low == low:
+            low_closed = low_closed and other.low_closed
+
+        high, high_closed = self.high, self.high_closed
+        if other.high is not None and (high is None or other.high < high):
+            high, high_closed = other.high, other.high_closed
+        elif other.high is not None and other.high == high:
+            high_closed = high_closed and other.high_closed
+
+        return Range(low, high, low_closed, high_closed)
+
+    def calc_coverage(self, interval: pd.Interval, n_values: int):
+        """Returns the fraction of an interval which is within the bounds.
+
+        Numeric intervals are assumed to be uniform. String intervals are either fully covered or
+        assumed to be half covered if they straddle a bound.
+        """
+
+        if not self.overlaps(interval):
+            return 0
+
+        low = interval.left if self.low is None else max(interval.left, self.low)
+        high = interval.right if self.high is None else min(interval.right, self.high)
+
+        if isinstance(interval.left, str):
+            return 1 if (low, high) == (interval.left, interval.right) else 0.5
+        if interval.right == interval.left:
+            return 1
+        return max(high - low, 0) / (interval.right - interval.left)
+
+    def keep_relevant(self, values):
+        return set(
+            v for v in values
+            if (self.overlaps(v) if isinstance(v, pd.Interval) else self.contains(v))
+        )
+
+    def calc_mask(self, values: pd.Series) -> np.ndarray:
+        try:
+            mask = values.notnull()
+            if self.low is not None:
+                mask &= values >= self.low if self.low_closed else values > self.low
+            if self.high is not None:
+                mask &= values <= self.high if self.high_closed else values < self.high
+            return mask.values
+        except TypeError:
+            return np.array([self.contains(v) for v in values], dtype=bool)
+
+    def key(self) -> tuple:
+        return ('range', self.low, self.high, self.low_closed, self.high_closed)
+
+    def __str__(self) -> str:
+        return 'x in {}{}, {}{}'.format(
+            '[' if self.low_closed else '(',
+            self.low,
+            self.high,
+            ']' if self.high_closed else ')'
+        )
+
+
+class IsNotNull(Range):
+
+    def __init__(self):
+        super().__init__()
+
+    def key(self) -> tuple:
+        return ('is not null',)
+
+    def __str__(self) -> str:
+        return 'x is not null'
+
+
+class IsNull(Operator):
+
+    def __init__(self):
+        self.operand = None
+
+    def calc_coverage(self, interval: pd.Interval, n_values: int):
+        return 0
+
+    def keep_relevant(self, values):
+        return set(v for v in values if v is None)
+
+    def calc_mask(self, values: pd.Series) -> np.ndarray:
+        return values.isnull().values
+
+    def key(self) -> tuple:
+        return ('is null',)
+
+    def __str__(self) -> str:
+        return 'x is null'
+
+
+class Like(Range):
+    """SQL LIKE pattern, where % matches any string and _ matches any character.
+
+    The strings which match a pattern lie between its prefix and the next prefix, which is what
+    the bounds of the range are. Only the most common values are matched against the whole
+    pattern, the intervals within the bounds are assumed to match in a proportion of
+    PATTERN_COVERAGE if the pattern is more than a prefix.
+    """
+
+    PATTERN_COVERAGE = 0.1
+
+    def __init__(self, pattern: str):
+        self.operand = pattern
+        self.regex = re.compile(''.join(
+            '.*' if c == '%' else '.' if c == '_' else re.escape(c)
+            for c in pattern
+        ) + '$', re.DOTALL)
+        prefix = re.split('[%_]', pattern, maxsplit=1)[0]
+        self.is_prefix = pattern in (prefix, prefix + '%')
+
+        # A pattern without wildcards is an equality
+        if pattern == prefix:
+            super().__init__(low=prefix, high=prefix)
+            return
+
+        super().__init__(
+            low=prefix or None,
+            high=prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else None,
+            low_closed=True,
+            high_closed=False
+        )
+
+    def contains(self, value) -> bool:
+        return isinstance(value, str) and self.regex.match(value) is not None
+
+    def calc_coverage(self, interval: pd.Interval, n_values: int):
+        coverage = super().calc_coverage(interval, n_values)
+        return coverage if self.is_prefix else coverage * self.PATTERN_COVERAGE
+
+    def calc_mask(self, values: pd.Series) -> np.ndarray:
+        if self.is_prefix:
+            return super().calc_mask(values)
+        return np.array([self.contains(v) for v in values], dtype=bool)
+
+    def key(self) -> tuple:
+        return ('like', self.operand)
+
+    def __str__(self) -> str:
+        return 'x like {!r}'.format(self.operand)
+
+
+class Intersection(Operator):
+    """Values which satisfy each of several operators."""
+
+    def __init__(self, operators: list):
+        self.operators = list(operators)
+        self.is_range = all(operator.is_range for operator in self.operators)
+
+    def calc_coverage(self, interval: pd.Interval, n_values: int):
+        return min(operator.calc_coverage(interval, n_values) for operator in self.operators)
+
+    def keep_relevant(self, values):
+        return set.intersection(*[set(operator.keep_relevant(values)) for operator in self.operators])
+
+    def calc_mask(self, values: pd.Series) -> np.ndarray:
+        return np.logical_and.reduce([operator.calc_mask(values) for operator in self.operators])
+
+    def key(self) -> tuple:
+        return ('and', frozenset(operator.key() for operator in self.operators))
+
+    def __str__(self) -> str:
+        return ' and '.join(str(operator) for operator in self.operators)
+
+
+class Union(Operator):
+    """Values which satisfy any of several operators."""
+
+    def __init__(self, operators: list):
+        self.operators = list(operators)
+        self.is_range = any(operator.is_range for operator in self.operators)
+
+    def calc_coverage(self, interval: pd.Interval, n_values: int):
+        return min(sum(operator.calc_coverage(interval, n_values) for operator in self.operators), 1)
+
+    def keep_relevant(self, values):
+        return set.union(*[set(operator.keep_relevant(values)) for operator in self.operators])
+
+    def calc_mask(self, values: pd.Series) -> np.ndarray:
+        return np.logical_or.reduce([operator.calc_mask(values) for operator in self.operators])
+
+    def key(self) -> tuple:
+        return ('or', frozenset(operator.key() for operator in self.operators))
+
+    def __str__(self) -> str:
+        return ' or '.join(str(operator) for operator in self.operators)
+
+
+def values_of(operator: Operator):
+    """Returns the values an Equal or an In operator matches, or None for other operators."""
+    if isinstance(operator, Equal):
+        return [operator.operand]
+    if isinstance(operator, In):
+        return list(operator.iterable)
+    return None
+
+
+def intersect(a: Operator, b: Operator) -> Operator:
+    """Returns an operator which matches the values that satisfy both operators."""
+
+    if isinstance(a, Identity):
+        return b
+    if isinstance(b, Identity) or a.key() == b.key():
+        return a
+
+    if type(a) is Range and type(b) is Range:
+        return a.intersect(b)
+
+    # Lists of values are filtered with the other operator
+    if values_of(a) is None:
+        a, b = b, a
+    values = values_of(a)
+    if values is not None and not any(isinstance(v, pd.Interval) for v in values):
+        mask = b.calc_mask(pd.Series(values, dtype=object))
+        return In([v for v, keep in zip(values, mask) if keep])
+
+    return Intersection([a, b])
+
+
+def union(operators: list) -> Operator:
+    """Returns an operator which matches the values that satisfy any of the operators."""
+
+    if any(isinstance(operator, Identity) for operator in operators):
+        return Identity()
+    if len(operators) == 1:
+        return operators[0]
+
+    # Lists of values are merged into a single one
+    values = [values_of(operator) for operator in operators]
+    if all(v is not None for v in values):
+        return In(sorted(set(v for vs in values for v in vs), key=str))
+
+    return Union(operators)
@@ -1,15 +1,27 @@
+import collections
+import os
 import random
-import time
 
+import numpy as np
 import pandas as pd
 import sqlalchemy
 
+from phd import cache
+from phd import expression
+from phd import index
+from phd import instrument
+from phd import store
 from phd.estimator import Estimator
+from phd.estimator import join_name
+from phd.estimator import relation_aliases
 
 
 class SamplingEstimator(Estimator):
 
-    def __init__(self, sampling_ratio=0.1, block_sampling=True, min_rows=10000, seed=None):
+    def __init__(self, sampling_ratio=0.1, block_sampling=True, min_rows=10000, seed=None, n_jobs=1,
+                 cache_size=1024, chunk_size=100000, loader='sql', sketch_size=100, fk_joins=False,
+                 n_bitmaps=64, adaptive=False, sampling_tolerance=0.02, sample_budget=None,
+                 time_budget=None):
 
         super().__init__()
 
@@ -17,70 +29,188 @@ class SamplingEstimator(Estimator):
         self.min_rows = min_rows
         self.block_sampling = block_sampling
         self.seed = seed if seed else random.randint(0, 2 ** 32)
+        self.n_jobs = n_jobs
+        self.cache_size = cache_size
+        self.cache = cache.SelectivityCache(cache_size)
+        self.chunk_size = chunk_size
+        self.loader = loader
+        self.sketch_size = sketch_size
+        self.fk_joins = fk_joins
+        self.n_bitmaps = n_bitmaps
+        self.adaptive = adaptive
+        self.sampling_tolerance = sampling_tolerance
+        self.sample_budget = sample_budget
+        self.time_budget = time_budget
         self.bayes_nets = None
+        self.synopses = {}
+        self.indexes = {}
 
     def build_from_engine(self, engine: sqlalchemy.engine.base.Engine) -> dict:
 
         self.setup(engine)
 
-        # Create a connection to the database
-        conn = engine.connect()
-
-        # Record the time spent
-        duration = {
-            'querying': {},
-        }
-
         # Sample each relation
-        self.relations = {}
-        sampling_method = {True: 'SYSTEM', False: 'BERNOULLI'}[self.block_sampling]
-        for rel_name in self.rel_names:
-
-            # Sample the relation if the number of rows is high enough
-            query = 'SELECT * FROM {}'.format(rel_name)
-            # Add a sampling statement if the sampling ratio is lower than 1
-            sampling_ratio = max(self.sampling_ratio, self.min_rows / self.rel_cards[rel_name])
-            if sampling_ratio < 1:
-                # Make sure there won't be less samples then the minimum number of allowed rows
-                query += ' TABLESAMPLE {} ({}) REPEATABLE ({})'.format(
-                    sampling_method,
-                    sampling_ratio * 100,
-                    self.seed
-                )
-            date_atts = [att for att, typ in self.att_types[rel_name].items() if typ == 'date']
-            tic = time.time()
-            rel = pd.read_sql_query(sql=query, con=conn, parse_dates=date_atts)
-            duration['querying'][rel_name] = time.time() - tic
-
-            # Convert the datetimes to ISO formatted strings
-            for att in date_atts:
-                rel[att] = rel[att].map(lambda x: x.isoformat())
-
-            # Strip the whitespace from the string columns
-            for att in rel.columns:
-                if rel[att].dtype == 'object':
-                    rel[att] = rel[att].str.rstrip()
-
-            # Store the relation
-            self.relations[rel_name] = rel
-
-        # Close the connection to the database
-        conn.close()
+        models, duration = self.build_relations(engine)
+        self.relations = {rel_name: rel for rel_name, (rel, _, _) in models.items()}
+        self.key_sketches = {rel_name: key_sketches for rel_name, (_, key_sketches, _) in models.items()}
+        self.indexes = {rel_name: rel_index for rel_name, (_, _, rel_index) in models.items()}
+
+        # Sample the join along each foreign key, the sampled rows of the referencing relation
+        # come with the row they reference
+        self.synopses = {}
+        self.join_cards = {}
+        if self.fk_joins:
+            models, duration['joins'] = self.build_joins(engine)
+            # The synopses are indexed alongside the relations, under their foreign key
+            for fk, (synopsis_index, card) in models.items():
+                self.synopses[fk] = synopsis_index.rel
+                self.indexes[fk] = synopsis_index
+                self.join_cards[fk] = card
 
         return duration
 
+    def build_relation(self, conn, rel_name: str) -> tuple:
+        duration = {}
+
+        with instrument.timer('querying', rel_name=rel_name) as timer:
+            rel = self.fetch_sample(conn, rel_name)
+        duration['querying'] = timer.duration
+
+        with instrument.timer('sketches', rel_name=rel_name) as timer:
+            key_sketches = self.build_key_sketches(rel_name, rel)
+        duration['sketches'] = timer.duration
+
+        with instrument.timer('indexing', rel_name=rel_name) as timer:
+            rel_index = index.SampleIndex(rel, n_bitmaps=self.n_bitmaps)
+        duration['indexing'] = timer.duration
+
+        return (rel, key_sketches, rel_index), duration
+
+    def build_join(self, conn, fk: tuple) -> tuple:
+        synopsis, card = self.fetch_join_sample(conn, fk)
+        if synopsis is None:
+            return None, 0
+        return index.SampleIndex(synopsis, n_bitmaps=self.n_bitmaps), card
+
     def estimate_selectivity(self, join_query: str, filter_query: str, relation_names=None):
 
         relationships, filters, rel_names = self.parse_query(join_query, filter_query)
+        aliases = relation_aliases(relation_names if relation_names else rel_names)
+
+        # The joins which have a synopsis are estimated along with their filters
+        joint_card, covered, relationships = self.calc_joint_card(relationships, filters, aliases)
 
-        cartesian_prod_card = self.calc_cartesian_prod_card(relation_names if relation_names else rel_names)
-        join_selectivity = self.calc_join_selectivity(relationships)
+        cartesian_prod_card = self.calc_cartesian_prod_card([
+            rel_name for alias, rel_name in aliases.items() if alias not in covered
+        ])
+        join_selectivity = self.calc_join_selectivity(relationships, filters, aliases)
 
         attribute_selectivity = 1
-        for rel_name, f in filters.items():
-            rel = self.relations[rel_name]
-            p = len(rel.query(f)) / len(rel)
-            print(rel_name, p)
+        for alias, f in filters.items():
+            if alias in covered:
+                continue
+            rel_name = aliases.get(alias, alias)
+            p = self.calc_cached_filter_selectivity(rel_name, f)
+            instrument.event('filter_selectivity', rel_name=rel_name, selectivity=p)
             attribute_selectivity *= p
 
-        return cartesian_prod_card * join_selectivity * attribute_selectivity
+        return joint_card * cartesian_prod_card * join_selectivity * attribute_selectivity
+
+    def calc_filter_selectivities(self, rel_name: str, conditions: list) -> list:
+        return self.indexes[rel_name].selectivities(conditions)
+
+    def calc_joint_selectivity(self, fk: tuple, conditions: dict) -> float:
+        return self.indexes[fk].selectivities([conditions])[0]
+
+    def calc_key_sketch(self, rel_name: str, att: str, f: str) -> tuple:
+        """Conditions the sketch of a join key on a filter by counting the most common values of
+        the key amongst the sampled rows which satisfy the filter."""
+
+        rel = self.relations[rel_name]
+        key_sketch = self.key_sketches[rel_name][att]
+        if att not in rel or not len(rel):
+            return super().calc_key_sketch(rel_name, att, f)
+
+        index = self.indexes[rel_name]
+        mask = expression.evaluate(
+            expression.parse(f),
+            lambda att, operator: index.mask({att: operator})
+        )
+        n_matches = np.count_nonzero(mask)
+        if not n_matches:
+            return key_sketch.condition(np.zeros(len(key_sketch)), 0), 0
+
+        value_counts = rel[att][mask].value_counts()
+        probs = np.array([value_counts.get(value, 0) for value in key_sketch.values]) / n_matches
+        p = n_matches / len(rel)
+
+        return key_sketch.condition(probs, p), p
+
+    def calc_memory_usage(self) -> dict:
+
+        def sample_usage(rel: pd.DataFrame, rel_index: index.SampleIndex) -> dict:
+            return {
+                att: int(rel[att].memory_usage(index=False, deep=True)) + rel_index.columns[att].nbytes()
+                for att in rel.columns
+            }
+
+        usage = {rel_name: sample_usage(rel, self.indexes[rel_name]) for rel_name, rel in self.relations.items()}
+        for fk, synopsis in self.synopses.items():
+            usage[join_name(fk)] = sample_usage(synopsis, self.indexes[fk])
+        return usage
+
+    def save_model(self, path: str) -> dict:
+
+        meta = {'relations': {}, 'joins': []}
+
+        for rel_name, rel in self.relations.items():
+            meta['relations'][rel_name] = save_sample(os.path.join(path, rel_name), rel)
+
+        for fk, synopsis in self.synopses.items():
+            meta['joins'].append({
+                'foreign_key': list(fk),
+                'card': float(self.join_cards[fk]),
+                'columns': save_sample(os.path.join(path, 'joins', join_name(fk)), synopsis)
+            })
+
+        return meta
+
+    def load_model(self, path: str, meta: dict, mmap_mode):
+        self.relations = {
+            rel_name: load_sample(os.path.join(path, rel_name), columns, mmap_mode)
+            for rel_name, columns in meta['relations'].items()
+        }
+        self.synopses = {}
+        self.join_cards = {}
+        for join_meta in meta['joins']:
+            fk = tuple(join_meta['foreign_key'])
+            self.synopses[fk] = load_sample(
+                os.path.join(path, 'joins', join_name(fk)),
+                join_meta['columns'],
+                mmap_mode
+            )
+            self.join_cards[fk] = join_meta['card']
+
+        # The indexes are cheaper to rebuild than to store
+        self.indexes = {
+            rel_name: index.SampleIndex(rel, n_bitmaps=self.n_bitmaps)
+            for rel_name, rel in self.relations.items()
+        }
+        for fk, synopsis in self.synopses.items():
+            self.indexes[fk] = index.SampleIndex(synopsis, n_bitmaps=self.n_bitmaps)
+
+
+def save_sample(path: str, rel: pd.DataFrame) -> list:
+    """Saves each column of a sample and returns the name and the metadata of each column."""
+    os.makedirs(path, exist_ok=True)
+    return [
+        (att, store.save_column(path, 'column-{}'.format(i), rel[att]))
+        for i, att in enumerate(rel.columns)
+    ]
+
+
+def load_sample(path: str, columns: list, mmap_mode) -> pd.DataFrame:
+    return pd.DataFrame(collections.OrderedDict(
+        (att, store.load_column(path, column, mmap_mode))
+        for att, column in columns
+    ))
@@ -0,0 +1,384 @@
+"""Long-lived estimation service.
+
+Persisted estimators are loaded once and answer cardinality requests from concurrent clients,
+such as a planner plugin or a benchmark, over TCP or a Unix socket. The front end runs on asyncio
+and speaks two protocols on the same socket:
+
+- HTTP/1.1: a POST to /estimate with a JSON body, or a msgpack one if the Content-Type is
+  application/msgpack and msgpack is installed. GET /models lists the loaded models.
+- Newline-delimited JSON: each line is a request and gets a line in response.
+
+A request is a dict with the name of a model, which can be left out if a single one is loaded, and
+a list of queries. Each query is either a dict with a "sql" key, a dict with "join_query",
+"filter_query" and optionally "relation_names" keys, or a [join_query, filter_query] list. The
+response holds the estimated cardinality of each query under the "estimates" key, or an error
+message under the "error" key. The queries of a request fail independently: the estimate of a
+query which failed is null and its error message is under its position in an "error" dict.
+
+The requests for the same model which arrive within batch_window seconds of each other are
+merged into a single call to Estimator.estimate_many, which evaluates the distinct filters of a
+batch in a single vectorized pass. The batches run on a pool of worker processes which each load
+the models; the arrays are memory-mapped, hence the workers share the pages of a model.
+"""
+import asyncio
+from concurrent import futures
+import http.client
+import json
+import os
+import socket
+
+from phd import sql
+from phd import store
+from phd.bn.estimator import BayesianNetworkEstimator
+from phd.sampling.estimator import SamplingEstimator
+from phd.textbook.estimator import TextbookEstimator
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+ESTIMATORS = {
+    cls.__name__: cls
+    for cls in (BayesianNetworkEstimator, SamplingEstimator, TextbookEstimator)
+}
+JSON_TYPE = 'application/json'
+MSGPACK_TYPE = 'application/msgpack'
+
+
+def load_estimator(path: str):
+    """Loads a saved estimator whatever its class."""
+    return ESTIMATORS[store.read_meta(path)['estimator']].load(path)
+
+
+def load_models(paths: list) -> dict:
+    """Loads saved estimators, each one being named after its directory."""
+    return {os.path.basename(os.path.normpath(path)): load_estimator(path) for path in paths}
+
+
+def to_query(query) -> tuple:
+    """Returns the (join_query, filter_query, relation_names) tuple of a query of a request.
+
+    Raises:
+        ValueError: if the query is malformed.
+    """
+
+    if isinstance(query, (list, tuple)) and 1 <= len(query) <= 3:
+        return tuple(query) + (None,) * (3 - len(query))
+    if not isinstance(query, dict):
+        raise ValueError('A query is a dict or a [join_query, filter_query] list, not {!r}'.format(query))
+    if 'sql' in query:
+        return tuple(sql.parse(query['sql']))
+    return (
+        query.get('join_query', ''),
+        query.get('filter_query', ''),
+        query.get('relation_names')
+    )
+
+
+def estimate(models: dict, name: str, queries: list) -> list:
+    """Estimates a batch of queries with one of the models.
+
+    If the batch fails as a whole then each query is estimated on its own, hence a bad query
+    only fails itself; the estimate of such a query is the exception.
+    """
+
+    est = models[name]
+    try:
+        return [float(e) for e in est.estimate_many([to_query(query) for query in queries])]
+    except Exception:
+        pass
+
+    estimates = []
+    for query in queries:
+        try:
+            estimates.append(float(est.estimate_many([to_query(query)])[0]))
+        except Exception as e:
+            estimates.append(e)
+    return estimates
+
+
+# Models of a worker process, which are loaded on its first batch
+worker_models = None
+
+
+def estimate_in_worker(paths: list, name: str, queries: list) -> list:
+    global worker_models
+    if worker_models is None:
+        worker_models = load_models(paths)
+    return estimate(worker_models, name, queries)
+
+
+class Batcher():
+    """Merges the requests which arrive within a time window into batches.
+
+    Args:
+        run (coroutine function): estimates a list of queries with a model, given the name of the
+            model and the queries.
+        window (float): the number of seconds a request waits for others to join its batch.
+        max_size (int): the number of queries which triggers a batch right away.
+    """
+
+    def __init__(self, run, window=0.002, max_size=1024):
+        self.run = run
+        self.window = window
+        self.max_size = max_size
+        self.pending = {}
+        self.timers = {}
+
+    async def submit(self, name: str, queries: list) -> list:
+        """Returns the estimate of each query once its batch has run."""
+
+        future = asyncio.get_event_loop().create_future()
+        pending = self.pending.setdefault(name, [])
+        pending.append((queries, future))
+
+        if sum(len(queries) for queries, _ in pending) >= self.max_size:
+            self.flush(name)
+        elif name not in self.timers:
+            self.timers[name] = asyncio.get_event_loop().call_later(self.window, self.flush, name)
+
+        return await future
+
+    def flush(self, name: str):
+        timer = self.timers.pop(name, None)
+        if timer:
+            timer.cancel()
+        batch = self.pending.pop(name, [])
+        if batch:
+            asyncio.ensure_future(self.run_batch(name, batch))
+
+    async def run_batch(self, name: str, batch: list):
+
+        try:
+            estimates = await self.run(name, [query for queries, _ in batch for query in queries])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        # Hand each request its share of the estimates
+        start = 0
+        for queries, future in batch:
+            future.set_result(estimates[start:start + len(queries)])
+            start += len(queries)
+
+
+class Server():
+    """Estimation service, see the module's docstring.
+
+    Args:
+        paths (list): the directories the estimators were saved to.
+        n_workers (int): the number of worker processes, 0 means the batches run in a thread of
+            the server's process.
+        batch_window (float): see Batcher.
+        max_batch_size (int): see Batcher.
+    """
+
+    def __init__(self, paths: list, n_workers=4, batch_window=0.002, max_batch_size=1024):
+        self.paths = list(paths)
+        self.models = load_models(self.paths)
+        self.n_workers = n_workers
+        if n_workers:
+            self.executor = futures.ProcessPoolExecutor(n_workers)
+        else:
+            self.executor = futures.ThreadPoolExecutor(1)
+        self.batcher = Batcher(self.run, window=batch_window, max_size=max_batch_size)
+
+    async def run(self, name: str, queries: list) -> list:
+        loop = asyncio.get_event_loop()
+        if self.n_workers:
+            return await loop.run_in_executor(self.executor, estimate_in_worker, self.paths, name, queries)
+        return await loop.run_in_executor(self.executor, estimate, self.models, name, queries)
+
+    async def handle_request(self, request) -> dict:
+        """Returns the response to a decoded request."""
+
+        if not isinstance(request, dict) or not isinstance(request.get('queries'), list):
+            return {'error': 'A request is a dict with a list of queries'}
+
+        name = request.get('model')
+        if name is None and len(self.models) == 1:
+            name = next(iter(self.models))
+        if name not in self.models:
+            return {'error': 'Unknown model {!r}, the models are {}'.format(name, sorted(self.models))}
+
+        try:
+            estimates = await self.batcher.submit(name, request['queries'])
+        except Exception as e:
+            return {'error': '{}: {}'.format(type(e).__name__, e)}
+
+        errors = {i: '{}: {}'.format(type(e).__name__, e) for i, e in enumerate(estimates) if isinstance(e, Exception)}
+        if errors:
+            return {'error': errors, 'estimates': [None if i in errors else e for i, e in enumerate(estimates)]}
+        return {'estimates': estimates}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.lstrip().startswith(b'{'):
+                    try:
+                        request = decode(line, JSON_TYPE)
+                    except ValueError as e:
+                        response = {'error': str(e)}
+                    else:
+                        response = await self.handle_request(request)
+                    writer.write(json.dumps(response).encode() + b'\n')
+                elif not await self.handle_http(line, reader, writer):
+                    break
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_http(self, request_line: bytes, reader: asyncio.StreamReader,
+                          writer: asyncio.StreamWriter) -> bool:
+        """Answers an HTTP request and returns whether the connection is kept alive."""
+
+        try:
+            method, path, version = request_line.decode().split()
+        except ValueError:
+            return False
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode().strip()
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        content_type = headers.get('content-type', JSON_TYPE).split(';')[0]
+        keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+
+        try:
+            content_length = int(headers.get('content-length', 0))
+        except ValueError:
+            content_length = -1
+
+        if content_length < 0:
+            # The end of the body is unknown, hence the connection can't be reused
+            status, response = 400, {'error': 'Invalid Content-Length {!r}'.format(headers['content-length'])}
+            keep_alive = False
+        else:
+            body = await reader.readexactly(content_length)
+            status, response = await self.route(method, path, body, content_type)
+
+        if content_type != MSGPACK_TYPE:
+            content_type = JSON_TYPE
+        payload = encode(response, content_type)
+        writer.write(
+            '{} {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                version, status, http.client.responses[status], content_type, len(payload),
+                'keep-alive' if keep_alive else 'close'
+            ).encode() + payload
+        )
+
+        return keep_alive
+
+    async def route(self, method: str, path: str, body: bytes, content_type: str) -> tuple:
+        """Returns the status and the response of an HTTP request."""
+
+        if method == 'GET' and path == '/models':
+            return 200, {'models': sorted(self.models)}
+
+        if method == 'POST' and path == '/estimate':
+            try:
+                request = decode(body, content_type)
+            except ValueError as e:
+                return 400, {'error': str(e)}
+            response = await self.handle_request(request)
+            return (200 if 'estimates' in response else 400), response
+
+        return 404, {'error': 'Unknown endpoint {} {}'.format(method, path)}
+
+    def serve_forever(self, host='127.0.0.1', port=8000, unix_socket=None):
+        """Listens on a TCP port, or on a Unix socket if a path is given, until interrupted."""
+
+        loop = asyncio.get_event_loop()
+        if unix_socket:
+            server = loop.run_until_complete(asyncio.start_unix_server(self.handle_connection, unix_socket))
+        else:
+            server = loop.run_until_complete(asyncio.start_server(self.handle_connection, host, port))
+
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            self.executor.shutdown()
+
+
+def decode(payload: bytes, content_type: str):
+    if content_type == MSGPACK_TYPE:
+        if msgpack is None:
+            raise ValueError('msgpack is not installed')
+        return msgpack.unpackb(payload, raw=False)
+    try:
+        return json.loads(payload.decode())
+    except json.JSONDecodeError as e:
+        raise ValueError('Invalid JSON: {}'.format(e))
+
+
+def encode(response: dict, content_type: str) -> bytes:
+    if content_type == MSGPACK_TYPE:
+        return msgpack.packb(response, use_bin_type=True)
+    return json.dumps(response).encode()
+
+
+class Client():
+    """Synchronous client of the service, which keeps its connection open.
+
+    Args:
+        host (str): the host the server listens on.
+        port (int): the port the server listens on.
+        unix_socket (str): the path of the Unix socket the server listens on, instead of a host
+            and a port.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8000, unix_socket=None):
+        if unix_socket:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(unix_socket)
+        else:
+            self.sock = socket.create_connection((host, port))
+        self.file = self.sock.makefile('rwb')
+
+    def estimate_many(self, queries: list, model: str = None) -> list:
+        """Returns the estimated cardinality of each query, see the module's docstring for the
+        format of the queries.
+
+        The queries are estimated independently from each other, hence the estimate of a query
+        which failed is replaced by a ValueError holding the reason, as in estimate.
+
+        Raises:
+            ValueError: if the server couldn't estimate the queries at all, for instance because
+                the model is unknown.
+        """
+
+        request = {'queries': list(queries)}
+        if model is not None:
+            request['model'] = model
+        self.file.write(json.dumps(request).encode() + b'\n')
+        self.file.flush()
+
+        response = json.loads(self.file.readline().decode())
+        if 'estimates' not in response:
+            raise ValueError(response['error'])
+
+        # The keys of the errors are strings once encoded in JSON
+        errors = {int(i): error for i, error in response.get('error', {}).items()}
+        return [
+            ValueError(errors[i]) if i in errors else estimate
+            for i, estimate in enumerate(response['estimates'])
+        ]
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
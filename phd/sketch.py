@@ -0,0 +1,139 @@
+"""Frequency sketches of join keys.
+
+A sketch stores the frequency of the most common values of a key along with the number of rows and
+of distinct values of the rest, which are assumed to be uniform. The size of a join is estimated
+as the dot product of the sketches of both sides, in the same spirit as PostgreSQL's eqjoinsel.
+"""
+import numpy as np
+import pandas as pd
+
+from phd import store
+from phd import tools
+
+
+class KeySketch():
+    """Most common values of a join key along with a uniform remainder.
+
+    Args:
+        values (list): the most common values.
+        freqs (numpy.ndarray): the number of rows of each most common value.
+        n_rows (float): the number of non-null rows.
+        n_distinct (float): the number of distinct non-null values.
+    """
+
+    def __init__(self, values: list, freqs: np.ndarray, n_rows: float, n_distinct: float):
+        self.values = list(values)
+        self.freqs = np.asarray(freqs, dtype=float)
+        self.n_rows = n_rows
+        self.n_distinct = n_distinct
+
+    @classmethod
+    def from_series(cls, series: pd.Series, n_rows: float, n_distinct: float, size: int):
+        """Builds a sketch from a sample of a key, the frequencies being scaled to n_rows."""
+        return cls.from_value_counts(series.value_counts(), n_rows, n_distinct, size)
+
+    @classmethod
+    def from_value_counts(cls, value_counts: pd.Series, n_rows: float, n_distinct: float, size: int):
+        """Builds a sketch from the number of times each value of a key occurs in a sample."""
+
+        n_sampled = value_counts.sum()
+        value_counts = value_counts.nlargest(size)
+
+        scale = n_rows / n_sampled if n_sampled else 0
+        return cls(
+            values=list(value_counts.index),
+            freqs=value_counts.values * scale,
+            n_rows=n_rows,
+            n_distinct=max(n_distinct, len(value_counts))
+        )
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def remainder_rows(self) -> float:
+        return max(self.n_rows - self.freqs.sum(), 0)
+
+    @property
+    def remainder_distinct(self) -> float:
+        return max(self.n_distinct - len(self), 0)
+
+    @property
+    def remainder_freq(self) -> float:
+        """Returns the frequency of each value which isn't one of the most common ones."""
+        return self.remainder_rows / self.remainder_distinct if self.remainder_distinct else 0
+
+    def join_size(self, other) -> float:
+        """Estimates the number of rows of the equi-join of two keys."""
+
+        other_freqs = dict(zip(other.values, other.freqs))
+        common = [v in other_freqs for v in self.values]
+
+        # Values which are common on both sides
+        size = sum(f * other_freqs[v] for v, f, c in zip(self.values, self.freqs, common) if c)
+
+        # Values which are common on one side and assumed to be uniform on the other
+        self_only = len(self) - sum(common)
+        size += self.freqs[~np.array(common, dtype=bool)].sum() * other.remainder_freq
+        values = set(self.values)
+        other_only = sum(v not in values for v in other.values)
+        size += sum(f for v, f in zip(other.values, other.freqs) if v not in values) * self.remainder_freq
+
+        # The remainders of both sides, without the values which were matched with the most common
+        # values of the other side
+        self_distinct = max(self.remainder_distinct - other_only, 0)
+        self_rows = max(self.remainder_rows - other_only * self.remainder_freq, 0)
+        other_distinct = max(other.remainder_distinct - self_only, 0)
+        other_rows = max(other.remainder_rows - self_only * other.remainder_freq, 0)
+        n_distinct = max(self_distinct, other_distinct)
+        if n_distinct:
+            size += self_rows * other_rows / n_distinct
+
+        return size
+
+    def condition(self, probs: np.ndarray, p: float):
+        """Returns the sketch of the rows which satisfy a filter.
+
+        Args:
+            probs (numpy.ndarray): the probability of each most common value amongst the rows
+                which satisfy the filter.
+            p (float): the selectivity of the filter.
+        """
+        n_rows = self.n_rows * p
+        freqs = np.minimum(np.asarray(probs, dtype=float) * n_rows, self.freqs)
+        remainder_rows = max(n_rows - freqs.sum(), 0)
+        return KeySketch(
+            values=self.values,
+            freqs=freqs,
+            n_rows=n_rows,
+            n_distinct=len(self) + min(self.remainder_distinct, np.ceil(remainder_rows))
+        )
+
+    def nbytes(self) -> int:
+        return tools.sizeof(self.values) + self.freqs.nbytes
+
+    def to_dict(self) -> dict:
+        return {
+            'values': [store.encode_key(v) for v in self.values],
+            'freqs': self.freqs.tolist(),
+            'n_rows': float(self.n_rows),
+            'n_distinct': float(self.n_distinct)
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        return cls([store.decode_key(v) for v in d['values']], d['freqs'], d['n_rows'], d['n_distinct'])
+
+
+def calc_join_selectivity(left: KeySketch, right: KeySketch, left_card: float, right_card: float) -> float:
+    """Returns the fraction of the cartesian product of two relations which satisfies an equi-join.
+
+    Args:
+        left (KeySketch): the sketch of the key of the left relation.
+        right (KeySketch): the sketch of the key of the right relation.
+        left_card (float): the number of rows of the left relation, including the null keys.
+        right_card (float): the number of rows of the right relation, including the null keys.
+    """
+    if not left_card or not right_card:
+        return 0
+    return left.join_size(right) / (left_card * right_card)
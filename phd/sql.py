@@ -0,0 +1,301 @@
+"""Parser of SELECT-FROM-WHERE queries written in SQL.
+
+The WHERE clause is parsed into a tree of predicates which is then lowered to the join and filter
+queries the estimators understand, where each relation is referred to by its name rather than by
+its alias. If a relation appears more than once, such as the two info_type relations of some JOB
+queries, then the relations are referred to by their aliases instead and the relation names of the
+query are a dict of the aliases to the relation names. Equalities between two columns are joins
+while the other predicates are filters. The members of a disjunction or of a negation have to be
+about the same relation.
+
+Parsed queries are memoized, hence estimating the same query many times only parses it once.
+"""
+import collections
+import functools
+import re
+
+
+# Tokens, the keywords being told apart from the identifiers afterwards
+TOKEN = re.compile(r'''
+    \s*(?:
+        (?P<string>'(?:[^']|'')*')
+        |(?P<number>-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)
+        |(?P<name>[A-Za-z_][A-Za-z0-9_$]*|"[^"]+")
+        |(?P<symbol><=|>=|<>|!=|=|<|>|\(|\)|,|\.|\*|;)
+    )
+''', re.VERBOSE)
+
+KEYWORDS = {
+    'select', 'distinct', 'from', 'where', 'as', 'and', 'or', 'not', 'in', 'between', 'like',
+    'is', 'null', 'group', 'order', 'limit'
+}
+
+# Comparisons written the other way around when the operand comes first
+FLIPPED = {'=': '=', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+# Operator names of the filter syntax
+OP_NAMES = {'=': '==', '<': '<', '<=': '<=', '>': '>', '>=': '>='}
+
+
+Column = collections.namedtuple('Column', ['rel', 'att'])
+Predicate = collections.namedtuple('Predicate', ['column', 'op', 'operand'])
+Join = collections.namedtuple('Join', ['left', 'right'])
+And = collections.namedtuple('And', ['children'])
+Or = collections.namedtuple('Or', ['children'])
+Not = collections.namedtuple('Not', ['child'])
+
+
+Query = collections.namedtuple('Query', ['join_query', 'filter_query', 'relation_names'])
+
+
+def tokenize(sql: str) -> list:
+    """Returns the (kind, value) pairs of the tokens of a query; keywords are lowercased."""
+
+    tokens = []
+    position = 0
+    sql = sql.strip()
+    while position < len(sql):
+        match = TOKEN.match(sql, position)
+        if not match or match.end() == position:
+            raise ValueError('Unexpected character at position {}: {!r}'.format(position, sql[position:position + 20]))
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'string':
+            value = value[1:-1].replace("''", "'")
+        elif kind == 'number':
+            value = float(value) if any(c in value for c in '.eE') else int(value)
+        elif kind == 'name' and value.lower() in KEYWORDS:
+            kind, value = 'keyword', value.lower()
+        elif kind == 'name':
+            value = value.strip('"')
+        tokens.append((kind, value))
+
+    return tokens
+
+
+class Parser():
+    """Recursive descent parser of a single SELECT-FROM-WHERE query."""
+
+    def __init__(self, sql: str):
+        self.tokens = tokenize(sql)
+        self.position = 0
+
+    def peek(self, offset=0) -> tuple:
+        position = self.position + offset
+        return self.tokens[position] if position < len(self.tokens) else (None, None)
+
+    def accept(self, kind: str, value=None) -> bool:
+        """Consumes the next token if it matches."""
+        token_kind, token_value = self.peek()
+        if token_kind == kind and (value is None or token_value == value):
+            self.position += 1
+            return True
+        return False
+
+    def expect(self, kind: str, value=None):
+        """Consumes and returns the value of the next token, which has to match."""
+        token_kind, token_value = self.peek()
+        if not self.accept(kind, value):
+            raise ValueError('Expected {} but got {!r}'.format(value or kind, token_value))
+        return token_value
+
+    def parse(self) -> tuple:
+        """Returns the relations of the query, as a dict of aliases to names, along with the
+        tree of the WHERE clause, which is None if there is none."""
+
+        # The selected columns don't matter
+        self.expect('keyword', 'select')
+        while self.peek()[0] and self.peek() != ('keyword', 'from'):
+            self.position += 1
+        self.expect('keyword', 'from')
+
+        relations = collections.OrderedDict()
+        while True:
+            name = self.expect('name')
+            self.accept('keyword', 'as')
+            alias = self.expect('name') if self.peek()[0] == 'name' else name
+            if alias in relations:
+                raise ValueError('Alias "{}" is used twice'.format(alias))
+            relations[alias] = name
+            if not self.accept('symbol', ','):
+                break
+
+        where = self.parse_or() if self.accept('keyword', 'where') else None
+
+        self.accept('symbol', ';')
+        if self.peek()[0] is not None:
+            raise ValueError('Unsupported clause starting with {!r}'.format(self.peek()[1]))
+
+        return relations, where
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while self.accept('keyword', 'or'):
+            children.append(self.parse_and())
+        return children[0] if len(children) == 1 else Or(children)
+
+    def parse_and(self):
+        children = [self.parse_not()]
+        while self.accept('keyword', 'and'):
+            children.append(self.parse_not())
+        return children[0] if len(children) == 1 else And(children)
+
+    def parse_not(self):
+        if self.accept('keyword', 'not'):
+            return Not(self.parse_not())
+        if self.accept('symbol', '('):
+            node = self.parse_or()
+            self.expect('symbol', ')')
+            return node
+        return self.parse_predicate()
+
+    def parse_column(self) -> Column:
+        first = self.expect('name')
+        if self.accept('symbol', '.'):
+            return Column(first, self.expect('name'))
+        return Column(None, first)
+
+    def parse_literal(self):
+        kind, value = self.peek()
+        if kind in ('string', 'number'):
+            self.position += 1
+            return value
+        raise ValueError('Expected a literal but got {!r}'.format(value))
+
+    def parse_predicate(self):
+
+        # Comparisons can be written with the operand first
+        if self.peek()[0] in ('string', 'number'):
+            operand = self.parse_literal()
+            op = self.expect('symbol')
+            if op not in FLIPPED:
+                raise ValueError('Unsupported comparison {!r}'.format(op))
+            return Predicate(self.parse_column(), FLIPPED[op], operand)
+
+        column = self.parse_column()
+        negated = self.accept('keyword', 'not')
+
+        if self.accept('keyword', 'in'):
+            self.expect('symbol', '(')
+            values = [self.parse_literal()]
+            while self.accept('symbol', ','):
+                values.append(self.parse_literal())
+            self.expect('symbol', ')')
+            predicate = Predicate(column, 'in', tuple(values))
+        elif self.accept('keyword', 'between'):
+            low = self.parse_literal()
+            self.expect('keyword', 'and')
+            predicate = Predicate(column, 'between', (low, self.parse_literal()))
+        elif self.accept('keyword', 'like'):
+            predicate = Predicate(column, 'like', self.expect('string'))
+        elif not negated and self.accept('keyword', 'is'):
+            op = 'is not null' if self.accept('keyword', 'not') else 'is null'
+            self.expect('keyword', 'null')
+            return Predicate(column, op, None)
+        elif not negated:
+            op = self.expect('symbol')
+            if op in ('<>', '!='):
+                return Not(Predicate(column, '=', self.parse_literal()))
+            if op not in FLIPPED:
+                raise ValueError('Unsupported comparison {!r}'.format(op))
+            if op == '=' and self.peek()[0] == 'name':
+                return Join(column, self.parse_column())
+            return Predicate(column, op, self.parse_literal())
+        else:
+            raise ValueError('Expected IN, BETWEEN or LIKE after NOT')
+
+        return Not(predicate) if negated else predicate
+
+
+def conjuncts(node) -> list:
+    """Returns the members of a conjunction, nested conjunctions being flattened."""
+    if node is None:
+        return []
+    if isinstance(node, And):
+        return [c for child in node.children for c in conjuncts(child)]
+    return [node]
+
+
+def format_literal(value) -> str:
+    """Writes a literal in the filter syntax; quotes and backslashes within strings are escaped
+    as in Python, which is how tools.parse_operand reads them."""
+    return repr(value)
+
+
+def format_predicate(predicate: Predicate, rel_name: str) -> str:
+    """Writes a predicate in the filter syntax of the estimators."""
+
+    name = '{}.{}'.format(rel_name, predicate.column.att)
+    if predicate.op in ('is null', 'is not null'):
+        return '{} {}'.format(name, predicate.op)
+    if predicate.op in ('in', 'between'):
+        operand = repr(list(predicate.operand))
+        return '{} {} {}'.format(name, predicate.op, operand)
+    return '{} {} {}'.format(name, OP_NAMES.get(predicate.op, predicate.op), format_literal(predicate.operand))
+
+
+def lower(relations: dict, where) -> Query:
+    """Lowers a parsed query to the join and filter queries of the estimators."""
+
+    # The occurrences of a relation which appears more than once are told apart by their alias
+    self_joined = len(set(relations.values())) < len(relations)
+    labels = {alias: alias if self_joined else rel_name for alias, rel_name in relations.items()}
+
+    def resolve(column: Column) -> str:
+        if column.rel is not None:
+            if column.rel not in relations:
+                raise ValueError('Unknown relation "{}"'.format(column.rel))
+            return labels[column.rel]
+        if len(relations) > 1:
+            raise ValueError('Column "{}" has to be qualified'.format(column.att))
+        return next(iter(labels.values()))
+
+    def format_node(node, rel_names: set) -> str:
+        """Writes a boolean expression in the filter syntax, along with the relations it
+        involves."""
+
+        def wrap(child, types):
+            s = format_node(child, rel_names)
+            return '({})'.format(s) if isinstance(child, types) else s
+
+        if isinstance(node, Join):
+            raise ValueError('Joins are only supported at the top level of the WHERE clause')
+        if isinstance(node, Predicate):
+            rel_names.add(resolve(node.column))
+            return format_predicate(node, resolve(node.column))
+        if isinstance(node, And):
+            return ' and '.join(wrap(child, Or) for child in node.children)
+        if isinstance(node, Or):
+            return ' or '.join(wrap(child, And) for child in node.children)
+        return 'not {}'.format(wrap(node.child, (And, Or)))
+
+    joins = []
+    filters = []
+    for node in conjuncts(where):
+        if isinstance(node, Join):
+            joins.append('{}.{} == {}.{}'.format(
+                resolve(node.left), node.left.att,
+                resolve(node.right), node.right.att
+            ))
+            continue
+        rel_names = set()
+        f = format_node(node, rel_names)
+        if len(rel_names) > 1:
+            raise ValueError('Disjunctions over several relations are not supported')
+        filters.append('({})'.format(f) if isinstance(node, Or) else f)
+
+    relation_names = dict(sorted(relations.items())) if self_joined else sorted(relations.values())
+    return Query(' and '.join(joins), ' and '.join(filters), relation_names)
+
+
+@functools.lru_cache(maxsize=1024)
+def parse(sql: str) -> Query:
+    """Parses a SELECT-FROM-WHERE query into the join query, the filter query and the relation
+    names the estimators expect, the latter being a dict of aliases to relation names if a relation
+    appears more than once.
+
+    Raises:
+        ValueError: if the query is not supported.
+    """
+    return lower(*Parser(sql).parse())
@@ -0,0 +1,81 @@
+"""On-disk format for fitted estimators.
+
+A model is stored as a directory that contains a meta.json file along with one .npy file per
+array. Arrays are saved with NumPy's own format so that they can be memory-mapped when a model is
+loaded. Values such as pd.Interval keys are encoded as JSON, nothing is pickled.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+FORMAT_VERSION = 5
+META_FILE = 'meta.json'
+
+
+def encode_key(key):
+    """Returns a JSON serializable version of a distribution key."""
+    if isinstance(key, pd.Interval):
+        return {'left': encode_key(key.left), 'right': encode_key(key.right), 'closed': key.closed}
+    if isinstance(key, np.generic):
+        return key.item()
+    return key
+
+
+def decode_key(key):
+    """Inverse of encode_key."""
+    if isinstance(key, dict):
+        return pd.Interval(key['left'], key['right'], key['closed'])
+    return key
+
+
+def write_meta(path: str, meta: dict):
+    meta = dict(meta, format_version=FORMAT_VERSION)
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+
+def read_meta(path: str) -> dict:
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    if meta.get('format_version') != FORMAT_VERSION:
+        raise ValueError('Unsupported model format version: {}'.format(meta.get('format_version')))
+    return meta
+
+
+def save_array(path: str, name: str, array: np.ndarray) -> str:
+    """Saves an array and returns the name of the file it was saved to."""
+    file_name = '{}.npy'.format(name)
+    np.save(os.path.join(path, file_name), np.asarray(array), allow_pickle=False)
+    return file_name
+
+
+def load_array(path: str, file_name: str, mmap_mode=None) -> np.ndarray:
+    return np.load(os.path.join(path, file_name), mmap_mode=mmap_mode, allow_pickle=False)
+
+
+def save_column(path: str, name: str, column: pd.Series) -> dict:
+    """Saves a DataFrame column; object columns are stored as unicode strings and a null mask."""
+
+    if column.dtype != 'object':
+        return {'values': save_array(path, name, column.values)}
+
+    nulls = column.isnull().values
+    return {
+        'values': save_array(path, name, column.where(~nulls, '').astype(str).values.astype('U')),
+        'nulls': save_array(path, '{}-nulls'.format(name), nulls)
+    }
+
+
+def load_column(path: str, column: dict, mmap_mode=None) -> np.ndarray:
+
+    values = load_array(path, column['values'], mmap_mode)
+
+    if 'nulls' not in column:
+        return values
+
+    values = values.astype(object)
+    values[load_array(path, column['nulls'])] = None
+    return values
@@ -1,125 +1,220 @@
+from collections import Counter
+from collections import defaultdict
+import os
 import random
-import time
 
+import numpy as np
 import pandas as pd
 import sqlalchemy
 
+from phd import cache
 from phd import distribution
-from phd import tools
+from phd import instrument
+from phd import store
 from phd.estimator import Estimator
+from phd.estimator import relation_aliases
 
 
 class TextbookEstimator(Estimator):
 
     def __init__(self, n_mcv=30, n_bins=30, sampling_ratio=1.0, block_sampling=True,
-                 min_rows=10000, seed=None):
+                 min_rows=10000, seed=None, n_jobs=1, cache_size=1024,
+                 chunk_size=100000, loader='sql', sketch_size=100, adaptive=False,
+                 sampling_tolerance=0.02, sample_budget=None, time_budget=None, memory_budget=None):
         self.n_mcv = n_mcv
         self.n_bins = n_bins
         self.sampling_ratio = sampling_ratio
         self.min_rows = min_rows
         self.block_sampling = block_sampling
         self.seed = seed if seed else random.randint(0, 2 ** 32)
+        self.n_jobs = n_jobs
+        self.cache_size = cache_size
+        self.cache = cache.SelectivityCache(cache_size)
+        self.chunk_size = chunk_size
+        self.loader = loader
+        self.sketch_size = sketch_size
+        self.adaptive = adaptive
+        self.sampling_tolerance = sampling_tolerance
+        self.sample_budget = sample_budget
+        self.time_budget = time_budget
+        self.memory_budget = memory_budget
+        self.sampling_ratios = {}
+        self.pilot_samples = {}
+        self.key_sketches = {}
+        self.join_cards = {}
 
     def build_from_engine(self, engine: sqlalchemy.engine.base.Engine) -> dict:
 
         self.setup(engine)
 
-        # Create a connection to the database
-        conn = engine.connect()
+        # Create histograms per attribute
+        models, duration = self.build_relations(engine)
+        self.histograms = {rel_name: histograms for rel_name, (histograms, _) in models.items()}
+        self.key_sketches = {rel_name: key_sketches for rel_name, (_, key_sketches) in models.items()}
+        self.fit_memory_budget()
 
-        # Record the time spent
-        duration = {
-            'querying': {},
-            'parameters': {}
-        }
+        return duration
 
-        # Create histograms per attribute
-        self.histograms = {}
-        self.n_in_bin = {}
-        sampling_method = {True: 'SYSTEM', False: 'BERNOULLI'}[self.block_sampling]
-
-        for rel_name in self.rel_names:
-
-            self.histograms[rel_name] = {}
-            self.n_in_bin[rel_name] = {}
-
-            rel_card = self.rel_cards[rel_name]
-
-            # Sample the relation if the number of rows is high enough
-            query = 'SELECT * FROM {}'.format(rel_name)
-            # Add a sampling statement if the sampling ratio is lower than 1
-            sampling_ratio = max(self.sampling_ratio, self.min_rows / rel_card)
-            if sampling_ratio < 1:
-                # Make sure there won't be less samples then the minimum number of allowed rows
-                query += ' TABLESAMPLE {} ({}) REPEATABLE ({})'.format(
-                    sampling_method,
-                    sampling_ratio * 100,
-                    self.seed
-                )
-            date_atts = [att for att, typ in self.att_types[rel_name].items() if typ == 'date']
-            tic = time.time()
-            rel = pd.read_sql_query(sql=query, con=conn, parse_dates=date_atts)
-            duration['querying'][rel_name] = time.time() - tic
-
-            # Convert the datetimes to ISO formatted strings
-            for att in date_atts:
-                rel[att] = rel[att].map(lambda x: x.isoformat())
-
-            # Strip the whitespace from the string columns
-            for att in rel.columns:
-                if rel[att].dtype == 'object':
-                    rel[att] = rel[att].str.rstrip()
-
-            # Blacklist the ID columns
-            blacklist = [
-                att for att in rel.columns
-                if '_id' in att
-                or 'id_' in att
-                or att == 'id'
-                or '_sk' in att
-                or self.att_types[rel_name][att] == 'character varying'
-                or round(rel_card * self.null_fracs[rel_name][att] + self.att_cards[rel_name][att]) == rel_card
-            ]
-
-            # Create one histogram per attribute
-            tic = time.time()
-            for att in set(rel.columns) - set(blacklist):
-                rel[att], self.n_in_bin[rel_name][att] = tools.discretize_series(
-                    rel[att],
+    def build_relation(self, conn, rel_name: str) -> tuple:
+
+        # Record the time spent
+        duration = {}
+
+        histograms = {}
+
+        # Blacklist the ID columns, whose values are only counted if they are join keys
+        header = pd.DataFrame(columns=list(self.att_types[rel_name]))
+        blacklist = self.calc_blacklist(rel_name, header)
+        join_keys = self.calc_join_keys(rel_name, header)
+        atts = [att for att in header.columns if att not in blacklist or att in join_keys]
+
+        # Count the values one chunk at a time, hence the memory taken up is proportional to the
+        # number of distinct values rather than to the number of sampled rows
+        value_counts = {att: Counter() for att in atts}
+        n_nulls = Counter()
+        with instrument.timer('querying', rel_name=rel_name) as timer:
+            for chunk in self.iter_sample(conn, rel_name):
+                for att in atts:
+                    value_counts[att].update(chunk[att].value_counts().to_dict())
+                    n_nulls[att] += int(chunk[att].isnull().sum())
+        duration['querying'] = timer.duration
+        value_counts = {att: pd.Series(counts, name=att) for att, counts in value_counts.items()}
+
+        # Create one histogram per attribute
+        with instrument.timer('parameters', rel_name=rel_name) as timer:
+            for att in set(atts) - set(blacklist):
+                bins, counts = distribution.Bins.from_value_counts(
+                    value_counts[att],
+                    n_null=n_nulls[att],
                     n_mcv=self.n_mcv,
                     n_bins=self.n_bins
                 )
-                self.histograms[rel_name][att] = distribution.Distribution(on=att, by=None)
-                self.histograms[rel_name][att].build_from_df(rel, types=self.att_types[rel_name])
+                histograms[att] = distribution.Distribution(on=att, by=None)
+                histograms[att].build_from_counts(counts, bins={att: bins})
+        duration['parameters'] = timer.duration
 
-            duration['parameters'][rel_name] = time.time() - tic
+        # Sketch the join keys
+        with instrument.timer('sketches', rel_name=rel_name) as timer:
+            key_sketches = self.build_key_sketches_from_counts(
+                rel_name,
+                {att: value_counts[att] for att in join_keys}
+            )
+        duration['sketches'] = timer.duration
 
-        # Close the connection to the database
-        conn.close()
-
-        return duration
+        return (histograms, key_sketches), duration
 
     def estimate_selectivity(self, join_query: str, filter_query: str, relation_names=None):
 
         relationships, filters, rel_names = self.parse_query(join_query, filter_query)
+        aliases = relation_aliases(relation_names if relation_names else rel_names)
 
-        cartesian_prod_card = self.calc_cartesian_prod_card(relation_names if relation_names else rel_names)
-        join_selectivity = self.calc_join_selectivity(relationships)
+        cartesian_prod_card = self.calc_cartesian_prod_card(list(aliases.values()))
+        join_selectivity = self.calc_join_selectivity(relationships, filters, aliases)
 
         attribute_selectivity = 1
-        for rel_name, f in filters.items():
-            rel_p = 1
-            for att, op in tools.parse_filter(f).items():
-                hist = self.histograms[rel_name][att]
-                relevant_hist = hist.subset(att, op)
-                pp = 0
-                for val, p in relevant_hist.items():
-                    if isinstance(val, pd.Interval):
-                        n_in_bin = self.n_in_bin[rel_name][att][str(val)]
-                        p *= op.calc_coverage(val, n_in_bin)
-                    pp += p
-                rel_p *= pp
-            print(rel_name, rel_p)
+        for alias, f in filters.items():
+            rel_name = aliases.get(alias, alias)
+            rel_p = self.calc_cached_filter_selectivity(rel_name, f)
+            instrument.event('filter_selectivity', rel_name=rel_name, selectivity=rel_p)
             attribute_selectivity *= rel_p
 
         return cartesian_prod_card * join_selectivity * attribute_selectivity
+
+    def calc_filter_selectivities(self, rel_name: str, conditions: list) -> list:
+
+        selectivities = np.ones(len(conditions))
+
+        # Group the predicates by attribute so that each distinct one is only evaluated once
+        predicates = defaultdict(lambda: defaultdict(list))
+        for i, condition in enumerate(conditions):
+            for att, op in condition.items():
+                predicates[att][op.key()].append((i, op))
+
+        for att, att_predicates in predicates.items():
+            hist = self.histograms[rel_name][att]
+            for occurrences in att_predicates.values():
+                p = calc_histogram_selectivity(hist, occurrences[0][1])
+                selectivities[[i for i, _ in occurrences]] *= p
+
+        return list(selectivities)
+
+    def update(self, rel_name: str, inserted_df: pd.DataFrame = None,
+               deleted_df: pd.DataFrame = None) -> bool:
+        """Updates the histograms of a relation after rows were inserted and/or deleted.
+
+        The histograms are independent from each other, hence a relation never has to be rebuilt.
+        """
+
+        inserted_df = self.normalize_types(rel_name, pd.DataFrame() if inserted_df is None else inserted_df)
+        deleted_df = self.normalize_types(rel_name, pd.DataFrame() if deleted_df is None else deleted_df)
+
+        # Each row is weighted by the sampling ratio the histograms were built with
+        old_card = self.rel_cards[rel_name]
+        for att, hist in self.histograms[rel_name].items():
+            weight = hist.counts.sum() / old_card if old_card else 1
+            for rows, sign in ((inserted_df, 1), (deleted_df, -1)):
+                if len(rows):
+                    hist.update_counts({att: hist.bins[att].encode(rows[att])}, sign * weight)
+        self.invalidate_cache(rel_name)
+
+        self.update_statistics(rel_name, inserted_df, deleted_df)
+
+        # Updating the counts decompresses the histograms
+        self.fit_memory_budget()
+
+        return False
+
+    def calc_memory_usage(self) -> dict:
+        return {
+            rel_name: {att: hist.nbytes() + hist.bins[att].nbytes() for att, hist in hists.items()}
+            for rel_name, hists in self.histograms.items()
+        }
+
+    def compress_models(self, min_mass: float):
+        for hists in self.histograms.values():
+            for hist in hists.values():
+                hist.compress(min_mass)
+
+    def save_model(self, path: str) -> dict:
+
+        meta = {}
+
+        for rel_name, hists in self.histograms.items():
+            rel_path = os.path.join(path, rel_name)
+            os.makedirs(rel_path, exist_ok=True)
+            meta[rel_name] = {
+                att: {
+                    'bins': hist.bins[att].to_dict(),
+                    'probs': store.save_array(rel_path, 'probs-{}'.format(att), hist.probs),
+                    'counts': store.save_array(rel_path, 'counts-{}'.format(att), hist.counts)
+                }
+                for att, hist in hists.items()
+            }
+
+        return meta
+
+    def load_model(self, path: str, meta: dict, mmap_mode):
+        self.histograms = {
+            rel_name: {
+                att: distribution.Distribution(
+                    on=att,
+                    by=None,
+                    bins={att: distribution.Bins.from_dict(hist_meta['bins'])},
+                    probs=store.load_array(os.path.join(path, rel_name), hist_meta['probs'], mmap_mode),
+                    counts=store.load_array(os.path.join(path, rel_name), hist_meta['counts'], mmap_mode)
+                )
+                for att, hist_meta in hists.items()
+            }
+            for rel_name, hists in meta.items()
+        }
+        self.fit_memory_budget()
+
+
+def calc_histogram_selectivity(hist: distribution.Distribution, op) -> float:
+    """Returns the fraction of rows of a histogram which satisfy an operator.
+
+    The probability of each relevant interval is weighted by the operator's coverage.
+    """
+    exact, fuzzy, coverage = hist.bins[hist.on].evidence(op)
+    relevant = distribution.keep_relevant((exact, fuzzy, coverage), hist.probs > 0)
+    return (hist.probs * coverage)[relevant].sum()
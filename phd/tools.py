@@ -1,7 +1,9 @@
 import ast
 import json
 import numbers
+import sys
 
+import numpy as np
 import pandas as pd
 import sqlalchemy
 
@@ -13,6 +15,12 @@ def print_json(d, indent=4, sort_keys=True):
     print(json.dumps(d, indent=indent, sort_keys=sort_keys))
 
 
+def sizeof(values) -> int:
+    """Returns the approximate number of bytes taken up by a container of Python objects, the
+    objects included; the values of a dict are left out."""
+    return sys.getsizeof(values) + sum(sys.getsizeof(value) for value in values)
+
+
 def explain_query(query, engine):
     """Executes a query against a connection and returns the execution plan."""
 
@@ -27,6 +35,9 @@ def explain_query(query, engine):
     plan = result.first()[0]
     result.close()
 
+    # Give the connection back to the pool
+    conn.close()
+
     return plan
 
 
@@ -37,29 +48,59 @@ def get_metadata(engine):
     return metadata
 
 
-def categorical_qcut(series, q):
-    """Computes categorical quantiles of a pandas.Series objects."""
+def categorical_qcut_codes(series: pd.Series, q: int) -> tuple:
+    """Computes categorical quantiles of a pandas.Series and returns the bin of each value.
+
+    Returns:
+        tuple: the bin code of each value (-1 for nulls) and the list of bins.
+    """
+    value_counts = series.value_counts().sort_index()
+    ends, bins = categorical_qcut_bins(value_counts, q)
+
+    # Map each value to the bin its sorted position belongs to
+    positions = value_counts.index.get_indexer(series)
+    codes = np.searchsorted(ends, positions)
+    codes[positions == -1] = -1
+
+    return codes, bins
+
+
+def categorical_qcut_bins(value_counts: pd.Series, q: int) -> tuple:
+    """Computes categorical quantiles given the number of times each value occurs.
+
+    Args:
+        value_counts (pandas.Series): the count of each value, sorted by value.
+        q (int): the number of quantiles.
+
+    Returns:
+        tuple: the position of the last value of each bin and the list of bins.
+    """
     bin_freq = 1 / q
-    value_counts = series.value_counts(normalize=True).sort_index()
-    bins = {}
+    freqs = value_counts.values / float(value_counts.sum())
 
-    values_in_bin = []
+    # A bin is closed as soon as its cumulative frequency reaches the expected one
+    ends = []
     cum_freq = 0
+    for i, freq in enumerate(freqs):
+        cum_freq += freq
+        if cum_freq >= bin_freq or (i+1) == len(freqs):
+            ends.append(i)
+            cum_freq = 0
 
-    for i, (val, freq) in enumerate(value_counts.iteritems()):
+    values = value_counts.index
+    starts = [0] + [end + 1 for end in ends[:-1]]
+    bins = [
+        pd.Interval(left=values[start], right=values[end], closed='both')
+        for start, end in zip(starts, ends)
+    ]
 
-        values_in_bin.append(val)
-        cum_freq += freq
+    return ends, bins
 
-        if cum_freq >= bin_freq or (i+1) == len(value_counts):
-            values_in_bin = sorted(values_in_bin)
-            interval = pd.Interval(left=values_in_bin[0], right=values_in_bin[-1], closed='both')
-            for v in values_in_bin:
-                bins[v] = interval
-                values_in_bin = []
-                cum_freq = 0
 
-    return series.apply(lambda x: bins.get(x))
+def categorical_qcut(series, q):
+    """Computes categorical quantiles of a pandas.Series objects."""
+    codes, bins = categorical_qcut_codes(series, q)
+    return pd.Series(codes_to_labels(codes, bins, None), index=series.index)
 
 
 def calc_interval_overlap(a: pd.Interval, b: pd.Interval):
@@ -89,78 +130,233 @@ def format_interval(x):
     return str(x)
 
 
-def discretize_series(series: pd.Series, n_mcv: int, n_bins: int) -> pd.Series:
+def codes_to_labels(codes: np.ndarray, bins: list, null) -> np.ndarray:
+    """Returns the bin of each code, -1 being mapped to null."""
+    labels = np.empty(len(bins) + 1, dtype=object)
+    labels[:len(bins)] = bins
+    labels[-1] = null
+    return labels[codes]
+
 
-    s = series.copy()
+def map_distinct(series: pd.Series, func) -> pd.Series:
+    """Applies a function to each distinct value of a series, missing values are mapped to None.
+
+    This is much cheaper than Series.map when the series contains many duplicates, and the mapped
+    values are shared between the rows instead of being copied.
+    """
+    codes, uniques = pd.factorize(series)
+    labels = codes_to_labels(codes, [func(value) for value in uniques], None)
+    return pd.Series(labels, index=series.index, name=series.name)
+
+
+def rstrip(series: pd.Series) -> pd.Series:
+    """Removes the trailing whitespace of the strings of a series, such as char(n) padding."""
+    return map_distinct(series, lambda x: x.rstrip() if isinstance(x, str) else x)
+
+
+def discretize(series: pd.Series, n_mcv: int, n_bins: int) -> tuple:
+    """Assigns each value of a series to a bin.
+
+    The most common values each get their own bin whilst the rest of the values are split into
+    quantiles. Missing values are assigned the code -1.
+
+    Returns:
+        tuple: the bin code of each value, the bins (values for the MCVs and pandas.Interval for
+            the quantiles), a boolean array indicating which bins are MCVs and the number of
+            distinct values in each bin.
+    """
+
+    s = series
 
     # Remove trailing whitespace
     if s.dtype == 'object':
-        s = s.str.rstrip()
+        s = rstrip(s)
+
+    codes = np.full(len(s), -1, dtype=np.int64)
 
     # Treat most common values
     value_counts = s.value_counts()
     n_mcv = len(value_counts) if n_mcv == -1 else n_mcv
-    n_largest = value_counts.nlargest(n_mcv)
-    most_common_vals = set(n_largest.index)
-    most_common_mask = s.isin(most_common_vals)
+    most_common_vals = value_counts.nlargest(n_mcv).index
+    mcv_codes = most_common_vals.get_indexer(s)
+    most_common_mask = mcv_codes != -1
+    codes[most_common_mask] = mcv_codes[most_common_mask]
+    bins = list(most_common_vals)
 
     # Treat least common values
-    n_least_common = s[~most_common_mask].nunique()
+    least_common = s[~most_common_mask]
+    n_least_common = least_common.nunique()
     n_bins = min(n_least_common, n_bins)
     if n_least_common > 0:
         # Histogram for categorical data
         if not isinstance(s.iloc[0], numbers.Number):
-            s[~most_common_mask] = categorical_qcut(s[~most_common_mask], q=n_bins)
+            bin_codes, quantiles = categorical_qcut_codes(least_common, q=n_bins)
         # Histogram for continuous data
         else:
-            s[~most_common_mask] = pd.qcut(s[~most_common_mask], q=n_bins, duplicates='drop')
+            cut = pd.qcut(least_common, q=n_bins, duplicates='drop')
+            bin_codes, quantiles = np.asarray(cut.cat.codes), list(cut.cat.categories)
+        codes[~most_common_mask] = np.where(bin_codes == -1, -1, bin_codes + len(bins))
+        bins += quantiles
 
-    # Replace np.nan with None
-    s = s.where((pd.notnull(s)), None)
+    is_mcv = np.arange(len(bins)) < len(most_common_vals)
 
     # Count the number of distinct values per bin
-    n_distinct = {}
-    for hist_bin in s[~most_common_mask].unique():
-        if hist_bin is not None:
-            n_distinct[str(hist_bin)] = len(set(
-                x
-                for x in series
-                if x and x in hist_bin and
-                x not in most_common_vals
-            ))
+    non_null = codes != -1
+    labels, _ = pd.factorize(s[non_null])
+    _, first = np.unique(labels, return_index=True)
+    n_distinct = np.bincount(codes[non_null][first], minlength=len(bins))
+
+    return codes, bins, is_mcv, n_distinct
+
+
+def discretize_counts(value_counts: pd.Series, n_mcv: int, n_bins: int) -> tuple:
+    """Places the bins of discretize given the number of times each value occurs instead of the
+    values themselves, hence the counts can be accumulated over the chunks of a sample.
+
+    The quantiles are interpolated between the values in the same way as pandas.qcut does, the
+    bins are therefore the ones discretize would place.
+
+    Returns:
+        tuple: the bins, a boolean array indicating which bins are MCVs, and the number of
+            distinct values and of rows in each bin.
+    """
+
+    # Treat most common values
+    n_mcv = len(value_counts) if n_mcv == -1 else n_mcv
+    most_common = value_counts.nlargest(n_mcv)
+    bins = list(most_common.index)
+    n_distinct = [1] * len(bins)
+    counts = list(most_common.values)
+
+    # Treat least common values
+    least_common = value_counts.drop(most_common.index).sort_index()
+    n_bins = min(len(least_common), n_bins)
+    if n_bins > 0:
+        # Histogram for categorical data
+        if not isinstance(least_common.index[0], numbers.Number):
+            ends, quantiles = categorical_qcut_bins(least_common, q=n_bins)
+            bin_codes = np.searchsorted(ends, np.arange(len(least_common)))
+        # Histogram for continuous data
+        else:
+            edges = weighted_quantiles(least_common, np.linspace(0, 1, n_bins + 1))
+            # Like pandas.qcut, the duplicate edges are dropped unless there is a single bin
+            if len(edges) != 2:
+                edges = np.unique(edges)
+            cut = pd.cut(least_common.index.values, bins=edges, include_lowest=True)
+            bin_codes, quantiles = np.asarray(cut.codes), list(cut.categories)
+        n_distinct += list(np.bincount(bin_codes, minlength=len(quantiles)))
+        counts += list(np.bincount(bin_codes, weights=least_common.values, minlength=len(quantiles)))
+        bins += quantiles
+
+    is_mcv = np.arange(len(bins)) < len(most_common)
+
+    return bins, is_mcv, np.array(n_distinct, dtype=np.int64), np.array(counts, dtype=float)
+
+
+def weighted_quantiles(value_counts: pd.Series, q: np.ndarray) -> np.ndarray:
+    """Returns the quantiles of the values a series of counts sorted by value stands for, each
+    value being repeated as many times as it occurs, with linear interpolation."""
+
+    values = value_counts.index.values
+    ends = np.cumsum(value_counts.values)
+
+    def value_at(position):
+        return values[np.searchsorted(ends, position, side='right')]
+
+    quantiles = []
+    for at in q:
+        position = at * (ends[-1] - 1)
+        lower = value_at(int(position))
+        if position % 1 == 0:
+            quantiles.append(lower)
+        else:
+            quantiles.append(lower + (value_at(int(position) + 1) - lower) * (position % 1))
+
+    return np.array(quantiles, dtype=float)
+
+
+def discretize_series(series: pd.Series, n_mcv: int, n_bins: int) -> pd.Series:
+
+    codes, bins, is_mcv, n_distinct = discretize(series, n_mcv=n_mcv, n_bins=n_bins)
 
     # I hate this shit
-    s = s.apply(format_interval)
+    labels = codes_to_labels(codes, [format_interval(b) for b in bins], 'None')
+    s = pd.Series(labels, index=series.index)
+
+    n_distinct = {
+        str(b): int(n)
+        for b, n, mcv in zip(bins, n_distinct, is_mcv)
+        if not mcv
+    }
 
     return s, n_distinct
 
 
-def parse_filter(f: str) -> dict:
+# Operator names of the filter syntax
+OP_NAMES = ('==', 'in', '<=', '>=', '<', '>', 'between', 'like', 'is not null', 'is null')
+
+
+def parse_operand(operand: str):
+    """Parses the operand of a predicate: quoted strings, lists and tuples, and numbers.
+
+    Strings are read as Python literals, hence quotes and backslashes within them are escaped with
+    a backslash.
+    """
+
+    if operand[:1] in ('"', "'", '[', '('):
+        return ast.literal_eval(operand)
+
+    try:
+        return float(operand)
+    except ValueError:
+        return operand
+
+
+def split_predicate(part: str) -> tuple:
+    """Splits a predicate such as "age >= 18" into its attribute, operator name and operand; the
+    operand is None for the operators which have none."""
+
+    att, rest = part.split(' ', 1)
+    for op_name in OP_NAMES:
+        if rest == op_name:
+            return att, op_name, None
+        if rest.startswith(op_name + ' '):
+            return att, op_name, parse_operand(rest[len(op_name) + 1:])
+    raise ValueError('Unknown operator in predicate "{}"'.format(part))
+
+
+def parse_predicate(part: str) -> tuple:
+    """Parses a predicate such as "age >= 18" into its attribute and its operator.
+
+    The supported predicates are "att == x", "att in [x, y]", "att < x", "att <= x", "att > x",
+    "att >= x", "att between [x, y]" (bounds included), "att like 'pattern'", "att is null" and
+    "att is not null".
+    """
 
     ops = {
         '==': op.Equal,
-        'in': op.In
+        'in': op.In,
+        '<': lambda x: op.Range(high=x, high_closed=False),
+        '<=': lambda x: op.Range(high=x),
+        '>': lambda x: op.Range(low=x, low_closed=False),
+        '>=': lambda x: op.Range(low=x),
+        'between': lambda x: op.Range(low=x[0], high=x[1]),
+        'like': op.Like,
+        'is null': lambda _: op.IsNull(),
+        'is not null': lambda _: op.IsNotNull()
     }
 
-    def part_to_op(part: str) -> op.Operator:
+    att, op_name, operand = split_predicate(part)
+    return att, ops[op_name](operand)
 
-        op_start = part.find(' ') + 1
-        att = part[:op_start-1]
-        op_end = part[op_start:].find(' ')
-        op_name = part[op_start:op_start+op_end]
-        operand = part[op_start+op_end+1:]
 
-        if operand.startswith('"') or operand.startswith("'"):
-            operand = operand[1:-1]
-
-        if operand.startswith('[') or operand.startswith("("):
-            operand = ast.literal_eval(operand)
-        elif operand.isdigit():
-            operand = float(operand)
+def parse_filter(f: str) -> dict:
+    """Parses a conjunction of predicates on the attributes of a relation, see parse_predicate."""
 
-        return att, ops[op_name](operand)
+    # The predicates on the same attribute are merged, for instance two bounds make up a range
+    conditions = {}
+    for part in f.split(' and '):
+        att, operator = parse_predicate(part)
+        conditions[att] = op.intersect(conditions[att], operator) if att in conditions else operator
 
-    return dict(
-        part_to_op(part)
-        for part in f.split(' and ')
-    )
+    return conditions
@@ -0,0 +1,54 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from phd import operator as op
+from phd.bn import bayes_net
+
+
+@pytest.fixture
+def fork():
+    """Network where a is the parent of b and c, along with the rows it is built on."""
+
+    rng = np.random.RandomState(0)
+    a = rng.choice(['x', 'y'], 1000, p=[0.3, 0.7])
+    df = pd.DataFrame({
+        'a': a,
+        'b': np.where(rng.rand(len(a)) < np.where(a == 'x', 0.8, 0.2), 'p', 'q'),
+        'c': np.where(rng.rand(len(a)) < np.where(a == 'x', 0.6, 0.1), 'r', 's')
+    })
+
+    bn = bayes_net.BayesNet(edges=[('a', 'b'), ('a', 'c')])
+    bn.update_distributions(df, n_mcv=5, n_bins=5)
+
+    return bn, df
+
+
+def factorize(df: pd.DataFrame, b: str, c: str) -> float:
+    """Returns P(b, c) = sum over a of P(a) P(b | a) P(c | a)."""
+    return sum(
+        (df['a'] == a).mean() *
+        (df[df['a'] == a]['b'] == b).mean() *
+        (df[df['a'] == a]['c'] == c).mean()
+        for a in ('x', 'y')
+    )
+
+
+@pytest.mark.parametrize('b,c', itertools.product(['p', 'q'], ['r', 's']))
+def test_evidence_in_sibling_subtrees(fork, b, c):
+    bn, df = fork
+    conditions = {'b': op.Equal(b), 'c': op.Equal(c)}
+
+    # The messages of the children have to be multiplied, summing them gave P(b) + P(c)
+    assert bn.infer(conditions) == pytest.approx(factorize(df, b, c))
+    assert bn.compile().infer(conditions) == pytest.approx(factorize(df, b, c))
+
+
+def test_sibling_evidence_sums_to_one(fork):
+    bn, _ = fork
+    conditions = [{'b': op.Equal(b), 'c': op.Equal(c)} for b, c in itertools.product(['p', 'q'], ['r', 's'])]
+
+    assert sum(bn.infer(cond) for cond in conditions) == pytest.approx(1)
+    assert sum(bn.compile().infer_many(conditions)) == pytest.approx(1)
@@ -0,0 +1,109 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from phd import tools
+from phd.bn import chow_liu
+
+
+# Passengers relation of the toy example
+PASSENGERS = pd.DataFrame(
+    data=[
+        ('Swedish', 'Male', 'Blond'),
+        ('Swedish', 'Female', 'Blond'),
+        ('Swedish', 'Male', 'Blond'),
+        ('Swedish', 'Female', 'Brown'),
+        ('Swedish', 'Female', 'Blond'),
+        ('American', 'Male', 'Brown'),
+        ('American', 'Male', 'Dark'),
+        ('American', 'Female', 'Brown'),
+        ('American', 'Male', 'Brown'),
+        ('American', 'Female', 'Blond'),
+    ],
+    columns=['nationality', 'gender', 'hair']
+)
+
+PREDICATES = {
+    'nationality': ["nationality == 'Swedish'", "nationality == 'American'",
+                    "nationality in ['Swedish', 'American']"],
+    'gender': ["gender == 'Male'", "gender == 'Female'", "gender in ['Male']"],
+    'hair': ["hair == 'Blond'", "hair == 'Brown'", "hair in ['Brown', 'Dark']", "hair == 'Red'"]
+}
+
+
+def fit(df: pd.DataFrame, n_mcv: int, n_bins: int):
+    bn, _ = chow_liu.chow_liu_tree_from_df(df, blacklist=[])
+    bn.update_distributions(df, n_mcv=n_mcv, n_bins=n_bins)
+    return bn
+
+
+def conjunctions(predicates: dict) -> list:
+    """Returns every conjunction of one predicate per attribute, for every subset of attributes."""
+    filters = []
+    for k in range(1, len(predicates) + 1):
+        for atts in itertools.combinations(sorted(predicates), k):
+            for parts in itertools.product(*[predicates[att] for att in atts]):
+                filters.append(' and '.join(parts))
+    return filters
+
+
+@pytest.mark.parametrize('n_mcv,n_bins', [(2, 2), (1, 1), (30, 30)])
+def test_toy_example(n_mcv, n_bins):
+    bn = fit(PASSENGERS, n_mcv, n_bins)
+    cbn = bn.compile()
+    filters = conjunctions(PREDICATES)
+
+    expected = [bn.infer(tools.parse_filter(f)) for f in filters]
+
+    assert [cbn.infer(tools.parse_filter(f)) for f in filters] == pytest.approx(expected)
+    assert cbn.infer_many([tools.parse_filter(f) for f in filters]) == pytest.approx(expected)
+
+
+def test_numeric_attributes():
+    rng = np.random.RandomState(42)
+    a = rng.randint(0, 100, 2000)
+    df = pd.DataFrame({
+        'a': a,
+        'b': a + rng.randint(0, 20, len(a)),
+        'c': np.where(a < 50, 'x', rng.choice(['y', 'z'], len(a)))
+    })
+    bn = fit(df, n_mcv=5, n_bins=5)
+    cbn = bn.compile()
+    filters = conjunctions({
+        'a': ['a == 3', 'a in [1, 2, 3]', 'a > 40', 'a between [10, 30]'],
+        'b': ['b <= 50', 'b >= 100', 'b == 7'],
+        'c': ["c == 'x'", "c in ['y', 'z']"]
+    })
+
+    expected = [bn.infer(tools.parse_filter(f)) for f in filters]
+
+    assert cbn.infer_many([tools.parse_filter(f) for f in filters]) == pytest.approx(expected)
+
+
+def test_in_and_range_with_the_same_bounds():
+    rng = np.random.RandomState(42)
+    df = pd.DataFrame({'a': rng.randint(0, 100, 2000)})
+    cbn = fit(df, n_mcv=5, n_bins=5).compile()
+    filters = ['a in [1, 50]', 'a between [1, 50]']
+
+    expected = [cbn.infer(tools.parse_filter(f)) for f in filters]
+
+    assert expected[0] < expected[1]
+    assert cbn.infer_many([tools.parse_filter(f) for f in filters]) == pytest.approx(expected)
+
+
+def test_compressed_cpds_are_decompressed_once():
+    bn = fit(PASSENGERS, n_mcv=2, n_bins=2)
+    filters = [tools.parse_filter(f) for f in conjunctions(PREDICATES)]
+    expected = bn.compile().infer_many(filters)
+
+    bn.compress()
+    cbn = bn.compile()
+
+    assert cbn.infer_many(filters) == pytest.approx(expected, rel=1e-3)
+    cpds = {node: cbn.cpd(node) for node in cbn.order}
+    assert all(cpd.dtype == np.float32 for cpd in cpds.values())
+    assert cbn.infer_many(filters) == pytest.approx(expected, rel=1e-3)
+    assert all(cbn.cpd(node) is cpd for node, cpd in cpds.items())
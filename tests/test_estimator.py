@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from phd import distribution
+from phd import sketch
+from phd.textbook.estimator import TextbookEstimator
+
+
+class Connection():
+    """Records the statements and the rows copied through a database connection."""
+
+    def __init__(self):
+        self.statements = []
+        self.copied = {}
+        self.connection = self
+
+    def execute(self, statement):
+        self.statements.append(statement)
+
+    def cursor(self):
+        return self
+
+    def copy_from(self, f, table, columns):
+        self.copied[table] = f.read().split('\n')
+
+    def close(self):
+        pass
+
+
+def make_estimator(sampling_ratio: float, pilot_ratio=0.01):
+    est = TextbookEstimator(seed=7)
+    est.att_types = {'t': {'a': 'integer'}}
+    est.rel_cards = {'t': 10 ** 6}
+    est.sampling_ratios = {'t': sampling_ratio}
+    est.pilot_samples = {'t': (pilot_ratio, pd.DataFrame({'a': [1, 2]}), ['(0,1)', '(3,4)'])}
+
+    queries = []
+
+    def iter_rows(conn, query, att_types):
+        queries.append(query)
+        yield pd.DataFrame({'a': [3]})
+
+    est.iter_rows = iter_rows
+    return est, queries
+
+
+def test_pilot_sample_is_reused():
+    est, queries = make_estimator(sampling_ratio=0.01)
+
+    assert est.fetch_sample(Connection(), 't')['a'].tolist() == [1, 2]
+    assert queries == []
+
+
+def test_only_the_missing_rows_are_fetched():
+    est, queries = make_estimator(sampling_ratio=0.05)
+    conn = Connection()
+
+    assert est.fetch_sample(conn, 't')['a'].tolist() == [1, 2, 3]
+    assert queries == [
+        "SELECT r.* FROM t AS r TABLESAMPLE SYSTEM (5.0) REPEATABLE (7) "
+        "WHERE NOT EXISTS (SELECT 1 FROM pilot_ctids_t AS p WHERE p.ctid = r.ctid::text)"
+    ]
+    assert conn.copied == {'pilot_ctids_t': ['(0,1)', '(3,4)']}
+    assert conn.statements[0] == 'CREATE TEMPORARY TABLE pilot_ctids_t (ctid text)'
+    assert conn.statements[-1] == 'DROP TABLE IF EXISTS pilot_ctids_t'
+
+
+def test_explicit_ratio_ignores_the_pilot_sample():
+    est, queries = make_estimator(sampling_ratio=0.01)
+
+    est.fetch_sample(Connection(), 't', 0.5)
+
+    assert queries == ['SELECT * FROM t TABLESAMPLE SYSTEM (50.0) REPEATABLE (7)']
+
+
+def test_histograms_are_built_chunk_by_chunk():
+    rng = np.random.RandomState(42)
+    rel = pd.DataFrame({
+        'a': np.where(rng.rand(1000) < 0.1, np.nan, rng.exponential(20, 1000).round()),
+        'b': rng.choice(['x', 'y', 'z', 'w'], 1000),
+        't_id': rng.randint(0, 50, 1000)
+    })
+
+    est = TextbookEstimator(n_mcv=5, n_bins=5, seed=7, chunk_size=100, sketch_size=10)
+    est.att_types = {'t': {'a': 'integer', 'b': 'text', 't_id': 'integer'}}
+    est.rel_cards = {'t': 10 ** 4}
+    est.null_fracs = {'t': {'a': 0.1, 'b': 0, 't_id': 0}}
+    est.att_cards = {'t': {'a': 100, 'b': 4, 't_id': 50}}
+    est.join_keys = {}
+
+    def iter_rows(conn, query, att_types):
+        for i in range(0, len(rel), est.chunk_size):
+            yield rel[i:i + est.chunk_size]
+
+    est.iter_rows = iter_rows
+    (histograms, key_sketches), _ = est.build_relation(None, 't')
+
+    assert sorted(histograms) == ['a', 'b']
+    for att, hist in histograms.items():
+        bins, codes = distribution.Bins.from_series(rel[att], n_mcv=5, n_bins=5)
+        expected = distribution.Distribution(on=att, by=None).build_from_codes({att: codes}, bins={att: bins})
+        assert hist.bins[att].values == bins.values
+        assert hist.probs.tolist() == expected.probs.tolist()
+
+    expected = sketch.KeySketch.from_series(rel['t_id'], n_rows=10 ** 4, n_distinct=50, size=10)
+    assert sorted(key_sketches['t_id'].freqs) == sorted(expected.freqs)
+
+
+def test_each_alias_of_a_relation_gets_its_own_filter():
+    rel = pd.DataFrame({'b': ['x'] * 60 + ['y'] * 40})
+
+    est = TextbookEstimator(n_mcv=5, n_bins=5, seed=7)
+    est.att_types = {'t': {'b': 'text'}}
+    est.rel_cards = {'t': 100}
+    est.null_fracs = {'t': {'b': 0}}
+    est.att_cards = {'t': {'b': 2}}
+    est.join_keys = {}
+    est.iter_rows = lambda conn, query, att_types: iter([rel])
+    (histograms, _), _ = est.build_relation(None, 't')
+    est.histograms = {'t': histograms}
+
+    estimate = est.estimate_selectivity('', "t1.b == 'x' and t2.b == 'y'", {'t1': 't', 't2': 't'})
+
+    assert estimate == pytest.approx(100 * 100 * 0.6 * 0.4)
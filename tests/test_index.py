@@ -0,0 +1,15 @@
+import numpy as np
+import pandas as pd
+
+from phd import index
+from phd import operator as op
+
+
+def test_in_and_range_with_the_same_bounds():
+    rel = pd.DataFrame({'a': np.arange(100)})
+    sample_index = index.SampleIndex(rel)
+
+    in_bitmap, range_bitmap = sample_index.bitmaps([{'a': op.In([1, 50])}, {'a': op.Range(1, 50)}])
+
+    assert index.popcount(in_bitmap) == 2
+    assert index.popcount(range_bitmap) == 50
@@ -0,0 +1,250 @@
+import asyncio
+import json
+
+import pytest
+
+from phd import server
+
+
+class StubEstimator():
+    """Estimates the length of the filter of each query and fails on the filters with bad."""
+
+    def __init__(self):
+        self.batches = []
+
+    def estimate_many(self, queries):
+        self.batches.append(list(queries))
+        estimates = []
+        for join_query, filter_query, relation_names in queries:
+            if 'bad' in filter_query:
+                raise ValueError('bad filter')
+            estimates.append(float(len(filter_query)))
+        return estimates
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def service():
+    service = server.Server(paths=[], n_workers=0, batch_window=0.01)
+    service.models = {'stub': StubEstimator()}
+    yield service
+    service.executor.shutdown()
+
+
+def test_to_query():
+    assert server.to_query(['a.x == b.y', 'a.z == 1']) == ('a.x == b.y', 'a.z == 1', None)
+    assert server.to_query({'filter_query': 't.a == 1'}) == ('', 't.a == 1', None)
+    assert server.to_query({'sql': 'SELECT * FROM t WHERE t.a = 1'}) == ('', 't.a == 1', ['t'])
+    for query in ('SELECT sql FROM t', 42, [], {'sql': 'garbage'}):
+        with pytest.raises(ValueError):
+            server.to_query(query)
+
+
+def test_estimate_isolates_bad_queries():
+    models = {'stub': StubEstimator()}
+
+    estimates = server.estimate(models, 'stub', [['', 'ab'], {'sql': 'garbage'}, 'sql', ['', 'bad'], ['', 'abc']])
+
+    assert estimates[0] == 2 and estimates[4] == 3
+    assert all(isinstance(e, ValueError) for e in estimates[1:4])
+
+
+def test_batcher_merges_requests(loop):
+    calls = []
+
+    async def run(name, queries):
+        calls.append((name, queries))
+        return [q * 10 for q in queries]
+
+    batcher = server.Batcher(run, window=0.01)
+    results = loop.run_until_complete(asyncio.gather(
+        batcher.submit('m', [1, 2]),
+        batcher.submit('m', [3]),
+        batcher.submit('other', [4])
+    ))
+
+    assert results == [[10, 20], [30], [40]]
+    assert sorted((name, sorted(queries)) for name, queries in calls) == [('m', [1, 2, 3]), ('other', [4])]
+
+
+def test_batcher_max_size(loop):
+    calls = []
+
+    async def run(name, queries):
+        calls.append(queries)
+        return queries
+
+    batcher = server.Batcher(run, window=60, max_size=2)
+    results = loop.run_until_complete(asyncio.wait_for(asyncio.gather(
+        batcher.submit('m', [1]),
+        batcher.submit('m', [2])
+    ), timeout=5))
+
+    assert sorted(results) == [[1], [2]]
+    assert len(calls) == 1 and sorted(calls[0]) == [1, 2]
+
+
+def test_batcher_failure(loop):
+
+    async def run(name, queries):
+        raise RuntimeError('boom')
+
+    batcher = server.Batcher(run, window=0.01)
+    results = loop.run_until_complete(asyncio.gather(
+        batcher.submit('m', [1]),
+        batcher.submit('m', [2]),
+        return_exceptions=True
+    ))
+
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_bad_query_only_fails_its_request(loop, service):
+    good, bad = loop.run_until_complete(asyncio.gather(
+        service.handle_request({'queries': [['', 'abcd']]}),
+        service.handle_request({'queries': [{'sql': 'garbage'}, ['', 'ab']]})
+    ))
+
+    assert good == {'estimates': [4.]}
+    assert bad['estimates'] == [None, 2.] and list(bad['error']) == [0]
+
+
+def test_unknown_model(loop, service):
+    response = loop.run_until_complete(service.handle_request({'model': 'nope', 'queries': []}))
+    assert 'error' in response
+
+
+async def serve(service):
+    return await asyncio.start_server(service.handle_connection, '127.0.0.1', 0)
+
+
+def test_ndjson(loop, service):
+
+    async def exchange():
+        srv = await serve(service)
+        reader, writer = await asyncio.open_connection(*srv.sockets[0].getsockname())
+        responses = []
+        for request in ({'queries': [['', 'abc']]}, {'model': 'stub', 'queries': [['', 'bad']]}):
+            writer.write(json.dumps(request).encode() + b'\n')
+            responses.append(json.loads((await reader.readline()).decode()))
+        writer.close()
+        # Let the server see the end of the connection
+        await asyncio.sleep(0.05)
+        srv.close()
+        await srv.wait_closed()
+        return responses
+
+    ok, failed = loop.run_until_complete(exchange())
+
+    assert ok == {'estimates': [3.]}
+    assert failed['estimates'] == [None] and 'ValueError' in failed['error']['0']
+
+
+def test_http(loop, service):
+
+    async def request(host, port, method, path, body=b''):
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(
+            '{} {} HTTP/1.1\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+                method, path, len(body)
+            ).encode() + body
+        )
+        response = await reader.read()
+        writer.close()
+        head, _, payload = response.partition(b'\r\n\r\n')
+        return int(head.split()[1]), json.loads(payload.decode())
+
+    async def exchange():
+        srv = await serve(service)
+        address = srv.sockets[0].getsockname()
+        responses = [
+            await request(*address, 'GET', '/models'),
+            await request(*address, 'POST', '/estimate', json.dumps({'queries': [['', 'ab']]}).encode()),
+            await request(*address, 'POST', '/estimate', b'not json'),
+            await request(*address, 'GET', '/nope')
+        ]
+        await asyncio.sleep(0.05)
+        srv.close()
+        await srv.wait_closed()
+        return responses
+
+    models, estimate, invalid, unknown = loop.run_until_complete(exchange())
+
+    assert models == (200, {'models': ['stub']})
+    assert estimate == (200, {'estimates': [2.]})
+    assert invalid[0] == 400
+    assert unknown[0] == 404
+
+
+def test_malformed_line(loop, service):
+
+    async def exchange():
+        srv = await serve(service)
+        reader, writer = await asyncio.open_connection(*srv.sockets[0].getsockname())
+        responses = []
+        for line in (b'{"queries": [\n', json.dumps({'queries': [['', 'abc']]}).encode() + b'\n'):
+            writer.write(line)
+            responses.append(json.loads((await reader.readline()).decode()))
+        writer.close()
+        await asyncio.sleep(0.05)
+        srv.close()
+        await srv.wait_closed()
+        return responses
+
+    malformed, ok = loop.run_until_complete(exchange())
+
+    assert 'Invalid JSON' in malformed['error']
+    assert ok == {'estimates': [3.]}
+
+
+def test_invalid_content_length(loop, service):
+
+    async def exchange():
+        srv = await serve(service)
+        reader, writer = await asyncio.open_connection(*srv.sockets[0].getsockname())
+        writer.write(b'POST /estimate HTTP/1.1\r\nContent-Length: many\r\n\r\n')
+        response = await reader.read()
+        writer.close()
+        await asyncio.sleep(0.05)
+        srv.close()
+        await srv.wait_closed()
+        return response
+
+    response = loop.run_until_complete(exchange())
+
+    assert response.startswith(b'HTTP/1.1 400 ')
+
+
+def test_client_partial_failure(loop, service):
+
+    async def exchange():
+        srv = await serve(service)
+        host, port = srv.sockets[0].getsockname()[:2]
+
+        def request():
+            client = server.Client(host, port)
+            try:
+                estimates = client.estimate_many([['', 'ab'], ['', 'bad'], ['', 'abcd']])
+                with pytest.raises(ValueError):
+                    client.estimate_many([], model='nope')
+                return estimates
+            finally:
+                client.close()
+
+        estimates = await loop.run_in_executor(None, request)
+        await asyncio.sleep(0.05)
+        srv.close()
+        await srv.wait_closed()
+        return estimates
+
+    good, bad, other = loop.run_until_complete(exchange())
+
+    assert (good, other) == (2., 4.)
+    assert isinstance(bad, ValueError) and 'bad filter' in str(bad)
@@ -0,0 +1,92 @@
+import pytest
+
+from phd import bench
+from phd import expression
+from phd import sql
+from phd import tools
+
+
+def parse_operators(f: str) -> list:
+    """Returns the attribute and the operator of each predicate of a filter."""
+    return [tools.parse_predicate(expression.to_string(p)) for p in expression.predicates(expression.parse(f))]
+
+
+@pytest.mark.parametrize('value', [
+    "O'Brien",
+    'say "hi"',
+    '''both ' and "''',
+    'back\\slash',
+    'x and y',
+    'ends with (',
+    42,
+    1.5
+])
+def test_literal_round_trip(value):
+    query = sql.parse("SELECT * FROM t WHERE t.a = {} AND t.b > 3".format(bench.to_sql_literal(value)))
+
+    (a, equal), (b, greater) = parse_operators(query.filter_query)
+
+    assert (a, equal.operand) == ('t.a', value)
+    assert (b, greater.low) == ('t.b', 3)
+
+
+def test_quotes_in_disjunction():
+    query = sql.parse("SELECT * FROM people p WHERE p.name = 'O''Brien' OR p.name IN ('D''Arcy', 'Smith')")
+
+    (_, equal), (_, in_) = parse_operators(query.filter_query)
+
+    assert isinstance(expression.parse(query.filter_query), expression.Or)
+    assert equal.operand == "O'Brien"
+    assert list(in_.iterable) == ["D'Arcy", 'Smith']
+
+
+def test_count_query_round_trip():
+    parsed = sql.parse("SELECT COUNT(*) FROM people WHERE people.name = 'O''Brien' AND people.age >= 18")
+    subplan = {
+        'relation_names': parsed.relation_names,
+        'join_query': parsed.join_query,
+        'filter_query': parsed.filter_query
+    }
+
+    count_query = bench.to_count_query(subplan)
+
+    assert "'O''Brien'" in count_query
+    assert parse_operators(sql.parse(count_query).filter_query)[0][1].operand == "O'Brien"
+
+
+def test_self_join_is_labelled_by_alias():
+    parsed = sql.parse(
+        "SELECT COUNT(*) FROM title t, movie_info_idx mi_idx1, movie_info_idx mi_idx2 "
+        "WHERE t.id = mi_idx1.movie_id AND t.id = mi_idx2.movie_id "
+        "AND mi_idx1.info_type_id = 99 AND mi_idx2.info_type_id = 100"
+    )
+
+    assert parsed.relation_names == {
+        'mi_idx1': 'movie_info_idx',
+        'mi_idx2': 'movie_info_idx',
+        't': 'title'
+    }
+    assert sorted(a for a, _ in parse_operators(parsed.filter_query)) == [
+        'mi_idx1.info_type_id',
+        'mi_idx2.info_type_id'
+    ]
+
+    query = dict(name='q', join_query=parsed.join_query, filter_query=parsed.filter_query,
+                 aliases=parsed.relation_names)
+    subplans = bench.enumerate_subplans(query)
+    pair = next(s for s in subplans if s['relation_names'] == {'mi_idx1': 'movie_info_idx', 't': 'title'})
+
+    count_query = bench.to_count_query(pair)
+
+    assert 'FROM movie_info_idx AS mi_idx1, title AS t WHERE' in count_query
+    assert 'mi_idx2' not in count_query
+
+
+def test_unparsable_query_is_reported(tmp_path):
+    (tmp_path / 'good.sql').write_text("SELECT COUNT(*) FROM t WHERE t.a = 1")
+    (tmp_path / 'bad.sql').write_text("SELECT COUNT(*) FROM t WHERE t.a = 1 GROUP BY t.b")
+
+    workload = {query['name']: query for query in bench.load_workload(str(tmp_path))}
+
+    assert 'error' in workload['bad']
+    assert workload['good']['filter_query'] == 't.a == 1'
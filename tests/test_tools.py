@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from phd import tools
+
+
+def check_discretize_counts(series: pd.Series, n_mcv: int, n_bins: int):
+    codes, bins, is_mcv, n_distinct = tools.discretize(series, n_mcv=n_mcv, n_bins=n_bins)
+
+    count_bins, count_is_mcv, count_n_distinct, counts = tools.discretize_counts(
+        series.value_counts(), n_mcv=n_mcv, n_bins=n_bins
+    )
+
+    assert count_bins == bins
+    assert count_is_mcv.tolist() == is_mcv.tolist()
+    assert count_n_distinct.tolist() == n_distinct.tolist()
+    assert counts.tolist() == np.bincount(codes[codes >= 0], minlength=len(bins)).tolist()
+
+
+@pytest.mark.parametrize('n_mcv,n_bins', [(0, 5), (5, 5), (10, 30), (-1, 5)])
+def test_discretize_counts_numeric(n_mcv, n_bins):
+    rng = np.random.RandomState(42)
+    values = rng.exponential(20, 1000).round()
+    values[rng.rand(len(values)) < 0.1] = np.nan
+    check_discretize_counts(pd.Series(values), n_mcv, n_bins)
+
+
+@pytest.mark.parametrize('n_mcv,n_bins', [(0, 5), (5, 5), (10, 30)])
+def test_discretize_counts_categorical(n_mcv, n_bins):
+    rng = np.random.RandomState(42)
+    values = rng.choice(['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h'], 1000, p=[.3, .2, .1, .1, .1, .1, .05, .05])
+    check_discretize_counts(pd.Series(values, dtype=object), n_mcv, n_bins)